@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+#    Copyright (C) 2020 Ben Woodcroft
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+__author__ = "Ben Woodcroft"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Ben Woodcroft"]
+__license__ = "GPL3"
+__maintainer__ = "Ben Woodcroft"
+__email__ = "benjwoodcroft near gmail.com"
+__status__ = "Development"
+
+# Generate sample indices for OTU tables and archive OTU tables, so that
+# 'singlem condense' and 'singlem summarise --stream-inputs' with
+# --sample-names or --sample-list read only the requested samples. Each index
+# is written alongside its table, with the suffix '.sample_index'. Gzipped
+# tables must be BGZF-compressed e.g. with 'bgzip' from htslib.
+
+import argparse
+import logging
+import sys
+import os
+from multiprocessing import Pool
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')] + sys.path
+from singlem.otu_table_sample_index import OtuTableSampleIndex
+
+def generate_index(path_and_format):
+    path, table_format = path_and_format
+    index = OtuTableSampleIndex.generate(path, table_format)
+    return path, len(index.samples)
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate sample indices for OTU tables.')
+    parser.add_argument('--otu-tables', nargs='+', default=[], help='OTU tables to index')
+    parser.add_argument('--archive-otu-tables', nargs='+', default=[], help='archive OTU tables to index, optionally BGZF-compressed')
+    parser.add_argument('--archive-otu-table-list', help='index the archive OTU tables newline separated in this file')
+    parser.add_argument('--threads', type=int, default=1, help='number of tables to index in parallel [default 1]')
+    parser.add_argument('--debug', help='output debug information', action="store_true")
+    args = parser.parse_args()
+
+    if args.debug:
+        loglevel = logging.DEBUG
+    else:
+        loglevel = logging.INFO
+    logging.basicConfig(level=loglevel, format='%(asctime)s %(levelname)s: %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    to_index = [(p, OtuTableSampleIndex.OTU_TABLE_FORMAT) for p in args.otu_tables]
+    archives = list(args.archive_otu_tables)
+    if args.archive_otu_table_list:
+        with open(args.archive_otu_table_list) as f:
+            archives += [line.strip() for line in f if line.strip() != '']
+    to_index += [(p, OtuTableSampleIndex.ARCHIVE_OTU_TABLE_FORMAT) for p in archives]
+    if len(to_index) == 0:
+        raise Exception("No OTU tables specified")
+
+    with Pool(args.threads) as pool:
+        for path, num_samples in pool.imap_unordered(generate_index, to_index):
+            logging.info("Indexed {} samples in {}".format(num_samples, path))
+    logging.info("Finished")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+#    Copyright (C) 2020 Ben Woodcroft
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+__author__ = "Ben Woodcroft"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Ben Woodcroft"]
+__license__ = "GPL3"
+__maintainer__ = "Ben Woodcroft"
+__email__ = "benjwoodcroft near gmail.com"
+__status__ = "Development"
+
+# Report the memory used per OTU when an OTU table is read into memory, and
+# the time taken to run within_taxonomy over each OTU. The table is generated
+# on the fly, resembling a large multi-sample table i.e. 59 markers, many
+# samples and a limited pool of GTDB-style lineages.
+
+import argparse
+import logging
+import random
+import sys
+import os
+import time
+import gc
+import tracemalloc
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')] + sys.path
+from singlem.otu_table import OtuTable
+
+def generate_otu_table_lines(num_rows, num_samples, num_lineages, seed):
+    rand = random.Random(seed)
+    markers = ['S3.{}.ribosomal_protein_{}'.format(i, i) for i in range(59)]
+    samples = ['SRR{}'.format(1000000+i) for i in range(num_samples)]
+    lineages = []
+    for i in range(num_lineages):
+        lineages.append('; '.join(['Root', 'd__Bacteria',
+            'p__Phylum{}'.format(i % 100),
+            'c__Class{}'.format(i % 300),
+            'o__Order{}'.format(i % 1000),
+            'f__Family{}'.format(i % 3000),
+            'g__Genus{}'.format(i)][:rand.randint(3,7)]))
+
+    yield 'gene\tsample\tsequence\tnum_hits\tcoverage\ttaxonomy\n'
+    for _ in range(num_rows):
+        yield '{}\t{}\t{}\t{}\t{}\t{}\n'.format(
+            rand.choice(markers),
+            rand.choice(samples),
+            ''.join(rand.choice('ACGT') for _ in range(60)),
+            rand.randint(1,20),
+            round(rand.random()*10, 2),
+            rand.choice(lineages))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the memory usage of OTU table entries.')
+    parser.add_argument('--num-rows', type=int, default=10000000, help='number of OTUs [default 10M]')
+    parser.add_argument('--num-samples', type=int, default=1000)
+    parser.add_argument('--num-lineages', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--debug', help='output debug information', action="store_true")
+    args = parser.parse_args()
+
+    if args.debug:
+        loglevel = logging.DEBUG
+    else:
+        loglevel = logging.INFO
+    logging.basicConfig(level=loglevel, format='%(asctime)s %(levelname)s: %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    lines = generate_otu_table_lines(args.num_rows, args.num_samples, args.num_lineages, args.seed)
+
+    gc.collect()
+    tracemalloc.start()
+    otus = list(OtuTable.each(lines))
+    gc.collect()
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    logging.info("Read {} OTUs using {:.1f} MB, {:.1f} bytes per OTU".format(
+        len(otus), used / 1e6, used / len(otus)))
+
+    target = ['Root', 'd__Bacteria', 'p__Phylum7']
+    start = time.time()
+    num_within = sum(1 for otu in otus if otu.within_taxonomy(target))
+    logging.info("within_taxonomy over all OTUs took {:.2f}s ({} matched)".format(
+        time.time() - start, num_within))
+
+if __name__ == '__main__':
+    main()
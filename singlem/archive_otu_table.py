@@ -1,3 +1,4 @@
+import io
 import json
 
 from .otu_table_entry import OtuTableEntry
@@ -42,49 +43,277 @@ class ArchiveOtuTable:
             self.data.append(otu.data)
 
     def write_to(self, output_io):
-        json.dump({"version": self.version,
+        header = self._header()
+        header["otus"] = self.data
+        json.dump(header, output_io)
+
+    def _header(self):
+        return {"version": self.version,
              "alignment_hmm_sha256s": self.alignment_hmm_sha256s if self.alignment_hmm_sha256s else [s.alignment_hmm_sha256() for s in self.singlem_packages],
              "singlem_package_sha256s": self.singlem_package_sha256s if self.singlem_package_sha256s else [s.singlem_package_sha256() for s in self.singlem_packages],
-             'fields': self.fields,
-             "otus": self.data},
-                  output_io)
+             'fields': self.fields}
+
+    def write_columnar(self, output_path):
+        '''Write this table in columnar format to the given file path'''
+        from .columnar_otu_table import ColumnarOtuTable
+        ColumnarOtuTable.write(self, self.fields, output_path, archive_header=self._header())
+
+    @staticmethod
+    def read_columnar(path, min_version=None, samples=None, markers=None):
+        '''Read a columnar archive OTU table file, optionally only the OTUs
+        from particular samples and markers (see ColumnarOtuTable.each)'''
+        from .columnar_otu_table import ColumnarOtuTable
+        columnar = ColumnarOtuTable(path)
+        if not columnar.is_archive():
+            raise Exception("Columnar OTU table {} is not an archive OTU table".format(path))
+        otus = ArchiveOtuTable()
+        otus._set_header(columnar.archive_header, min_version)
+        otus.data = list(columnar.each_data(samples, markers))
+        return otus
 
     @staticmethod
     def read(input_io, min_version=None):
         otus = ArchiveOtuTable()
         j = json.load(input_io)
-        if not j['version'] in [1,2,3,4]:
+        otus._set_header(j, min_version)
+        otus.data = j['otus']
+        return otus
+
+    @staticmethod
+    def read_streaming(input_io, min_version=None):
+        '''Read an archive OTU table incrementally. The header (version, fields
+        and sha256s) is read and checked immediately, but the OTUs are only
+        parsed one at a time as the returned object is iterated over, so that
+        the whole table is never held in memory. Iteration can therefore only
+        be done once.
+
+        Parameters
+        ----------
+        input_io: IO
+            text or binary (e.g. from gzip.open) stream of archive JSON
+
+        Returns
+        -------
+        StreamingArchiveOtuTable
+        '''
+        return StreamingArchiveOtuTable(input_io, min_version)
+
+    def _set_header(self, header, min_version):
+        if not header['version'] in [1,2,3,4]:
             raise Exception("Wrong OTU table version detected")
-        otus.version = j['version']
-        if min_version is not None and otus.version < min_version:
+        self.version = header['version']
+        if min_version is not None and self.version < min_version:
             raise InsufficientArchiveOtuTableVersionException(
-                "OTU table version is too old, required: %d, found: %d" % (min_version, otus.version))
+                "OTU table version is too old, required: %d, found: %d" % (min_version, self.version))
 
-        otus.alignment_hmm_sha256s = j['alignment_hmm_sha256s']
-        otus.singlem_package_sha256s = j['singlem_package_sha256s']
+        self.alignment_hmm_sha256s = header['alignment_hmm_sha256s']
+        self.singlem_package_sha256s = header['singlem_package_sha256s']
 
-        otus.fields = j['fields']
-        if otus.fields != ArchiveOtuTable.FIELDS_OF_EACH_VERSION[j['version']-1]:
+        self.fields = header['fields']
+        if self.fields != ArchiveOtuTable.FIELDS_OF_EACH_VERSION[header['version']-1]:
             raise Exception("Unexpected archive OTU table format detected")
 
-        otus.data = j['otus']
-        return otus
+    def _entry(self, d):
+        e = ArchiveOtuTableEntry()
+        OtuTableEntry.intern_data(d)
+        e.marker = d[0]
+        e.sample_name = d[1]
+        e.sequence = d[2]
+        e.count = d[3]
+        e.coverage = d[4]
+        e.taxonomy = d[5]
+        e.data = d
+        e.fields = self.fields
+        return e
 
     def __iter__(self):
         for d in self.data:
-            e = ArchiveOtuTableEntry()
-            e.marker = d[0]
-            e.sample_name = d[1]
-            e.sequence = d[2]
-            e.count = d[3]
-            e.coverage = d[4]
-            e.taxonomy = d[5]
-            e.data = d
-            e.fields = self.fields
+            yield self._entry(d)
+
+
+class StreamingArchiveOtuTable(ArchiveOtuTable):
+    '''An ArchiveOtuTable where the OTUs are parsed from the input stream as
+    they are iterated over. The data attribute is always empty.'''
+
+    _HEADER_KEYS = ['version', 'alignment_hmm_sha256s', 'singlem_package_sha256s', 'fields']
+
+    def __init__(self, input_io, min_version=None):
+        super().__init__()
+        self._parser = _JsonObjectStreamParser(input_io)
+        self._buffered_otus = None
+
+        # Read the top level keys until the header is complete and the otus
+        # array is reached. Archives written by singlem have the otus last, but
+        # if the otus come before part of the header, buffer them in memory.
+        header = {}
+        for key in self._parser.each_key():
+            if key == 'otus':
+                if all(k in header for k in self._HEADER_KEYS):
+                    break
+                self._buffered_otus = list(self._parser.each_array_element())
+            else:
+                header[key] = self._parser.decode_value()
+        else:
+            self._parser = None
+        if self._buffered_otus is None and self._parser is None:
+            raise json.JSONDecodeError("No otus found in archive OTU table", '', 0)
+        self._set_header(header, min_version)
+
+    def __iter__(self):
+        if self._buffered_otus is not None:
+            for d in self._buffered_otus:
+                yield self._entry(d)
+            self._buffered_otus = None
+        else:
+            if self._parser is None:
+                raise Exception("Streaming archive OTU tables can only be iterated over once")
+            parser = self._parser
+            self._parser = None
+            for d in parser.each_array_element():
+                yield self._entry(d)
+            # Consume the remainder of the top-level object so that malformed
+            # input is detected.
+            for _ in parser.each_key():
+                parser.decode_value()
+
+
+class _JsonObjectStreamParser:
+    '''Minimal incremental parser for a JSON document that is a single object,
+    with the ability to iterate over the elements of an array value without
+    reading the whole array into memory. Individual values are decoded with the
+    standard json module.
+
+    If expect_object is False, parsing starts part-way through an array
+    instead, at the start of one of its elements, so that the remaining
+    elements can be read with each_remaining_array_element.'''
+
+    _CHUNK_SIZE = 1 << 20
+
+    def __init__(self, input_io, expect_object=True):
+        if isinstance(input_io.read(0), bytes):
+            input_io = io.TextIOWrapper(input_io, encoding='utf-8')
+        self._io = input_io
+        self._buffer = ''
+        self._position = 0
+        # Number of characters dropped from the start of the buffer
+        self._offset = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+        if expect_object:
+            self._expect('{')
+        self._first_key = True
+
+    def _read_more(self, min_size=0):
+        '''Read more of the input into the buffer, returning False at EOF'''
+        if self._eof:
+            return False
+        # Drop the consumed part of the buffer
+        if self._position > 0:
+            self._buffer = self._buffer[self._position:]
+            self._offset += self._position
+            self._position = 0
+        chunk = self._io.read(max(self._CHUNK_SIZE, min_size))
+        if chunk == '':
+            self._eof = True
+            return False
+        self._buffer += chunk
+        return True
+
+    def _peek(self):
+        '''Return the next non-whitespace character, without consuming it, or
+        None at EOF.'''
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position] in ' \t\n\r':
+                self._position += 1
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+            if not self._read_more():
+                return None
+
+    def tell(self):
+        '''Return the number of characters consumed from the input'''
+        return self._offset + self._position
+
+    def _error(self, message):
+        return json.JSONDecodeError(message, self._buffer, self._position)
+
+    def _expect(self, character):
+        if self._peek() != character:
+            raise self._error("Expecting '{}'".format(character))
+        self._position += 1
+
+    def decode_value(self):
+        '''Decode and return the next JSON value'''
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._position)
+                # A value that runs to the end of the buffer may be truncated
+                # e.g. a number, so only accept it if followed by something.
+                if end < len(self._buffer) or self._eof:
+                    self._position = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            # Grow the read size with the size of the pending value, so that
+            # large values are not re-parsed many times.
+            self._read_more(len(self._buffer) - self._position)
+
+    def each_key(self):
+        '''Yield each remaining key of the top-level object. The caller must
+        consume the corresponding value (with decode_value or
+        each_array_element) before the next key is yielded.'''
+        while True:
+            c = self._peek()
+            if c == '}':
+                self._position += 1
+                if self._peek() is not None:
+                    raise self._error("Extra data")
+                return
+            if not self._first_key:
+                self._expect(',')
+            self._first_key = False
+            key = self.decode_value()
+            if not isinstance(key, str):
+                raise self._error("Expecting property name")
+            self._expect(':')
+            yield key
+
+    def each_array_element(self, with_offsets=False):
+        '''Yield each element of the array which is the next value. If
+        with_offsets is True, yield (offset, element) tuples instead, where
+        offset is the tell() of the start of the element.'''
+        self._expect('[')
+        if self._peek() == ']':
+            self._position += 1
+            return
+        for e in self.each_remaining_array_element(with_offsets):
             yield e
 
+    def each_remaining_array_element(self, with_offsets=False):
+        '''Yield each element of the current array, starting from the next
+        value, which must be an element of it.'''
+        while True:
+            if with_offsets:
+                self._peek()
+                offset = self.tell()
+                yield offset, self.decode_value()
+            else:
+                yield self.decode_value()
+            c = self._peek()
+            if c == ',':
+                self._position += 1
+            elif c == ']':
+                self._position += 1
+                return
+            else:
+                raise self._error("Expecting ',' or ']'")
+
 
 class ArchiveOtuTableEntry(OtuTableEntry):
+    __slots__ = ()
+
     def read_names(self):
         '''Return a list of read names for this OTU'''
         return self.data[ArchiveOtuTable.READ_NAME_FIELD_INDEX]
@@ -0,0 +1,301 @@
+import json
+import struct
+import zlib
+
+import numpy as np
+
+from .archive_otu_table import ArchiveOtuTable
+from .otu_table_entry import OtuTableEntry
+
+
+class ColumnarOtuTable:
+    '''A compressed, column-oriented binary OTU table file, which can be read
+    much faster than the text and JSON formats since no CSV or JSON parsing of
+    the OTUs themselves is required.
+
+    The file is made up of row groups, each of which stores each column as a
+    separately zlib-compressed block. The marker, sample and taxonomy columns
+    are dictionary-encoded i.e. stored as integer codes into lists of distinct
+    strings. The dictionaries, fields, archive header (if any) and row group
+    locations are stored in a compressed JSON footer at the end of the file,
+    followed by the footer length and a magic number. Because the footer
+    records which samples and markers are present in each row group, reading
+    only some samples or markers skips the row groups that contain neither,
+    without decompressing them.
+
+    Columns other than the 6 default OTU table fields (e.g. read_names in
+    archive tables) are stored as one JSON value per row.
+    '''
+
+    MAGIC = b'SMCOLOTU'
+    version = 1
+    ROW_GROUP_SIZE = 65536
+
+    _TRAILER_FORMAT = '<Q8s'
+    _TRAILER_SIZE = struct.calcsize(_TRAILER_FORMAT)
+    _NUM_DEFAULT_FIELDS = 6
+
+    def __init__(self, path):
+        '''Read the footer of a columnar OTU table. OTUs are only read when
+        each() is called.'''
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise Exception("File {} does not appear to be a columnar OTU table".format(path))
+            f.seek(0, 2)
+            file_size = f.tell()
+            if file_size < len(self.MAGIC) + self._TRAILER_SIZE:
+                raise Exception("Columnar OTU table {} is truncated".format(path))
+            f.seek(file_size - self._TRAILER_SIZE)
+            footer_length, magic = struct.unpack(self._TRAILER_FORMAT, f.read(self._TRAILER_SIZE))
+            if magic != self.MAGIC:
+                raise Exception("Columnar OTU table {} is truncated".format(path))
+            f.seek(file_size - self._TRAILER_SIZE - footer_length)
+            footer = json.loads(zlib.decompress(f.read(footer_length)).decode())
+
+        if footer['version'] != self.version:
+            raise Exception("Unexpected columnar OTU table version {} found in {}".format(footer['version'], path))
+        self.fields = footer['fields']
+        self.archive_header = footer['archive_header']
+        self.markers = [OtuTableEntry.intern_string(m) for m in footer['markers']]
+        self.samples = [OtuTableEntry.intern_string(s) for s in footer['samples']]
+        self.taxonomies = [OtuTableEntry.intern_string(t) for t in footer['taxonomies']]
+        self._row_groups = footer['row_groups']
+
+    def is_archive(self):
+        return self.archive_header is not None
+
+    def __len__(self):
+        return sum(g['num_rows'] for g in self._row_groups)
+
+    @staticmethod
+    def write(otu_table_entries, fields, output_path, archive_header=None, row_group_size=ROW_GROUP_SIZE):
+        '''Write OTUs to a new columnar OTU table file. Row groups are written
+        as the OTUs are iterated over, so the OTUs are never all held in
+        memory. Reading by sample is fastest when the OTUs are ordered by
+        sample.
+
+        Parameters
+        ----------
+        otu_table_entries: iterable of OtuTableEntry
+            each must have all of the given fields
+        fields: list of str
+            the field names to write, the first 6 of which must be the default
+            OTU table fields
+        output_path: str
+            path to the file to write
+        archive_header: dict or None
+            version, alignment_hmm_sha256s and singlem_package_sha256s of an
+            archive OTU table, or None if the OTUs are not from an archive
+        row_group_size: int
+            maximum number of OTUs in each row group
+        '''
+        writer = _ColumnarOtuTableWriter(fields, archive_header)
+        with open(output_path, 'wb') as f:
+            f.write(ColumnarOtuTable.MAGIC)
+            rows = []
+            entry_fields = None
+            indices = None
+            for e in otu_table_entries:
+                # Entries from the same table share their fields object.
+                # Entries without fields (e.g. those created by condense)
+                # are taken to be in the order of the fields being written.
+                if e.fields is not entry_fields:
+                    entry_fields = e.fields
+                    indices = None if entry_fields is None or list(entry_fields) == writer.fields else \
+                        [entry_fields.index(f) for f in writer.fields]
+                if indices is None:
+                    if len(e.data) != len(writer.fields):
+                        raise Exception("Unexpected number of fields in OTU table row: %s" % str(e.data))
+                    rows.append(e.data)
+                else:
+                    rows.append([e.data[i] for i in indices])
+                if len(rows) == row_group_size:
+                    writer.write_row_group(f, rows)
+                    rows = []
+            if len(rows) > 0:
+                writer.write_row_group(f, rows)
+
+            footer = zlib.compress(json.dumps(writer.footer()).encode())
+            f.write(footer)
+            f.write(struct.pack(ColumnarOtuTable._TRAILER_FORMAT, len(footer), ColumnarOtuTable.MAGIC))
+
+    def each(self, samples=None, markers=None, min_archive_version=None):
+        '''Yield an OtuTableEntry (or ArchiveOtuTableEntry if the table is an
+        archive) for each OTU in the table, optionally only those from
+        particular samples and markers.
+
+        Parameters
+        ----------
+        samples: iterable of str or None
+            only yield OTUs from these samples. None means all samples.
+        markers: iterable of str or None
+            only yield OTUs from these markers. None means all markers.
+        min_archive_version: int or None
+            if not None, the table must be an archive OTU table at least this
+            version
+        '''
+        if self.is_archive():
+            archive = ArchiveOtuTable()
+            archive._set_header(self.archive_header, min_archive_version)
+            for d in self.each_data(samples, markers):
+                yield archive._entry(d)
+        else:
+            if min_archive_version is not None:
+                raise Exception("Columnar OTU table {} is not an archive OTU table".format(self.path))
+            fields = self.fields
+            for d in self.each_data(samples, markers):
+                e = OtuTableEntry()
+                e.marker = d[0]
+                e.sample_name = d[1]
+                e.sequence = d[2]
+                e.count = d[3]
+                e.coverage = d[4]
+                e.taxonomy = d[5]
+                e.data = d
+                e.fields = fields
+                yield e
+
+    def each_data(self, samples=None, markers=None):
+        '''Yield the data of each OTU as a list, in the order of the fields.
+        Parameters are as for each().'''
+        sample_codes = self._codes(self.samples, samples)
+        marker_codes = self._codes(self.markers, markers)
+
+        with open(self.path, 'rb') as f:
+            for group in self._row_groups:
+                if sample_codes is not None and sample_codes.isdisjoint(group['samples']):
+                    continue
+                if marker_codes is not None and marker_codes.isdisjoint(group['markers']):
+                    continue
+
+                sample_column = self._read_codes(f, group, 'sample')
+                marker_column = self._read_codes(f, group, 'gene')
+                selected = None
+                if sample_codes is not None:
+                    selected = np.isin(sample_column, list(sample_codes))
+                if marker_codes is not None:
+                    marker_selected = np.isin(marker_column, list(marker_codes))
+                    selected = marker_selected if selected is None else (selected & marker_selected)
+                if selected is not None:
+                    indices = np.flatnonzero(selected)
+                    if len(indices) == 0:
+                        continue
+                    if len(indices) == len(selected):
+                        indices = None
+                else:
+                    indices = None
+
+                def take(values):
+                    if indices is None:
+                        return values
+                    elif isinstance(values, np.ndarray):
+                        return values[indices]
+                    else:
+                        return [values[i] for i in indices.tolist()]
+
+                columns = [
+                    [self.markers[c] for c in take(marker_column).tolist()],
+                    [self.samples[c] for c in take(sample_column).tolist()],
+                    take(self._read_strings(f, group, 'sequence')),
+                    take(self._read_array(f, group, 'num_hits', '<i8')).tolist(),
+                    take(self._read_array(f, group, 'coverage', '<f8')).tolist(),
+                    [self.taxonomies[c] for c in take(self._read_codes(f, group, 'taxonomy')).tolist()],
+                ]
+                for field in self.fields[self._NUM_DEFAULT_FIELDS:]:
+                    columns.append([json.loads(v) for v in take(self._read_strings(f, group, field))])
+
+                for d in zip(*columns):
+                    yield list(d)
+
+    @staticmethod
+    def _codes(dictionary, values):
+        if values is None:
+            return None
+        wanted = set(values)
+        return set(i for i, v in enumerate(dictionary) if v in wanted)
+
+    @staticmethod
+    def _read_block(f, group, column):
+        offset, length = group['columns'][column]
+        f.seek(offset)
+        return zlib.decompress(f.read(length))
+
+    @staticmethod
+    def _read_array(f, group, column, dtype):
+        return np.frombuffer(ColumnarOtuTable._read_block(f, group, column), dtype=dtype)
+
+    @staticmethod
+    def _read_codes(f, group, column):
+        return ColumnarOtuTable._read_array(f, group, column, '<u4')
+
+    @staticmethod
+    def _read_strings(f, group, column):
+        # Values never contain newlines: sequences do not, and the other
+        # string columns are JSON-encoded.
+        return ColumnarOtuTable._read_block(f, group, column).decode().split('\n')
+
+
+class _ColumnarOtuTableWriter:
+    '''Accumulates the dictionaries and row group locations of a columnar OTU
+    table as its row groups are written.'''
+
+    def __init__(self, fields, archive_header):
+        if list(fields[:ColumnarOtuTable._NUM_DEFAULT_FIELDS]) != ArchiveOtuTable.FIELDS_VERSION1[:ColumnarOtuTable._NUM_DEFAULT_FIELDS]:
+            raise Exception("Unexpected OTU table fields: %s" % str(fields))
+        self.fields = list(fields)
+        self.archive_header = None
+        if archive_header is not None:
+            self.archive_header = {
+                'version': archive_header['version'],
+                'alignment_hmm_sha256s': archive_header['alignment_hmm_sha256s'],
+                'singlem_package_sha256s': archive_header['singlem_package_sha256s'],
+                'fields': self.fields,
+            }
+        self._dictionaries = {'gene': {}, 'sample': {}, 'taxonomy': {}}
+        self._row_groups = []
+
+    def _encode(self, column, values):
+        dictionary = self._dictionaries[column]
+        return np.array([dictionary.setdefault(v, len(dictionary)) for v in values], dtype='<u4')
+
+    def write_row_group(self, f, rows):
+        columns = list(zip(*rows))
+        marker_codes = self._encode('gene', columns[0])
+        sample_codes = self._encode('sample', columns[1])
+        blocks = [
+            ('gene', marker_codes.tobytes()),
+            ('sample', sample_codes.tobytes()),
+            ('sequence', '\n'.join(columns[2]).encode()),
+            ('num_hits', np.array(columns[3], dtype='<i8').tobytes()),
+            ('coverage', np.array(columns[4], dtype='<f8').tobytes()),
+            ('taxonomy', self._encode('taxonomy', columns[5]).tobytes()),
+        ]
+        for i, field in enumerate(self.fields[ColumnarOtuTable._NUM_DEFAULT_FIELDS:]):
+            blocks.append((field, '\n'.join(
+                [json.dumps(v) for v in columns[ColumnarOtuTable._NUM_DEFAULT_FIELDS+i]]).encode()))
+
+        locations = {}
+        for column, block in blocks:
+            compressed = zlib.compress(block)
+            locations[column] = [f.tell(), len(compressed)]
+            f.write(compressed)
+        self._row_groups.append({
+            'num_rows': len(rows),
+            'samples': sorted(set(sample_codes.tolist())),
+            'markers': sorted(set(marker_codes.tolist())),
+            'columns': locations,
+        })
+
+    def footer(self):
+        def dictionary_values(column):
+            return list(self._dictionaries[column].keys())
+        return {
+            'version': ColumnarOtuTable.version,
+            'fields': self.fields,
+            'archive_header': self.archive_header,
+            'markers': dictionary_values('gene'),
+            'samples': dictionary_values('sample'),
+            'taxonomies': dictionary_values('taxonomy'),
+            'row_groups': self._row_groups,
+        }
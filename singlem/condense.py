@@ -4,8 +4,10 @@ import csv
 import numpy as np
 import extern
 import sys
+import multiprocessing
 
 from queue import Queue
+from collections import deque
 
 from .archive_otu_table import ArchiveOtuTable, ArchiveOtuTableEntry
 from .singlem_package import SingleMPackage
@@ -25,6 +27,18 @@ while True:
     except OverflowError:
         maxInt = int(maxInt/10)
 
+# Arguments shared by all samples condensed in a worker process, set by
+# _init_condense_worker. Must be defined outside a class so that it is
+# pickle-able, so multiprocessing can work.
+_condense_worker_arguments = None
+
+def _init_condense_worker(*args):
+    global _condense_worker_arguments
+    _condense_worker_arguments = args
+
+def _condense_a_sample_in_worker(sample, sample_otus):
+    return Condenser()._condense_a_sample(sample, sample_otus, *_condense_worker_arguments)
+
 class Condenser:
     """ Combines otu table output for each marker into a single otu table"""
 
@@ -72,6 +86,7 @@ class Condenser:
         min_taxon_coverage = kwargs.pop('min_taxon_coverage', Condenser.DEFAULT_MIN_TAXON_COVERAGE)
         # apply_expectation_maximisation = kwargs.pop('apply_expectation_maximisation')
         output_after_em_otu_table = kwargs.pop('output_after_em_otu_table', False)
+        threads = kwargs.pop('threads', 1)
         if len(kwargs) > 0:
             raise Exception("Unexpected arguments detected: %s" % kwargs)
 
@@ -99,15 +114,47 @@ class Condenser:
             if target_domains[domain] in [1, 2]:
                 raise Exception("Number of markers for all domains must either be >= 3 or equal to 0. Only {} markers for domain '{}' found".format(target_domains[domain], domain))
 
-        for sample, sample_otus in input_otu_table.each_sample_otus(generate_archive_otu_table=True):
-            logging.debug("Processing sample {} ..".format(sample))
-            apply_diamond_expectation_maximisation = True
-            yield self._condense_a_sample(sample, sample_otus, markers, target_domains, trim_percent, min_taxon_coverage, 
-                True, apply_diamond_expectation_maximisation, metapackage, output_after_em_otu_table)
+        apply_diamond_expectation_maximisation = True
+        condense_arguments = (markers, target_domains, trim_percent, min_taxon_coverage,
+            True, apply_diamond_expectation_maximisation, metapackage, bool(output_after_em_otu_table))
+
+        for condensed_otus, after_em_otus in self._condense_each_sample(input_otu_table, condense_arguments, threads):
+            if output_after_em_otu_table:
+                after_em_otus.alignment_hmm_sha256s = 'na'
+                after_em_otus.singlem_package_sha256s = 'na'
+                with open(output_after_em_otu_table,'w') as f:
+                    after_em_otus.write_to(f)
+            yield condensed_otus
+
+    def _condense_each_sample(self, input_otu_table, condense_arguments, threads):
+        '''Yield the result of _condense_a_sample for each sample, in input
+        order. When threads > 1, samples are condensed in a pool of worker
+        processes, with at most a few samples per worker read ahead so that
+        large inputs are not loaded into RAM all at once.'''
+        each_sample_otus = input_otu_table.each_sample_otus(generate_archive_otu_table=True)
+        if threads <= 1:
+            for sample, sample_otus in each_sample_otus:
+                logging.debug("Processing sample {} ..".format(sample))
+                yield self._condense_a_sample(sample, sample_otus, *condense_arguments)
+            return
+
+        logging.info("Condensing samples using {} processes".format(threads))
+        with multiprocessing.Pool(threads, initializer=_init_condense_worker, initargs=condense_arguments) as pool:
+            pending = deque()
+            for sample, sample_otus in each_sample_otus:
+                logging.debug("Queueing sample {} ..".format(sample))
+                pending.append(pool.apply_async(_condense_a_sample_in_worker, (sample, sample_otus)))
+                if len(pending) >= 2 * threads:
+                    yield pending.popleft().get()
+            while len(pending) > 0:
+                yield pending.popleft().get()
 
     def _condense_a_sample(self, sample, sample_otus, markers, target_domains, trim_percent, min_taxon_coverage, 
             apply_query_expectation_maximisation, apply_diamond_expectation_maximisation, metapackage,
-            output_after_em_otu_table):
+            return_after_em_otu_table):
+        '''Return a tuple of the CondensedCommunityProfile of the sample, and
+        the OTU table after expectation maximisation if
+        return_after_em_otu_table is True, otherwise None.'''
 
         # Remove off-target OTUs genes
         logging.debug("Total coverage by query: {}".format(sum([o.coverage for o in sample_otus if o.taxonomy_assignment_method() == QUERY_BASED_ASSIGNMENT_METHOD])))
@@ -132,12 +179,6 @@ class Condenser:
             sample_otus = self._apply_genus_expectation_maximization(sample_otus, target_domains)
             logging.info("Total coverage: {}".format(sum([o.coverage for o in sample_otus])))
 
-        if output_after_em_otu_table:
-            sample_otus.alignment_hmm_sha256s = 'na'
-            sample_otus.singlem_package_sha256s = 'na'
-            with open(output_after_em_otu_table,'w') as f:
-                sample_otus.write_to(f)
-
         # Condense via trimmed mean from domain to species
         condensed_otus = self._condense_domain_to_species(sample, sample_otus, markers, target_domains, trim_percent, min_taxon_coverage)
 
@@ -146,7 +187,7 @@ class Condenser:
 
         self._report_taxonomic_level_assignment_stats(condensed_otus)
 
-        return condensed_otus
+        return condensed_otus, sample_otus if return_after_em_otu_table else None
 
     def _report_taxonomic_level_assignment_stats(self, condensed_otus):
         level_coverage = [0.0]*7
@@ -408,6 +449,10 @@ class Condenser:
         return demux_otus
     
     def _apply_genus_expectation_maximization_core(self, sample_otus, trim_percent, genes_per_domain):
+        # The same species are the equal best hits of many OTUs, so only
+        # truncate each once
+        species_to_genus = {}
+
         def best_hit_genera_from_otu(otu):
             # The DIAMOND assignments are already truncated to genus level.
             # But the query-based ones go to species level.
@@ -416,14 +461,22 @@ class Condenser:
             if method == DIAMOND_ASSIGNMENT_METHOD:
                 best_hit_genera = best_hit_taxonomies
             elif method in (QUERY_BASED_ASSIGNMENT_METHOD, QUERY_BASED_ASSIGNMENT_METHOD+'_abandoned'):
-                best_hit_genera = set(
-                    [';'.join([s.strip() for s in taxon.split(';')[:-1]]) for taxon in best_hit_taxonomies])
+                best_hit_genera = set()
+                for taxon in best_hit_taxonomies:
+                    try:
+                        best_hit_genera.add(species_to_genus[taxon])
+                    except KeyError:
+                        genus = ';'.join([s.strip() for s in taxon.split(';')[:-1]])
+                        species_to_genus[taxon] = genus
+                        best_hit_genera.add(genus)
             else:
                 raise Exception("Unexpected taxonomy assignment method: {}".format(otu.taxonomy_assignment_method()))
             return best_hit_genera
 
         # Set up initial conditions. The coverage of each genus is set to 1
-        genus_to_coverage = {}
+        otu_genera = []
+        otu_markers = []
+        otu_coverages = []
         best_hit_taxonomy_sets = set()
         some_em_to_do = False
         for otu in sample_otus:
@@ -431,71 +484,15 @@ class Condenser:
             if otu.taxonomy_assignment_method() == DIAMOND_ASSIGNMENT_METHOD:
                 some_em_to_do = True
             best_hit_taxonomy_sets.add(self._species_list_to_key(best_hit_genera))
-            for genus in best_hit_genera:
-                if genus not in genus_to_coverage:
-                    genus_to_coverage[genus] = 1
+            otu_genera.append(best_hit_genera)
+            otu_markers.append(otu.marker)
+            otu_coverages.append(otu.coverage)
         if some_em_to_do is False:
             return None
         logging.debug(best_hit_taxonomy_sets)
-        num_steps = 0
-
-        # The fraction of each undecided OTU is the ratio of that class's
-        # coverage (coverage in the current iteration) to the total coverage of
-        # all best hits of the undecided OTU
-        while True: # while not converged
-            next_genus_to_gene_to_coverage = {}
-            num_steps += 1
-            # logging.debug("Starting iteration with species abundances: {}".format(species_to_coverage))
 
-            # Partition out the undecided coverage according to the current
-            # iteration's ratios
-            for otu in sample_otus:
-                unnormalised_coverages = {}
-                best_hit_genera = best_hit_genera_from_otu(otu)
-
-                for best_hit_genus in best_hit_genera:
-                    if best_hit_genus in genus_to_coverage: # Can get removed during trimmed mean
-                        unnormalised_coverages[best_hit_genus] = genus_to_coverage[best_hit_genus]
-                total_coverage = sum(unnormalised_coverages.values())
-                # if total_coverage == 0:
-                #     # This OTU has been removed by the previous iteration through trimmed mean
-                #     continue
-
-                for tax, unnormalised_coverage in unnormalised_coverages.items():
-                    # Record the total for each gene so a trimmed mean can be taken afterwards
-                    if tax not in next_genus_to_gene_to_coverage:
-                        next_genus_to_gene_to_coverage[tax] = {}
-                    if otu.marker not in next_genus_to_gene_to_coverage[tax]:
-                        next_genus_to_gene_to_coverage[tax][otu.marker] = 0
-                    next_genus_to_gene_to_coverage[tax][otu.marker] = next_genus_to_gene_to_coverage[tax][otu.marker] + unnormalised_coverage / total_coverage * otu.coverage
-                    
-            # Calculate the trimmed mean for each genus
-            next_genus_to_coverage = {}
-            for tax, gene_to_coverage in next_genus_to_gene_to_coverage.items():
-                num_markers = len(genes_per_domain[tax.split(';')[1].strip().replace('d__','')])
-                logging.debug("Using {} markers for OTU taxonomy {}, with coverages {}".format(num_markers, tax, gene_to_coverage.values()))
-                trimmed_mean = self.calculate_abundance(list(gene_to_coverage.values()), num_markers, trim_percent)
-                next_genus_to_coverage[tax] = trimmed_mean
-
-            # Has any species changed in abundance by a large enough amount? If not, we're done
-            need_another_iteration = False
-            for tax, next_coverage in next_genus_to_coverage.items():
-                if abs(next_coverage - genus_to_coverage[tax]) > 0.001:
-                    logging.debug("Taxonomy {} changed from {} to {}".format(tax, next_coverage, genus_to_coverage[tax]))
-                    need_another_iteration = True
-                    break
-            genus_to_coverage = next_genus_to_coverage
-            if not need_another_iteration:
-                break
-        
-        # Round each genome to 4 decimal places in coverage, removing entries with 0 coverage
-        # Use 3 decimals to avoid rounding to 0 when one OTU is split between many species
-        rounded_genus_to_coverage = {}
-        for tax, coverage in genus_to_coverage.items():
-            cov2 = round(coverage, 3)
-            if cov2 > 0:
-                rounded_genus_to_coverage[tax] = cov2
-        
+        rounded_genus_to_coverage, num_steps = self._expectation_maximization(
+            otu_genera, otu_markers, otu_coverages, trim_percent, genes_per_domain)
         logging.info("Genus-wise EM converged in {} steps".format(num_steps))
 
         return rounded_genus_to_coverage, \
@@ -536,7 +533,9 @@ class Condenser:
 
     def _apply_species_expectation_maximization_core(self, sample_otus, trim_percent, genes_per_domain, min_genes_for_whitelist=10, proximity_cutoff=0.1):
         # Set up initial conditions. The coverage of each species is set to 1
-        species_to_coverage = {}
+        otu_species = []
+        otu_markers = []
+        otu_coverages = []
         best_hit_taxonomy_sets = set()
         some_em_to_do = False
         species_genes = {}
@@ -545,15 +544,14 @@ class Condenser:
             if otu.taxonomy_assignment_method() == QUERY_BASED_ASSIGNMENT_METHOD and best_hit_taxonomies is not None:
                 some_em_to_do = True
                 best_hit_taxonomy_sets.add(self._species_list_to_key(best_hit_taxonomies))
-                for best_hit_tax in best_hit_taxonomies:
-                    if best_hit_tax not in species_to_coverage:
-                        species_to_coverage[best_hit_tax] = 1
+                otu_species.append(best_hit_taxonomies)
+                otu_markers.append(otu.marker)
+                otu_coverages.append(otu.coverage)
                 if len(best_hit_taxonomies) == 1:
                     sp = best_hit_taxonomies[0]
                     if sp not in species_genes:
                         species_genes[sp] = set()
                     species_genes[sp].add(otu.marker)
-                species_genes
         if some_em_to_do is False:
             return None
         logging.debug(best_hit_taxonomy_sets)
@@ -562,98 +560,152 @@ class Condenser:
         logging.info("Found {} species uniquely hitting >= {} marker genes".format(len(species_whitelist), min_genes_for_whitelist))
         logging.debug("Species whitelist: {}".format(species_whitelist))
 
+        rounded_species_to_coverage, num_steps = self._expectation_maximization(
+            otu_species, otu_markers, otu_coverages, trim_percent, genes_per_domain,
+            species_whitelist=species_whitelist, proximity_cutoff=proximity_cutoff)
+        logging.info("Species-wise EM converged in {} steps".format(num_steps))
+
+        return rounded_species_to_coverage, \
+            list([self._key_to_species_list(k) for k in best_hit_taxonomy_sets])
+
+    def _expectation_maximization(self, otu_taxa, otu_markers, otu_coverages, trim_percent, genes_per_domain,
+        species_whitelist=None, proximity_cutoff=None):
+        '''Run EM over OTUs which each have a list of equally good best hit
+        taxa, returning a dict of taxon to coverage (rounded, with 0 coverage
+        taxa removed) and the number of iterations taken.
+
+        OTU to taxon membership is held as parallel arrays of (OTU, taxon)
+        pairs so each iteration is a handful of numpy operations rather than
+        loops over dictionaries. If species_whitelist is given, taxa are
+        species, and those which appear to be noise are removed each iteration,
+        i.e. species not in the whitelist with less than proximity_cutoff of
+        the total coverage of their genus.
+        '''
+        taxon_to_index = {}
+        marker_to_index = {}
+        pair_otus = []
+        pair_taxa = []
+        for otu_index, taxa in enumerate(otu_taxa):
+            for taxon in dict.fromkeys(taxa): # Remove duplicates, keeping order
+                pair_otus.append(otu_index)
+                pair_taxa.append(taxon_to_index.setdefault(taxon, len(taxon_to_index)))
+        taxa = list(taxon_to_index.keys())
+        num_taxa = len(taxa)
+        num_otus = len(otu_taxa)
+        pair_otus = np.array(pair_otus, dtype=np.int64)
+        pair_taxa = np.array(pair_taxa, dtype=np.int64)
+        otu_coverages = np.array(otu_coverages, dtype=np.float64)
+        otu_markers = np.array([marker_to_index.setdefault(m, len(marker_to_index)) for m in otu_markers], dtype=np.int64)
+        num_markers = len(marker_to_index)
+        pair_taxon_markers = pair_taxa * num_markers + otu_markers[pair_otus]
+
+        # Number of markers each taxon's coverage is averaged over
+        taxon_num_markers = np.array([
+            len(genes_per_domain[tax.split(';')[1].strip().replace('d__','')]) for tax in taxa], dtype=np.int64)
+
+        if species_whitelist is not None:
+            genus_to_index = {}
+            taxon_genera = np.array([
+                genus_to_index.setdefault(tax.split(';')[6].strip(), len(genus_to_index)) for tax in taxa], dtype=np.int64)
+            not_whitelisted = np.array([tax not in species_whitelist for tax in taxa], dtype=bool)
+
+        # Taxa are removed from consideration when they no longer receive any
+        # coverage, or are removed as noise.
+        taxon_coverages = np.ones(num_taxa)
+        taxon_present = np.ones(num_taxa, dtype=bool)
         num_steps = 0
+
         # The fraction of each undecided OTU is the ratio of that class's
         # coverage (coverage in the current iteration) to the total coverage of
         # all best hits of the undecided OTU
         while True: # while not converged
-            next_species_to_gene_to_coverage = {}
             num_steps += 1
-            # logging.debug("Starting iteration with species abundances: {}".format(species_to_coverage))
-            for otu in sample_otus:
-                unnormalised_coverages = {}
-                best_hit_taxonomies = otu.equal_best_hit_taxonomies()
-                if otu.taxonomy_assignment_method() == QUERY_BASED_ASSIGNMENT_METHOD and best_hit_taxonomies is not None:
-                    for best_hit_tax in best_hit_taxonomies:
-                        if best_hit_tax in species_to_coverage: # Can get removed during trimmed mean
-                            unnormalised_coverages[best_hit_tax] = species_to_coverage[best_hit_tax]
-                total_coverage = sum(unnormalised_coverages.values())
-                if total_coverage == 0:
-                    # This OTU has been removed by the previous iteration through trimmed mean
-                    continue
-
-                for tax, unnormalised_coverage in unnormalised_coverages.items():
-                    # Record the total for each gene so a trimmed mean can be taken afterwards
-                    if tax not in next_species_to_gene_to_coverage:
-                        next_species_to_gene_to_coverage[tax] = {}
-                    if otu.marker not in next_species_to_gene_to_coverage[tax]:
-                        next_species_to_gene_to_coverage[tax][otu.marker] = 0
-                    next_species_to_gene_to_coverage[tax][otu.marker] = next_species_to_gene_to_coverage[tax][otu.marker] + unnormalised_coverage / total_coverage * otu.coverage
-                    
-            # Calculate the (possibly trimmed) mean for each species
-            next_species_to_coverage = {}
-            for tax, gene_to_coverage in next_species_to_gene_to_coverage.items():
-                num_markers = len(genes_per_domain[tax.split(';')[1].strip().replace('d__','')])
-                # logging.debug("Using {} markers for OTU taxonomy {}, with coverages {}".format(num_markers, tax, gene_to_coverage.values()))
-                trimmed_mean = self.calculate_abundance(list(gene_to_coverage.values()), num_markers, trim_percent)
-                next_species_to_coverage[tax] = trimmed_mean
+
+            # Partition out the undecided coverage according to the current
+            # iteration's ratios
+            pair_unnormalised_coverages = np.where(taxon_present[pair_taxa], taxon_coverages[pair_taxa], 0)
+            otu_total_coverages = np.bincount(pair_otus, weights=pair_unnormalised_coverages, minlength=num_otus)
+            # OTUs where all taxa have been removed contribute nothing
+            pair_used = taxon_present[pair_taxa] & (otu_total_coverages[pair_otus] > 0)
+            used_otus = pair_otus[pair_used]
+            pair_coverages = pair_unnormalised_coverages[pair_used] / otu_total_coverages[used_otus] * otu_coverages[used_otus]
+
+            # Record the total for each gene so a (possibly trimmed) mean can
+            # be taken afterwards
+            used_taxon_markers = pair_taxon_markers[pair_used]
+            taxon_marker_coverages = np.bincount(
+                used_taxon_markers, weights=pair_coverages, minlength=num_taxa*num_markers).reshape(num_taxa, num_markers)
+            taxon_marker_counts = np.bincount(
+                used_taxon_markers, minlength=num_taxa*num_markers).reshape(num_taxa, num_markers)
+            next_taxon_present = taxon_marker_counts.sum(axis=1) > 0
+            next_taxon_coverages = self._calculate_abundances(
+                taxon_marker_coverages, (taxon_marker_counts > 0).sum(axis=1), taxon_num_markers, trim_percent)
 
             # Remove species that appear to be noise based upon having low
             # coverage and proximity to higher coverage species
-            failed_species = self._find_species_with_low_coverage_and_proximity_to_higher_coverage_species(
-                next_species_to_coverage, species_whitelist, proximity_cutoff)
-            for failed_s in failed_species:
-                logging.debug("Removing species {} due to low coverage and proximity to higher coverage species".format(failed_species))
-                del next_species_to_coverage[failed_s]
-
-            # Has any species changed in abundance by a large enough amount? If not, we're done
-            if len(failed_species) > 0:
-                # Always iterate again if we removed any species, because
-                # otherwise their coverage contributions will be lost.
-                need_another_iteration = True
+            num_failed_species = 0
+            if species_whitelist is not None:
+                genus_coverages = np.bincount(
+                    taxon_genera[next_taxon_present], weights=next_taxon_coverages[next_taxon_present], minlength=len(genus_to_index))
+                failed_species = next_taxon_present & not_whitelisted & \
+                    (next_taxon_coverages < genus_coverages[taxon_genera] * proximity_cutoff)
+                for failed_index in np.flatnonzero(failed_species):
+                    logging.debug("Removing species {} due to low coverage and proximity to higher coverage species".format(taxa[failed_index]))
+                next_taxon_present &= ~failed_species
+                num_failed_species = int(failed_species.sum())
+
+            # Has any taxon changed in abundance by a large enough amount? If
+            # not, we're done. Always iterate again if we removed any species,
+            # because otherwise their coverage contributions will be lost.
+            if np.any(next_taxon_present):
+                max_change = np.max(np.abs(next_taxon_coverages - taxon_coverages)[next_taxon_present])
             else:
-                need_another_iteration = False
-                for tax, next_coverage in next_species_to_coverage.items():
-                    if abs(next_coverage - species_to_coverage[tax]) > 0.001:
-                        need_another_iteration = True
-                        break
-
-            species_to_coverage = next_species_to_coverage
-            if not need_another_iteration:
+                max_change = 0
+            logging.debug("EM iteration {}: {} taxa remaining, {} removed, maximum coverage change {}".format(
+                num_steps, int(next_taxon_present.sum()), num_failed_species, max_change))
+
+            taxon_coverages = next_taxon_coverages
+            taxon_present = next_taxon_present
+            if num_failed_species == 0 and not max_change > 0.001:
                 break
-        
+
         # Round each genome to 4 decimal places in coverage, removing entries with 0 coverage
         # Use 3 decimals to avoid rounding to 0 when one OTU is split between many species
-        rounded_species_to_coverage = {}
-        for tax, coverage in species_to_coverage.items():
-            cov2 = round(coverage, 3)
+        rounded_taxon_to_coverage = {}
+        for taxon_index in np.flatnonzero(taxon_present):
+            cov2 = round(float(taxon_coverages[taxon_index]), 3)
             if cov2 > 0:
-                rounded_species_to_coverage[tax] = cov2
+                rounded_taxon_to_coverage[taxa[taxon_index]] = cov2
 
-        logging.info("Species-wise EM converged in {} steps".format(num_steps))
-
-        return rounded_species_to_coverage, \
-            list([self._key_to_species_list(k) for k in best_hit_taxonomy_sets])
-
-    def _find_species_with_low_coverage_and_proximity_to_higher_coverage_species(self,
-        species_to_coverage, species_whitelist, proximity_cutoff):
-        '''Return a list of species that is not in the species whitelist, and
-        is less than 10% of the total relative abundance of the genus
-        '''
-        genus_to_coverage = {}
-        for tax, coverage in species_to_coverage.items():
-            genus = tax.split(';')[6].strip()
-            if genus not in genus_to_coverage:
-                genus_to_coverage[genus] = 0
-            genus_to_coverage[genus] += coverage
-
-        failed_species = []
-        for tax, coverage in species_to_coverage.items():
-            genus = tax.split(';')[6].strip()
-            if tax not in species_whitelist and coverage < genus_to_coverage[genus] * proximity_cutoff:
-                failed_species.append(tax)
-        return failed_species
+        return rounded_taxon_to_coverage, num_steps
 
+    def _calculate_abundances(self, taxon_marker_coverages, taxon_num_observed_markers, taxon_num_markers, proportiontocut):
+        '''Vectorised version of calculate_abundance, taking a taxa by
+        markers matrix of coverages (0 where a marker was not observed), and
+        returning an array of abundances.'''
+        if proportiontocut == 0:
+            return taxon_marker_coverages.sum(axis=1) / taxon_num_markers
+
+        abundances = np.zeros(len(taxon_marker_coverages))
+        # Unobserved markers count as 0 coverage, so the number of measures
+        # averaged over can vary between taxa. Calculate each length
+        # separately.
+        lengths = np.maximum(taxon_num_observed_markers, taxon_num_markers)
+        for length in np.unique(lengths):
+            indices = np.flatnonzero(lengths == length)
+            coverages = taxon_marker_coverages[indices]
+            if coverages.shape[1] < length:
+                coverages = np.hstack([coverages, np.zeros((len(indices), length - coverages.shape[1]))])
+            # Since coverages are not negative, and there are at most length
+            # observed markers, the largest length values are the data plus
+            # padding 0s.
+            coverages = np.sort(coverages, axis=1)[:, coverages.shape[1]-length:]
+            cut = int(np.floor(length * proportiontocut))
+            if cut == 0:
+                abundances[indices] = np.mean(coverages, axis=1)
+            else:
+                abundances[indices] = np.mean(coverages[:, cut:-cut], axis=1)
+        return abundances
 
     def _demultiplex_otus(self, sample_otus, species_to_coverage, eq_classes,
     assignment_method):
@@ -843,6 +895,13 @@ class WordNode:
                 self.iter_queue.put(c)
             return node
 
+    def __getstate__(self):
+        # The iteration queue contains locks so cannot be pickled, which is
+        # needed to return profiles from condense worker processes.
+        state = self.__dict__.copy()
+        state.pop('iter_queue', None)
+        return state
+
     def calculate_level(self):
         '''Return the number of ancestors of this node, which corresponds to taxonomic levels'''
         c = 0
@@ -1,9 +1,8 @@
 import os
 import logging
-import extern
 
 from .singlem import FastaNameToSampleName
-from .run_via_os_system import run_via_os_system
+from .run_streaming_command import run_streaming_command
 
 class DiamondSpkgSearcher:
     def __init__(self, num_threads, working_directory):
@@ -68,9 +67,6 @@ class DiamondSpkgSearcher:
                 fasta_path = fasta_path[:-3] # remove .gz for destination files
             fasta_path = os.path.splitext(fasta_path)[0]+'.fna'
             
-            f = open(fasta_path, 'w+') # create tempfile in working directory
-            f.close()
-            
             cmd = "diamond blastx " \
                   "--outfmt 6 qseqid full_qseq sseqid " \
                   "--max-target-seqs 1 " \
@@ -78,34 +74,43 @@ class DiamondSpkgSearcher:
                   "%s " \
                   "--threads %i " \
                   "--query %s " \
-                  "--db %s " \
-                  "| tee >(sed 's/^/>/; s/\\t/\\n/; s/\\t.*//' > %s) " \
-                  "| awk '{print $1,$3}'" % (
+                  "--db %s" % (
                       performance_parameters,
                       self._num_threads,
                       file,
-                      diamond_database,
-                      fasta_path)
+                      diamond_database)
 
             # Originially, we ran here via os.system rather than normal extern
             # so reads can be piped in to singlem. However, this meant that
             # errors and failed commands were ignored, sometimes causing
-            # successful return of singlem but an empty OTU table.
-            qseqid_sseqid = extern.run(cmd)
+            # successful return of singlem but an empty OTU table. Now the
+            # output is read as it is generated, writing the hit sequences to
+            # fasta_path and reducing to best hits on the fly, so that the
+            # DIAMOND output is never held in RAM all at once.
+            logging.debug("Running command: {}".format(cmd))
             best_hits = {}
-            for line in qseqid_sseqid.splitlines():
-                try:
-                    (qseqid,sseqid) = line.split(' ')
-                except ValueError:
-                    raise Exception("Unexpected line format for DIAMOND output line '{}'".format(line))
-                if qseqid in best_hits and best_hits[qseqid] != sseqid:
-                    raise Exception("Multiple DIAMOND best hits? for '{}'".format(qseqid))
-                best_hits[qseqid] = sseqid
+            with run_streaming_command(cmd) as diamond_output:
+                with open(fasta_path, 'w') as fasta_out:
+                    self._read_diamond_output(diamond_output, fasta_out, best_hits)
 
             diamond_results.append(DiamondSearchResult(fasta_path, best_hits))
             
         return diamond_results
 
+    def _read_diamond_output(self, diamond_output, fasta_out, best_hits):
+        '''Read DIAMOND output lines of qseqid, full_qseq and sseqid,
+        writing each query sequence to fasta_out and recording the best hit
+        of each query in the best_hits dict.'''
+        for line in diamond_output:
+            try:
+                (qseqid, full_qseq, sseqid) = line.rstrip('\n').split('\t')
+            except ValueError:
+                raise Exception("Unexpected line format for DIAMOND output line '{}'".format(line))
+            fasta_out.write(">{}\n{}\n".format(qseqid, full_qseq))
+            if qseqid in best_hits and best_hits[qseqid] != sseqid:
+                raise Exception("Multiple DIAMOND best hits? for '{}'".format(qseqid))
+            best_hits[qseqid] = sseqid
+
 class DiamondSearchResult:
     def __init__(self, query_sequence_file, best_hits):
         self.query_sequences_file = query_sequence_file
@@ -1,7 +1,6 @@
 import logging
-import re
+import numpy as np
 from .sequence_classes import UnalignedAlignedNucleotideSequence
-import itertools
 
 class MetagenomeOtuFinder:
     def find_windowed_sequences(self,
@@ -85,15 +84,16 @@ class MetagenomeOtuFinder:
         return windowed_sequences
 
     def _find_lower_case_columns(self, protein_alignment):
-        lower_cases = [False]*len(protein_alignment[0].seq)
-        lower_case_chars = re.compile(r'[a-z]')
+        alignment_length = len(protein_alignment[0].seq)
+        lower_cases = np.zeros(alignment_length, dtype=bool)
         for pro in protein_alignment:
-            for i, aa in enumerate(pro.seq):
-                if lower_case_chars.match(aa):
-                    if i >= len(lower_cases):
-                        raise Exception("Unexpectedly found sequence with long length in alignment: {} / {}", pro.name, pro.seq)
-                    lower_cases[i] = True
-        return [i for i, is_lower in enumerate(lower_cases) if is_lower]
+            codes = np.frombuffer(pro.seq.encode(), dtype=np.uint8)
+            lower_case_indices = np.flatnonzero((codes >= ord('a')) & (codes <= ord('z')))
+            if len(lower_case_indices) > 0:
+                if lower_case_indices[-1] >= alignment_length:
+                    raise Exception("Unexpectedly found sequence with long length in alignment: {} / {}", pro.name, pro.seq)
+                lower_cases[lower_case_indices] = True
+        return list([int(i) for i in np.flatnonzero(lower_cases)])
 
     def find_best_window(self, alignment, stretch_length, is_protein_alignment):
         '''Return the position in the alignment that has the most bases aligned only
@@ -127,46 +127,53 @@ class MetagenomeOtuFinder:
             raise Exception("stretch_length must be positive")
 
         ignored_columns = self._find_lower_case_columns(alignment)
+        alignment_length = len(alignment[0].seq)
 
-        # Convert the alignment into a True/False matrix for ease,
-        # True meaning that there is something aligned, else False
-        binary_alignment = []
-        for s in alignment:
-            aln = []
-            for i, base in enumerate(s.seq):
-                if base=='-':
-                    aln.append(False)
-                else:
-                    aln.append(True)
-            binary_alignment.append(aln)
+        # Windows start at, and are made up of, columns which are not ignored.
+        # Index windows by the position of their first column among these
+        # kept columns, which is also the position returned.
+        kept_columns = np.setdiff1d(np.arange(alignment_length), ignored_columns)
+        # Windows must start early enough in the alignment and not run past
+        # its end.
+        num_windows = len(kept_columns) - stretch_length + 1
+        if num_windows > 0:
+            num_windows = int(np.searchsorted(
+                kept_columns[:num_windows], alignment_length - stretch_length, side='right'))
+
+        # Find the number of aligned bases in each window, only counting
+        # sequences that are aligned at both its first and last column. Use
+        # prefix sums over each sequence so that each window is scored in
+        # constant time. Sequences are processed in chunks to bound RAM usage.
+        window_scores = np.zeros(max(num_windows, 0), dtype=np.int64)
+        if num_windows > 0:
+            chunk_size = 10000
+            for chunk_start in range(0, len(alignment), chunk_size):
+                chunk = alignment[chunk_start:chunk_start+chunk_size]
+                codes = np.frombuffer(''.join([s.seq for s in chunk]).encode(), dtype=np.uint8)
+                if len(codes) != len(chunk) * alignment_length:
+                    raise Exception("Unexpectedly found sequences of differing lengths in alignment")
+                # True/False matrix, True meaning that there is something
+                # aligned, else False
+                binary_alignment = (codes != ord('-')).reshape(len(chunk), alignment_length)[:, kept_columns]
+                prefix_sums = np.zeros((len(chunk), len(kept_columns)+1), dtype=np.int32)
+                np.cumsum(binary_alignment, axis=1, out=prefix_sums[:, 1:])
+                bases_in_windows = prefix_sums[:, stretch_length:stretch_length+num_windows] - prefix_sums[:, :num_windows]
+                covers_window = binary_alignment[:, :num_windows] & \
+                    binary_alignment[:, stretch_length-1:stretch_length-1+num_windows]
+                window_scores += np.where(covers_window, bases_in_windows, 0).sum(axis=0)
 
-        # Find the number of aligned bases at each position
-        current_best_position = 0
-        current_max_num_aligned_bases = 0
-        for i in range(0, len(binary_alignment[0])-stretch_length+1):
-            if i in ignored_columns: continue #don't start from ignored columns
-            positions = self._best_position_to_chosen_positions(i, stretch_length, ignored_columns)
-            logging.debug("Testing positions %s" % str(positions))
-            num_bases_covered_here = 0
-            end_index = positions[-1]
-            #if ignored char is within stretch length of end of aln
-            if end_index >= len(binary_alignment[0]): continue
-            for s in binary_alignment:
-                if not s[i] or not s[end_index]: continue #ignore reads that don't cover the entirety
-                for pos in positions:
-                    if s[pos]: num_bases_covered_here += 1
-            logging.debug("Found %i aligned bases at position %i" % (num_bases_covered_here, i))
-            if num_bases_covered_here > current_max_num_aligned_bases:
-                current_best_position = i
-                current_max_num_aligned_bases = num_bases_covered_here
+        # Choose the first window with the most bases aligned, or the start of
+        # the alignment if no window has any.
+        if num_windows > 0 and window_scores.max() > 0:
+            start_position_without_gaps = int(np.argmax(window_scores))
+            current_best_position = int(kept_columns[start_position_without_gaps])
+            current_max_num_aligned_bases = int(window_scores[start_position_without_gaps])
+        else:
+            start_position_without_gaps = 0
+            current_best_position = 0
+            current_max_num_aligned_bases = 0
         logging.info("Found a window starting at position %i with %i bases aligned" % (
             current_best_position, current_max_num_aligned_bases))
-
-        # Convert the best position to the best position not including ignored columns
-        start_position_without_gaps = current_best_position
-        for col in ignored_columns:
-            if col < current_best_position:
-                start_position_without_gaps -= 1
         logging.info("Found best section of the alignment starting from %i" % (
             start_position_without_gaps+1))
 
@@ -175,10 +182,11 @@ class MetagenomeOtuFinder:
     def _best_position_to_chosen_positions(self, best_position, stretch_length, ignored_columns):
         '''Given a position to start from, and the number of positions to index,
         return the consecutive indices that are not in the ignored_columns list'''
+        ignored = set(ignored_columns)
         chosens = []
         i = best_position
         while len(chosens) < stretch_length:
-            if i not in ignored_columns:
+            if i not in ignored:
                 chosens.append(i)
             i += 1
         return chosens
@@ -231,39 +239,42 @@ class MetagenomeOtuFinder:
             length_ratio = 1
             empty_codon = '-'
 
+        # For each position in the amino acid sequence, if it is a non-dash
+        # character take the next codon from the nucleotide sequence, else
+        # record an empty codon. Codons are located by offset rather than by
+        # repeatedly slicing the nucleotide string.
         codons = []
-        # For each position in the amino acid sequence
-        # If non-dash character, take 3 nucleotides off the nucleotide sequence and
-        # add that as the codon
-        # else add None
+        offset = 0
+        num_nucleotides = len(nucleotides)
         for aa in protein_sequence.seq:
             if aa=='-':
                 codons.append(empty_codon)
             else:
-                if len(nucleotides) < length_ratio: raise Exception("Insufficient nucleotide length found")
-                codons.append(nucleotides[:length_ratio])
-                if len(nucleotides)>=length_ratio: nucleotides = nucleotides[length_ratio:]
-                if nucleotides[:length_ratio] == empty_codon: raise Exception("Input nucleotide sequence had gap characters, didn't expect this")
-        if len(nucleotides) > 0:
+                next_offset = offset + length_ratio
+                if next_offset > num_nucleotides: raise Exception("Insufficient nucleotide length found")
+                codons.append(nucleotides[offset:next_offset])
+                offset = next_offset
+                if nucleotides[offset:offset+length_ratio] == empty_codon: raise Exception("Input nucleotide sequence had gap characters, didn't expect this")
+        if offset < num_nucleotides:
             raise Exception(
                 "Insufficient aligned length found - were unaligned columns"
                 " removed? Don't remove them.")
 
-        aligned_length = 0
-        for i in range(chosen_positions[0],chosen_positions[-1]+1):
-            if protein_sequence.seq[i] != '-':
-                aligned_length += length_ratio
+        first = chosen_positions[0]
+        last = chosen_positions[-1]
+        window = protein_sequence.seq[first:last+1]
+        aligned_length = (len(window) - window.count('-')) * length_ratio
 
         if include_inserts:
+            chosen = set(chosen_positions)
             to_return = []
-            for i in range(chosen_positions[0], chosen_positions[-1]+1):
-                if i in chosen_positions:
-                    to_return += codons[i]
+            for i in range(first, last+1):
+                if i in chosen:
+                    to_return.append(codons[i])
                 elif codons[i] == empty_codon:
                     pass
                 else:
-                    to_return += codons[i].lower()
+                    to_return.append(codons[i].lower())
             return ''.join(to_return), aligned_length
         else:
-            return ''.join(itertools.chain(codons[i] for i in chosen_positions)), \
-                aligned_length
+            return ''.join([codons[i] for i in chosen_positions]), aligned_length
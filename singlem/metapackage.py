@@ -5,6 +5,10 @@ import shutil
 import extern
 import tempfile
 import json
+import hashlib
+import fcntl
+import functools
+import glob
 import pandas as pd
 
 import zenodo_backpack
@@ -16,6 +20,20 @@ from .metapackage_read_name_store import MetapackageReadNameStore
 DATA_DEFAULT_VERSION = '3.1.0'
 DATA_ENVIRONMENT_VARIABLE = 'SINGLEM_METAPACKAGE_PATH'
 DATA_DOI = '10.5281/zenodo.5739611'
+# Directory where DIAMOND databases built by Metapackage.get_dmnd are cached.
+# Set to an empty string to disable caching.
+DIAMOND_CACHE_ENVIRONMENT_VARIABLE = 'SINGLEM_DIAMOND_CACHE_DIRECTORY'
+DIAMOND_CACHE_LOCK_FILE_NAME = '.lock'
+
+# Number of read name to taxonomy lookups remembered in memory, since the same
+# reference sequences tend to be looked up repeatedly e.g. across samples in
+# condense
+READ_NAME_TAXONOMY_CACHE_SIZE = 50000
+
+@functools.lru_cache(maxsize=None)
+def _diamond_version():
+    '''Output of 'diamond version', run only once per process.'''
+    return extern.run('diamond version').strip()
 
 class Metapackage:
     '''A class for a set of SingleM packages, plus prefilter DB'''
@@ -278,17 +296,111 @@ class Metapackage:
         self._prefilter_path = path
 
     def get_dmnd(self):
-        ''' Create temporary DIAMOND file for search method '''
+        '''Return the path to a DIAMOND database of the unaligned sequences of
+        all the SingleM packages, for use when there is no prefilter DB.
+
+        Built databases are cached in a directory named by the environment
+        variable SINGLEM_DIAMOND_CACHE_DIRECTORY (default
+        $XDG_CACHE_HOME/singlem/diamond), keyed by the sha256 of the SingleM
+        packages. Concurrent processes wait for each other through a lock
+        file in the cache directory, so that only one of them builds the
+        database. If caching is disabled or the cache directory cannot be
+        written to, a temporary database is built instead.
+        '''
         fasta_paths = [pkg.graftm_package().unaligned_sequence_database_path() for pkg in self.singlem_packages]
-        temp_dmnd = tempfile.NamedTemporaryFile(mode="w", prefix='singlem-diamond-prefilter',
-                                                suffix='.dmnd', delete=False).name
+
+        cache_directory = self._diamond_cache_directory()
+        if cache_directory is None:
+            temp_dmnd = tempfile.NamedTemporaryFile(mode="w", prefix='singlem-diamond-prefilter',
+                                                    suffix='.dmnd', delete=False).name
+            self._make_dmnd(fasta_paths, temp_dmnd)
+            return temp_dmnd
+
+        key = self._dmnd_cache_key()
+        cached_dmnd = os.path.join(cache_directory, '{}.dmnd'.format(key))
+        if os.path.exists(cached_dmnd):
+            self._log_using_cached_dmnd(cached_dmnd)
+            return cached_dmnd
+
+        # A single lock file is shared by all cache entries, so that lock
+        # files do not accumulate in the cache directory. It is never removed,
+        # since a process could otherwise lock a file that another has just
+        # removed.
+        with open(os.path.join(cache_directory, DIAMOND_CACHE_LOCK_FILE_NAME), 'w') as lock:
+            logging.debug("Waiting for lock on DIAMOND database cache {} ..".format(cache_directory))
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # Another process may have built it while we were waiting
+                if os.path.exists(cached_dmnd):
+                    self._log_using_cached_dmnd(cached_dmnd)
+                    return cached_dmnd
+
+                logging.info("Building DIAMOND database from SingleM packages, caching it as {} (set {} to change the cache directory, or to '' to disable caching) ..".format(
+                    cached_dmnd, DIAMOND_CACHE_ENVIRONMENT_VARIABLE))
+                # Build under a temporary name in the same directory, then
+                # move into place. The .dmnd is moved last so its existence
+                # implies the index is in place too.
+                building_prefix = os.path.join(cache_directory, '{}.building{}'.format(key, os.getpid()))
+                building_dmnd = building_prefix + '.dmnd'
+                try:
+                    self._make_dmnd(fasta_paths, building_dmnd)
+                    for path in glob.glob(building_dmnd + '.*'):
+                        os.replace(path, cached_dmnd + path[len(building_dmnd):])
+                    os.replace(building_dmnd, cached_dmnd)
+                finally:
+                    for path in glob.glob(building_prefix + '.*'):
+                        os.remove(path)
+                logging.info("Finished building DIAMOND database {}".format(cached_dmnd))
+                return cached_dmnd
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _log_using_cached_dmnd(self, cached_dmnd):
+        logging.info("Using cached DIAMOND database {} (set {} to change the cache directory, or to '' to disable caching)".format(
+            cached_dmnd, DIAMOND_CACHE_ENVIRONMENT_VARIABLE))
+
+    def _make_dmnd(self, fasta_paths, dmnd_path):
         cmd = 'cat %s | '\
-            'diamond makedb --in - --db %s' % (' '.join(fasta_paths), temp_dmnd)
+            'diamond makedb --in - --db %s' % (' '.join(fasta_paths), dmnd_path)
 
         extern.run(cmd)
-        extern.run("diamond makeidx -d {}".format(temp_dmnd))
-
-        return temp_dmnd
+        extern.run("diamond makeidx -d {}".format(dmnd_path))
+
+    def _diamond_cache_directory(self):
+        '''Return the directory to cache DIAMOND databases in, creating it if
+        necessary, or None if caching is disabled or not possible.'''
+        if DIAMOND_CACHE_ENVIRONMENT_VARIABLE in os.environ:
+            cache_directory = os.environ[DIAMOND_CACHE_ENVIRONMENT_VARIABLE]
+            if cache_directory == '':
+                return None
+        else:
+            cache_directory = os.path.join(
+                os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+                'singlem', 'diamond')
+        try:
+            os.makedirs(cache_directory, exist_ok=True)
+        except OSError as e:
+            logging.warning("Unable to create DIAMOND database cache directory {}, not caching: {}".format(cache_directory, e))
+            return None
+        if not os.access(cache_directory, os.W_OK):
+            logging.warning("DIAMOND database cache directory {} is not writeable, not caching".format(cache_directory))
+            return None
+        return cache_directory
+
+    def _dmnd_cache_key(self):
+        '''sha256 identifying the DIAMOND database built from these SingleM
+        packages by the installed version of DIAMOND.'''
+        h = hashlib.sha256()
+        # DB format can change between DIAMOND versions
+        h.update(_diamond_version().encode())
+        for pkg in self.singlem_packages:
+            try:
+                pkg_sha256 = pkg.singlem_package_sha256()
+            except KeyError:
+                # Old packages may not record their sha256
+                pkg_sha256 = pkg.calculate_singlem_package_sha256()
+            h.update(pkg_sha256.encode())
+        return h.hexdigest()
 
     def protein_packages(self):
         return [pkg for pkg in self._hmms_and_positions.values() if pkg.is_protein_package()]
@@ -368,8 +480,18 @@ class Metapackage:
             )))
 
     def get_taxonomy_of_reads(self, read_names):
-        store = MetapackageReadNameStore.acquire(self._sqlite_db_path)
-        return store.get_taxonomy_of_reads(read_names)
+        return self._read_name_store().get_taxonomy_of_reads(read_names)
+
+    def _read_name_store(self):
+        '''Return a MetapackageReadNameStore, reused across calls within a
+        process. SQLAlchemy engines cannot be shared across forked processes,
+        so a new store is acquired in each worker process.'''
+        pid = os.getpid()
+        if getattr(self, '_read_name_store_pid', None) != pid:
+            self._cached_read_name_store = MetapackageReadNameStore.acquire(
+                self._sqlite_db_path, cache_size=READ_NAME_TAXONOMY_CACHE_SIZE)
+            self._read_name_store_pid = pid
+        return self._cached_read_name_store
 
     def nucleotide_sdb(self):
         # import here so that we avoid tensorflow dependency if not needed
@@ -1,13 +1,16 @@
 import logging
+import os
+import sqlite3
 import tempfile
+import urllib.parse
+from collections import OrderedDict
 import extern
 
 from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
 from sqlalchemy.orm import registry, declarative_base
 from sqlalchemy import Column, Integer, String, select
 
-from bird_tool_utils import iterable_chunks
-
 from .singlem_package import SingleMPackage
 
 mapper_registry = registry()
@@ -45,27 +48,74 @@ class MetapackageReadNameStore:
         logging.info("Imported {} packages and {} read names.".format(num_packages, num_read_names))
 
     @staticmethod
-    def acquire(sqlitedb_path):
-        engine = create_engine("sqlite+pysqlite:///{}".format(sqlitedb_path),
+    def acquire(sqlitedb_path, cache_size=0):
+        '''Open an existing store for reading.
+
+        Parameters
+        ----------
+        sqlitedb_path: str
+            path to the sqlite3 DB created with generate()
+        cache_size: int
+            number of read name to taxonomy lookups to remember in memory, so
+            they are not looked up again. 0 for no cache.
+        '''
+        uri = 'file:{}?mode=ro'.format(urllib.parse.quote(os.path.abspath(sqlitedb_path)))
+        # A single connection is reused for all lookups, so use a pool that
+        # holds exactly one.
+        engine = create_engine("sqlite+pysqlite://",
+            creator=lambda: sqlite3.connect(uri, uri=True, check_same_thread=False),
+            poolclass=StaticPool,
             echo=logging.getLogger().isEnabledFor(logging.DEBUG),
             future=True)
 
         m = MetapackageReadNameStore()
         m.engine = engine
+        m._connection = None
+        m._cache_size = cache_size
+        m._cache = OrderedDict()
 
         return m
 
+    def _get_connection(self):
+        if self._connection is None:
+            self._connection = self.engine.connect()
+        return self._connection
+
     def get_taxonomy_of_reads(self, read_names):
         '''Return dict of read name to taxonomy string'''
         to_return = {}
 
-        for read_name_set in iterable_chunks(read_names, 900): # Must be at least < 1000 for sqlite versions prior to 3.32.0
-            names = [r for r in read_name_set if r is not None]
-            stmt = select(ReadNameTaxonomy).where(
-                ReadNameTaxonomy.read_name.in_(names))
-            with self.engine.connect() as conn:
-                for res in conn.execute(stmt):
-                    to_return[res.read_name] = [s.strip() for s in res.taxonomy.split(';')]
+        to_lookup = []
+        for name in read_names:
+            if name in self._cache:
+                self._cache.move_to_end(name)
+                to_return[name] = list(self._cache[name])
+            else:
+                to_lookup.append(name)
+
+        if len(to_lookup) > 0:
+            # Resolve all names in a single statement by joining against a
+            # temporary table, rather than using chunked IN clauses.
+            conn = self._get_connection()
+            with conn.begin():
+                conn.exec_driver_sql("CREATE TEMP TABLE query_read_names (read_name TEXT)")
+                try:
+                    conn.exec_driver_sql(
+                        "INSERT INTO query_read_names (read_name) VALUES (?)",
+                        [(name,) for name in to_lookup])
+                    for res in conn.exec_driver_sql(
+                        "SELECT r.read_name, r.taxonomy FROM read_name_taxonomy r "
+                        "JOIN query_read_names q ON r.read_name = q.read_name"):
+
+                        taxonomy = [s.strip() for s in res.taxonomy.split(';')]
+                        to_return[res.read_name] = taxonomy
+                        if self._cache_size > 0:
+                            self._cache[res.read_name] = tuple(taxonomy)
+                finally:
+                    conn.exec_driver_sql("DROP TABLE temp.query_read_names")
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
         if len(to_return) != len(read_names):
             raise Exception("Not all read names found in metapackage sqlite3 database")
         return to_return
@@ -1,6 +1,7 @@
 import csv
 
 from .archive_otu_table import ArchiveOtuTable
+from .columnar_otu_table import ColumnarOtuTable
 from .otu_table_entry import OtuTableEntry
 
 
@@ -35,6 +36,7 @@ class OtuTable:
                 except ValueError:
                     raise Exception("Malformed OTU table detected, num_hits column is not an integer, on line %i: %s" % (i+1, str(d)))
                 d[4] = float(d[4])
+                OtuTableEntry.intern_data(d)
                 e.marker = d[0]
                 e.sample_name = d[1]
                 e.sequence = d[2]
@@ -105,6 +107,20 @@ class OtuTable:
             otus.data.append(otu.data)
         return otus
 
+    @staticmethod
+    def read_columnar(path, samples=None, markers=None):
+        '''Read a columnar OTU table file, optionally only the OTUs from
+        particular samples and markers (see ColumnarOtuTable.each)'''
+        columnar = ColumnarOtuTable(path)
+        otus = OtuTable()
+        otus.fields = columnar.fields
+        otus.data = list(columnar.each_data(samples, markers))
+        return otus
+
+    def write_columnar(self, output_path):
+        '''Write this table in columnar format to the given file path'''
+        ColumnarOtuTable.write(self, self.fields, output_path)
+
     def write_to(self, output_io, fields_to_print=DEFAULT_OUTPUT_FIELDS, print_header=True):
         '''Output as a CSV file to the (open) I/O object
 
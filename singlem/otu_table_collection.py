@@ -3,9 +3,12 @@ import re
 from collections import OrderedDict
 import gzip
 import json
+import zlib
 
 from .archive_otu_table import ArchiveOtuTable
+from .columnar_otu_table import ColumnarOtuTable
 from .otu_table import OtuTable
+from .otu_table_sample_index import OtuTableSampleIndex
 from .taxonomy import TaxonomyUtils
 from .otu_table_entry import OtuTableEntry
 
@@ -33,6 +36,14 @@ class OtuTableCollection:
 
     def add_archive_otu_table(self, input_archive_table_io):
         self.archive_table_objects.append(ArchiveOtuTable.read(input_archive_table_io))
+
+    def add_columnar_otu_table(self, file_path):
+        '''Add a columnar OTU table file, which may be either a regular or an
+        archive OTU table'''
+        if ColumnarOtuTable(file_path).is_archive():
+            self.archive_table_objects.append(ArchiveOtuTable.read_columnar(file_path))
+        else:
+            self.otu_table_objects.append(OtuTable.read_columnar(file_path))
     
     def add_otu_table_object(self, input_otu_table_object):
         self.otu_table_objects.append(input_otu_table_object)
@@ -58,6 +69,14 @@ class OtuTableCollection:
                 return table.fields
         raise Exception("Attempt to get fields from empty TableCollection")
 
+    def archive_header(self):
+        '''Return the header (version, sha256s and fields) shared by the
+        archive OTU tables of the collection, or None if the collection
+        contains regular OTU tables or no tables at all.'''
+        if len(self.otu_table_objects) > 0:
+            return None
+        return _common_archive_header(a._header() for a in self.archive_table_objects)
+
     def sort_otu_tables_by_marker(self):
         '''Sort each OTU table by marker gene.
         '''
@@ -185,8 +204,14 @@ class StreamingOtuTableCollection:
         self._otu_table_file_paths = []
         self._archive_table_file_paths = []
         self._gzip_archive_table_file_paths = []
+        self._columnar_table_file_paths = []
         self._archive_table_objects = []
         self.min_archive_otu_table_version = None
+        # None, or only iterate over OTUs from these samples / markers. Row
+        # groups of columnar OTU tables without them are skipped, and tables
+        # with a sample index are only read where these samples are.
+        self.sample_names = None
+        self.marker_names = None
 
     def add_otu_table(self, input_otu_table_io):
         '''Add a regular style OTU table to the collection.
@@ -214,6 +239,11 @@ class StreamingOtuTableCollection:
     def add_gzip_archive_otu_table_file(self, file_path):
         self._gzip_archive_table_file_paths.append(file_path)
 
+    def add_columnar_otu_table_file(self, file_path):
+        '''Add a columnar OTU table file, which may be either a regular or an
+        archive OTU table'''
+        self._columnar_table_file_paths.append(file_path)
+
     def add_archive_otu_table_object(self, archive_table):
         '''Not technically streaming, but easier to put this here for pipe
         instead of implementing each_sample_otus() for non-streaming OTU
@@ -224,27 +254,99 @@ class StreamingOtuTableCollection:
         '''Iterate over all the OTUs from all the tables. This can only be done once
         since the data is streamed in.
         '''
+        sample_names = None if self.sample_names is None else set(self.sample_names)
+        marker_names = None if self.marker_names is None else set(self.marker_names)
+        for otu in self._each_otu(sample_names, marker_names):
+            if (sample_names is None or otu.sample_name in sample_names) and \
+                (marker_names is None or otu.marker in marker_names):
+                yield otu
+
+    def archive_header(self):
+        '''Return the header (version, sha256s and fields) shared by the
+        archive OTU tables of the collection, or None if the collection
+        contains regular OTU tables or no tables at all. Only the headers of
+        the tables are read, so the OTUs can still be streamed afterwards.'''
+        if len(self._otu_table_io_objects) > 0 or len(self._otu_table_file_paths) > 0:
+            return None
+        if len(self._archive_table_io_objects) > 0:
+            raise Exception("Cannot read archive OTU table headers from streams before iterating over them")
+
+        def each_header():
+            for file_path in self._archive_table_file_paths:
+                with open(file_path) as f:
+                    yield ArchiveOtuTable.read_streaming(f)._header()
+            for file_path in self._gzip_archive_table_file_paths:
+                with gzip.open(file_path) as f:
+                    yield ArchiveOtuTable.read_streaming(f)._header()
+            for file_path in self._columnar_table_file_paths:
+                yield ColumnarOtuTable(file_path).archive_header
+            for archive_table in self._archive_table_objects:
+                yield archive_table._header()
+        return _common_archive_header(each_header())
+
+    def _sample_index(self, file_path, sample_names, table_format):
+        '''Return the sample index of the table, or None if it has none or it
+        is not needed.'''
+        if sample_names is None:
+            return None
+        index = OtuTableSampleIndex.acquire(file_path)
+        if index is not None and index.table_format != table_format:
+            raise Exception("Sample index of {} is for a {}, not a {}".format(file_path, index.table_format, table_format))
+        return index
+
+    def _each_otu(self, sample_names, marker_names):
         for io in self._archive_table_io_objects:
-            for otu in ArchiveOtuTable.read(io, min_version=self.min_archive_otu_table_version):
+            for otu in ArchiveOtuTable.read_streaming(io, min_version=self.min_archive_otu_table_version):
                 yield otu
         for io in self._otu_table_io_objects:
             for otu in OtuTable.each(io):
                 yield otu
         for file_path in self._archive_table_file_paths:
-            with open(file_path) as f:
-                for otu in ArchiveOtuTable.read(f, min_version=self.min_archive_otu_table_version):
+            index = self._sample_index(file_path, sample_names, OtuTableSampleIndex.ARCHIVE_OTU_TABLE_FORMAT)
+            if index is not None:
+                for otu in index.each(file_path, sample_names, min_archive_version=self.min_archive_otu_table_version):
                     yield otu
+            else:
+                with open(file_path) as f:
+                    for otu in ArchiveOtuTable.read_streaming(f, min_version=self.min_archive_otu_table_version):
+                        yield otu
         for file_path in self._otu_table_file_paths:
-            with open(file_path) as f:
-                for otu in OtuTable.each(f):
+            index = self._sample_index(file_path, sample_names, OtuTableSampleIndex.OTU_TABLE_FORMAT)
+            if index is not None:
+                for otu in index.each(file_path, sample_names):
                     yield otu
+            else:
+                with open(file_path) as f:
+                    for otu in OtuTable.each(f):
+                        yield otu
         for file_path in self._gzip_archive_table_file_paths:
-            with gzip.open(file_path) as f:
-                try:
-                    for otu in ArchiveOtuTable.read(f, min_version=self.min_archive_otu_table_version):
+            index = self._sample_index(file_path, sample_names, OtuTableSampleIndex.ARCHIVE_OTU_TABLE_FORMAT)
+            # Truncated or corrupt gzip files are skipped entirely. This is
+            # checked by decompressing the whole file before streaming it,
+            # which is much quicker than parsing the JSON, and keeps none of
+            # it in memory. Indexed tables are only read in part, so are not
+            # checked.
+            if index is None and not _gzip_file_is_intact(file_path):
+                logging.error(f"{file_path} is truncated or corrupt, skipping this one")
+                continue
+            try:
+                if index is not None:
+                    for otu in index.each(file_path, sample_names, min_archive_version=self.min_archive_otu_table_version):
                         yield otu
-                except json.decoder.JSONDecodeError:
-                    logging.error(f"JSON parsing error in {file_path}, skipping this one")
+                else:
+                    with gzip.open(file_path) as f:
+                        for otu in ArchiveOtuTable.read_streaming(f, min_version=self.min_archive_otu_table_version):
+                            yield otu
+            except (json.decoder.JSONDecodeError, EOFError):
+                # Since the table is streamed, OTUs before the error will
+                # already have been yielded.
+                logging.error(f"JSON parsing error in {file_path}, skipping the remainder of this one")
+        for file_path in self._columnar_table_file_paths:
+            for otu in ColumnarOtuTable(file_path).each(
+                    samples=sample_names,
+                    markers=marker_names,
+                    min_archive_version=self.min_archive_otu_table_version):
+                yield otu
         for archive_table in self._archive_table_objects:
             for otu in archive_table:
                 yield otu
@@ -266,3 +368,34 @@ class StreamingOtuTableCollection:
             current_otus.data.append(otu.data)
         if current_sample is not None:
             yield current_sample, current_otus
+
+def _gzip_file_is_intact(file_path):
+    '''Return True if the gzip file can be decompressed to its end without
+    error, discarding the decompressed data.'''
+    try:
+        with gzip.open(file_path) as f:
+            while f.read(1 << 20):
+                pass
+    except (EOFError, gzip.BadGzipFile, zlib.error):
+        return False
+    return True
+
+def _common_archive_header(headers):
+    '''Return the archive OTU table header shared by all of the given headers,
+    or None if there are none or any of them is None (i.e. from a table which
+    is not an archive). Raise an Exception if they differ.'''
+    common = None
+    for header in headers:
+        if header is None:
+            return None
+        header = {
+            'version': header['version'],
+            'alignment_hmm_sha256s': header['alignment_hmm_sha256s'],
+            'singlem_package_sha256s': header['singlem_package_sha256s'],
+            'fields': header['fields'],
+        }
+        if common is None:
+            common = header
+        elif header != common:
+            raise Exception("The input archive OTU tables differ in their version, fields or SingleM packages, so they cannot be combined into one archive OTU table")
+    return common
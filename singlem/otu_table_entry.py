@@ -1,17 +1,48 @@
+import functools
+import sys
+
 from .taxonomy import TaxonomyUtils
 
+@functools.lru_cache(maxsize=65536)
+def _split_taxonomy(taxonomy):
+    '''TaxonomyUtils.split_taxonomy as a tuple, cached since OTU tables contain
+    far fewer distinct taxonomy strings than OTUs.'''
+    tax = TaxonomyUtils.split_taxonomy(taxonomy)
+    return None if tax is None else tuple(tax)
+
 class OtuTableEntry:
-    marker = None
-    sample_name = None
-    sequence = None
-    count = None
-    taxonomy = None
-    coverage = None
-    data = None
-    fields = None
+    # Tables can hold millions of entries, so avoid a per-instance __dict__
+    __slots__ = ('marker', 'sample_name', 'sequence', 'count', 'taxonomy', 'coverage', 'data', 'fields')
+
+    def __init__(self):
+        self.marker = None
+        self.sample_name = None
+        self.sequence = None
+        self.count = None
+        self.taxonomy = None
+        self.coverage = None
+        self.data = None
+        self.fields = None
+
+    # Marker, sample and taxonomy strings are heavily repeated across the OTUs
+    # of a table, so the table readers share a single copy of each.
+    @staticmethod
+    def intern_data(data):
+        '''Intern the marker, sample and taxonomy strings of a row of OTU
+        table data, in place.'''
+        data[0] = sys.intern(data[0])
+        data[1] = sys.intern(data[1])
+        if data[5] is not None:
+            data[5] = sys.intern(data[5])
+
+    @staticmethod
+    def intern_string(s):
+        '''Intern a marker, sample or taxonomy string, which may be None.'''
+        return None if s is None else sys.intern(s)
 
     def taxonomy_array(self):
-        return TaxonomyUtils.split_taxonomy(self.taxonomy)
+        tax = _split_taxonomy(self.taxonomy)
+        return None if tax is None else list(tax)
 
     def within_taxonomy(self, target_taxonomy):
         '''Return true iff the OTU has been assigned within this taxonomy,
@@ -22,7 +53,7 @@ class OtuTableEntry:
         taxonomy: list of str
             each taxonomy level
         '''
-        return (self.taxonomy_array()[:len(target_taxonomy)] == target_taxonomy)
+        return (list(_split_taxonomy(self.taxonomy)[:len(target_taxonomy)]) == target_taxonomy)
 
     def add_found_data(self, found_in):
         if 'found_in' not in self.fields:
@@ -0,0 +1,215 @@
+import bisect
+import codecs
+import gzip
+import io
+import itertools
+import json
+import logging
+import os
+
+from Bio import bgzf
+
+from .archive_otu_table import ArchiveOtuTable, _JsonObjectStreamParser
+from .otu_table import OtuTable
+
+
+class OtuTableSampleIndex:
+    '''A sidecar index of an OTU table or archive OTU table file, recording
+    where the OTUs of each sample start in the file, so that the OTUs of
+    particular samples can be read without parsing the rest of the table. The
+    OTUs of each sample must be contiguous in the table, as they are in tables
+    generated by pipe.
+
+    Gzip-compressed tables can only be indexed if they are BGZF-compressed
+    (e.g. with bgzip from htslib), since only then can they be seeked into.
+    Offsets into these are stored as BGZF virtual offsets. BGZF files are
+    also valid gzip files, so they can be read in full as usual.
+
+    The index is stored as JSON in a file at the path of the table with SUFFIX
+    appended.
+    '''
+
+    SUFFIX = '.sample_index'
+    version = 1
+
+    OTU_TABLE_FORMAT = 'otu_table'
+    ARCHIVE_OTU_TABLE_FORMAT = 'archive_otu_table'
+
+    def __init__(self, table_format, is_bgzf, table_size, table_mtime, samples, archive_header=None):
+        self.table_format = table_format
+        self.is_bgzf = is_bgzf
+        # Size and modification time of the indexed table file, used to detect
+        # stale indices
+        self.table_size = table_size
+        self.table_mtime = table_mtime
+        # sample name => (offset, number of OTUs)
+        self.samples = samples
+        self.archive_header = archive_header
+
+    @staticmethod
+    def index_path(table_path):
+        return table_path + OtuTableSampleIndex.SUFFIX
+
+    @staticmethod
+    def acquire(table_path):
+        '''Return the index of the table, or None if there is no index or it
+        is out of date.'''
+        path = OtuTableSampleIndex.index_path(table_path)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            j = json.load(f)
+        if j['version'] != OtuTableSampleIndex.version:
+            raise Exception("Unexpected sample index version {} found in {}".format(j['version'], path))
+        stat = os.stat(table_path)
+        if j['table_size'] != stat.st_size or j.get('table_mtime') != stat.st_mtime:
+            logging.warning("Ignoring sample index {} since it does not match the size or modification time of {}".format(path, table_path))
+            return None
+        return OtuTableSampleIndex(
+            j['table_format'], j['bgzf'], j['table_size'], j['table_mtime'],
+            dict((s, (offset, num_otus)) for s, offset, num_otus in j['samples']),
+            j['archive_header'])
+
+    def write(self, table_path):
+        with open(OtuTableSampleIndex.index_path(table_path), 'w') as f:
+            json.dump({
+                'version': self.version,
+                'table_format': self.table_format,
+                'bgzf': self.is_bgzf,
+                'table_size': self.table_size,
+                'table_mtime': self.table_mtime,
+                'archive_header': self.archive_header,
+                'samples': [[s, offset, num_otus] for s, (offset, num_otus) in self.samples.items()],
+            }, f)
+
+    @staticmethod
+    def generate(table_path, table_format):
+        '''Read through a table, and write and return its index.
+
+        Parameters
+        ----------
+        table_path: str
+            path to the OTU table, which may be BGZF-compressed
+        table_format: str
+            OTU_TABLE_FORMAT or ARCHIVE_OTU_TABLE_FORMAT
+        '''
+        with open(table_path, 'rb') as f:
+            is_bgzf = f.read(2) == b'\x1f\x8b'
+        if is_bgzf:
+            try:
+                with open(table_path, 'rb') as f:
+                    blocks = [(start, data_start) for start, _, data_start, _ in bgzf.BgzfBlocks(f)]
+            except ValueError:
+                raise Exception("{} is gzip-compressed, but not BGZF-compressed, so it cannot be indexed. It can be recompressed with 'bgzip'.".format(table_path))
+            f = gzip.open(table_path)
+        else:
+            f = open(table_path, 'rb')
+
+        with f:
+            archive_header = None
+            if table_format == OtuTableSampleIndex.OTU_TABLE_FORMAT:
+                offsets = OtuTableSampleIndex._otu_table_sample_offsets(f)
+            elif table_format == OtuTableSampleIndex.ARCHIVE_OTU_TABLE_FORMAT:
+                archive_header, offsets = OtuTableSampleIndex._archive_otu_table_sample_offsets(f)
+            else:
+                raise Exception("Unknown OTU table format {}".format(table_format))
+
+            samples = {}
+            current_sample = None
+            for sample, offset in offsets:
+                if sample != current_sample:
+                    if sample in samples:
+                        raise Exception("The OTUs of sample {} are not contiguous in {}, so it cannot be indexed".format(sample, table_path))
+                    samples[sample] = [offset, 0]
+                    current_sample = sample
+                samples[sample][1] += 1
+
+        if is_bgzf:
+            # Convert offsets into the uncompressed data to virtual offsets
+            data_starts = [data_start for _, data_start in blocks]
+            for sample_offset in samples.values():
+                start, data_start = blocks[bisect.bisect_right(data_starts, sample_offset[0])-1]
+                sample_offset[0] = bgzf.make_virtual_offset(start, sample_offset[0] - data_start)
+
+        stat = os.stat(table_path)
+        index = OtuTableSampleIndex(
+            table_format, is_bgzf, stat.st_size, stat.st_mtime,
+            dict((s, tuple(o)) for s, o in samples.items()),
+            archive_header)
+        index.write(table_path)
+        return index
+
+    @staticmethod
+    def _otu_table_sample_offsets(binary_io):
+        '''Yield (sample, byte offset) for each OTU in an OTU table'''
+        offset = len(binary_io.readline())
+        for line in binary_io:
+            yield line.split(b'\t', 2)[1].decode(), offset
+            offset += len(line)
+
+    @staticmethod
+    def _archive_otu_table_sample_offsets(binary_io):
+        '''Return the header of an archive OTU table, and a list of (sample,
+        byte offset) for each OTU'''
+        # Decode so that each character corresponds to one byte, with
+        # non-ASCII bytes becoming lone surrogates which are re-encoded below
+        parser = _JsonObjectStreamParser(io.TextIOWrapper(
+            binary_io, encoding='ascii', errors='surrogateescape', newline=''))
+        header = {}
+        offsets = []
+        for key in parser.each_key():
+            if key == 'otus':
+                for offset, d in parser.each_array_element(with_offsets=True):
+                    sample = d[ArchiveOtuTable.SAMPLE_ID_FIELD_INDEX].encode('utf-8', 'surrogateescape').decode('utf-8')
+                    offsets.append((sample, offset))
+            else:
+                header[key] = parser.decode_value()
+        for key in ('version', 'alignment_hmm_sha256s', 'singlem_package_sha256s', 'fields'):
+            if key not in header:
+                raise Exception("Archive OTU table header is missing {}".format(key))
+        return header, offsets
+
+    def each(self, table_path, sample_names, min_archive_version=None):
+        '''Yield an OtuTableEntry (or ArchiveOtuTableEntry) for each OTU of
+        the given samples, in the order in which they appear in the table.
+        Samples not in the table are ignored.'''
+        wanted = sorted(self.samples[s] for s in set(sample_names) if s in self.samples)
+
+        if self.table_format == self.ARCHIVE_OTU_TABLE_FORMAT:
+            archive = ArchiveOtuTable()
+            archive._set_header(self.archive_header, min_archive_version)
+        elif min_archive_version is not None:
+            raise Exception("{} is not an archive OTU table".format(table_path))
+
+        if self.is_bgzf:
+            f = bgzf.BgzfReader(table_path, 'rb')
+        else:
+            f = open(table_path, 'rb')
+        with f:
+            if self.table_format == self.OTU_TABLE_FORMAT:
+                header = f.readline().decode()
+                for offset, num_otus in wanted:
+                    f.seek(offset)
+                    lines = (line.decode() for line in itertools.islice(f, num_otus))
+                    for otu in OtuTable.each(itertools.chain([header], lines)):
+                        yield otu
+            else:
+                for offset, num_otus in wanted:
+                    f.seek(offset)
+                    parser = _JsonObjectStreamParser(_DecodingReader(f), expect_object=False)
+                    for d in itertools.islice(parser.each_remaining_array_element(), num_otus):
+                        yield archive._entry(d)
+
+
+class _DecodingReader:
+    '''Reads text from a binary stream such as a BgzfReader, which cannot be
+    wrapped in an io.TextIOWrapper. Unlike a TextIOWrapper, the underlying
+    stream is not closed when this object is garbage collected.'''
+
+    def __init__(self, binary_io):
+        self._io = binary_io
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def read(self, size=-1):
+        data = self._io.read(size)
+        return self._decoder.decode(data, final=(size != 0 and len(data) == 0))
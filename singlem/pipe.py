@@ -10,6 +10,8 @@ import re
 import csv
 import subprocess
 import time
+from collections import Counter
+from multiprocessing.pool import ThreadPool
 
 from .metapackage import Metapackage
 from .singlem import OrfMUtils, FastaNameToSampleName
@@ -242,13 +244,19 @@ class SearchPipe:
         transcript_tempfile_name_to_desired_name = {}
         if genome_fasta_files:
             logging.info("Calling rough transcriptome of genome FASTA files")
+            orfm_commands = []
             for fasta in genome_fasta_files:
                 # Make a tempfile with delete=False because it is in a tmpdir already, and useful for debug to keep around with --working-directory
                 transcripts_path = tempfile.NamedTemporaryFile(prefix='singlem-genome-{}'.format(os.path.basename(fasta)), suffix='.fasta', delete=False)
-                extern.run('orfm -m {} -t {} {} >/dev/null'.format(self._min_orf_length, transcripts_path.name, fasta))
+                # Close immediately since orfm writes to it by name, to avoid
+                # the "Too many open files" error when there are many genomes.
+                transcripts_path.close()
+                orfm_commands.append('orfm -m {} -t {} {} >/dev/null'.format(self._min_orf_length, transcripts_path.name, fasta))
                 transcript_tempfiles.append(transcripts_path)
                 forward_read_files.append(transcripts_path.name)
                 transcript_tempfile_name_to_desired_name[FastaNameToSampleName().fasta_to_name(transcripts_path.name)] = FastaNameToSampleName().fasta_to_name(fasta)
+            logging.debug("Running {} orfm commands using {} threads".format(len(orfm_commands), self._num_threads))
+            extern.run_many(orfm_commands, num_threads=self._num_threads)
 
         def return_cleanly():
             for tf in transcript_tempfiles:
@@ -918,15 +926,17 @@ class SearchPipe:
 
     def _median_taxonomy(self, taxonomies):
         levels_to_counts = []
-        for tax_string in taxonomies:
+        # Reads of an OTU are usually assigned few distinct taxonomies, so
+        # split each distinct taxonomy only once.
+        for tax_string, tax_count in Counter(taxonomies).items():
             for i, tax in enumerate(tax_string.split(';')):
                 tax = tax.strip()
                 if i >= len(levels_to_counts):
                     levels_to_counts.append({})
                 try:
-                    levels_to_counts[i][tax] += 1
+                    levels_to_counts[i][tax] += tax_count
                 except KeyError:
-                    levels_to_counts[i][tax] = 1
+                    levels_to_counts[i][tax] = tax_count
 
         median_tax = []
         for level_counts in levels_to_counts:
@@ -1180,11 +1190,19 @@ class SearchPipe:
 
 
 
-        # Run each one at a time serially so that the number of threads is
-        # respected, to save RAM as one DB needs to be loaded at once, and so
-        # fewer open files are needed, so that the open file count limit is
-        # eased.
+        # By default run each one at a time serially so that the number of
+        # threads is respected, to save RAM as one DB needs to be loaded at
+        # once, and so fewer open files are needed, so that the open file count
+        # limit is eased. With --assignment-threads > 1, DIAMOND jobs across
+        # packages and samples are run in parallel, with the threads divided
+        # between them so that the total number of threads is still respected.
+        if assignment_threads > 1:
+            threads_per_job = max(1, self._num_threads // assignment_threads)
+        else:
+            threads_per_job = self._num_threads
         diamond_results = []
+        diamond_jobs = []
+        diamond_packages = []
         for singlem_package, readsets in extracted_reads.each_package_wise():
             tmp_files = []
             for readset in readsets:
@@ -1375,28 +1393,23 @@ class SearchPipe:
                         "--evalue 0.01 " \
                         "--threads %i " \
                         "%s " % (
-                            self._num_threads,
+                            threads_per_job,
                             diamond_taxonomy_assignment_performance_parameters)
-                    # Run serially for the moment, coz lazy
+                    # Queue up one DIAMOND job per sample (and read
+                    # direction). These are run together once all packages
+                    # have been seen, so that different packages and samples
+                    # can be run in parallel.
+                    sample_names = []
                     if extracted_reads.analysing_pairs:
-                        forward_results = []
-                        reverse_results = []
-                        sample_names = []
                         for (sample_name, t0, t1) in tmp_files:
                             sample_names.append(sample_name)
-                            logging.debug("Assigning taxonomy to forward reads file {} ..".format(t0.name))
-                            forward_results.append(run_diamond_to_hash(cmd_stub, t0.name, singlem_package))
-                            logging.debug("Assigning taxonomy to reverse reads file {} ..".format(t1.name))
-                            reverse_results.append(run_diamond_to_hash(cmd_stub, t1.name, singlem_package))
-                        diamond_results.append([singlem_package,sample_names,[forward_results,reverse_results]])
+                            diamond_jobs.append((run_diamond_to_hash, cmd_stub, t0.name, singlem_package))
+                            diamond_jobs.append((run_diamond_to_hash, cmd_stub, t1.name, singlem_package))
                     else:
-                        single_results = []
-                        sample_names = []
                         for (sample_name, t) in tmp_files:
                             sample_names.append(sample_name)
-                            logging.debug("Assigning taxonomy to single-ended reads file {} ..".format(t.name))
-                            single_results.append(run_diamond_to_hash(cmd_stub, t.name, singlem_package))
-                        diamond_results.append([singlem_package,sample_names,single_results])
+                            diamond_jobs.append((run_diamond_to_hash, cmd_stub, t.name, singlem_package))
+                    diamond_packages.append([singlem_package, sample_names])
 
                 elif assignment_method == PPLACER_ASSIGNMENT_METHOD:
                     cmd = "%s "\
@@ -1405,7 +1418,7 @@ class SearchPipe:
                         "--max_samples_for_krona 0 "\
                         "--assignment_method %s " % (
                             self._graftm_command_prefix(singlem_package.is_protein_package()),
-                            self._num_threads,
+                            threads_per_job,
                             singlem_package.graftm_package_path(),
                             assignment_method)
                     if extracted_reads.analysing_pairs:
@@ -1428,6 +1441,9 @@ class SearchPipe:
                 else:
                     raise Exception("Programming error")
 
+        if len(diamond_jobs) > 0:
+            diamond_results = self._run_diamond_assignment_jobs(
+                diamond_jobs, diamond_packages, assignment_threads, extracted_reads.analysing_pairs)
         extern.run_many(commands, num_threads=assignment_threads)
         logging.info("Finished running taxonomic assignment")
         if assignment_method == DIAMOND_ASSIGNMENT_METHOD:
@@ -1448,6 +1464,56 @@ class SearchPipe:
         else:
             raise Exception("Programming error")
 
+    def _run_diamond_assignment_jobs(self, diamond_jobs, diamond_packages, assignment_threads, analysing_pairs):
+        '''Run DIAMOND taxonomic assignment jobs, up to assignment_threads at
+        a time. Each job is a DIAMOND run on a single query file, so jobs are
+        independent and can be run in any order. Results are gathered in
+        submission order, so the output is the same as when run serially.
+
+        Parameters
+        ----------
+        diamond_jobs: list of (run_function, cmd_stub, query_path, singlem_package)
+        diamond_packages: list of [singlem_package, sample_names], in the order
+        the jobs were queued. When analysing pairs, each sample has a forward
+        then a reverse job.
+
+        Returns
+        -------
+        list of [singlem_package, sample_names, results] as expected by
+        DiamondTaxonomicAssignmentResult.
+        '''
+        def run_job(job):
+            (run_function, cmd_stub, query_path, singlem_package) = job
+            logging.debug("Assigning taxonomy to reads file {} ..".format(query_path))
+            return run_function(cmd_stub, query_path, singlem_package)
+
+        logging.debug("Running {} DIAMOND taxonomic assignment job(s) using {} parallel process(es)".format(
+            len(diamond_jobs), assignment_threads))
+        if assignment_threads > 1:
+            # Threads rather than processes are sufficient here because the
+            # work is done in the DIAMOND subprocesses.
+            with ThreadPool(min(assignment_threads, len(diamond_jobs))) as pool:
+                job_results = pool.map(run_job, diamond_jobs)
+        else:
+            job_results = list([run_job(job) for job in diamond_jobs])
+
+        diamond_results = []
+        job_index = 0
+        for (singlem_package, sample_names) in diamond_packages:
+            if analysing_pairs:
+                forward_results = []
+                reverse_results = []
+                for _ in sample_names:
+                    forward_results.append(job_results[job_index])
+                    reverse_results.append(job_results[job_index+1])
+                    job_index += 2
+                diamond_results.append([singlem_package, sample_names, [forward_results, reverse_results]])
+            else:
+                single_results = job_results[job_index:job_index+len(sample_names)]
+                job_index += len(sample_names)
+                diamond_results.append([singlem_package, sample_names, single_results])
+        return diamond_results
+
     def _diamond_assign_taxonomy_paired_output_directory(
             self, graftm_align_directory_base, singlem_package, is_forward):
         return "{}/{}_{}".format(
@@ -1737,16 +1803,28 @@ class DiamondTaxonomicAssignmentResult:
         logging.debug("Reading taxonomy hash for {}".format(singlem_package.base_directory()))
         tax_hash = singlem_package.taxonomy_hash()
 
+        # Many reads hit the same reference sequences, so convert each hit ID
+        # to a node of the taxonomy tree only once.
+        tax_id_to_node = {}
         equal_best_hits = self.get_equal_best_hits(singlem_package, sample_name)
         if self._analysing_pairs:
             return [
-                {k:self._lca_string([tax_hash[tax_id] for tax_id in v]) for k,v in equal_best_hits[0].items()},
-                {k:self._lca_string([tax_hash[tax_id] for tax_id in v]) for k,v in equal_best_hits[1].items()}]
+                {k:self._lca_string(tax_hash, tax_id_to_node, v) for k,v in equal_best_hits[0].items()},
+                {k:self._lca_string(tax_hash, tax_id_to_node, v) for k,v in equal_best_hits[1].items()}]
         else:
-            return {k:self._lca_string([tax_hash[tax_id] for tax_id in v]) for k,v in equal_best_hits.items()}
+            return {k:self._lca_string(tax_hash, tax_id_to_node, v) for k,v in equal_best_hits.items()}
 
-    def _lca_string(self, taxon_list):
-        taxon_list2 = TaxonomyUtils.lca_taxonomy_of_taxon_lists(taxon_list)
+    def _lca_string(self, tax_hash, tax_id_to_node, tax_ids):
+        tree = TaxonomyUtils.taxonomy_tree()
+        nodes = []
+        for tax_id in tax_ids:
+            try:
+                nodes.append(tax_id_to_node[tax_id])
+            except KeyError:
+                node = tree.node(tax_hash[tax_id])
+                tax_id_to_node[tax_id] = node
+                nodes.append(node)
+        taxon_list2 = tree.taxonomy_string(tree.lca_of_nodes(nodes))
         if len(taxon_list2) == 0:
             return 'Root'
         else:
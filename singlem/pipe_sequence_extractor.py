@@ -14,6 +14,7 @@ from .metagenome_otu_finder import MetagenomeOtuFinder
 from . import sequence_extractor as singlem_sequence_extractor
 from .streaming_hmm_search_result import StreamingHMMSearchResult
 from .singlem import OrfMUtils
+from .run_streaming_command import run_streaming_command
 
 # Must be defined outside a class so that it is pickle-able, so multiprocessing can work
 def _run_individual_extraction(sample_name, singlem_package, sequence_files_for_alignment, separate_search_result, include_inserts, known_taxonomy):
@@ -159,8 +160,10 @@ def _filter_sequences_through_hmmsearch(
     prefilter_result,
     min_orf_length):
     """Return a generator of Sequence objects that match one or more of the
-    search HMMs in the graftm_package. To save RAM, the full set of sequences is
-    never read in.
+    search HMMs in the graftm_package. The prefilter FASTA is read only once.
+    Sequences with a best hit to this package are kept in memory while they
+    are written as hmmsearch input, so the passing sequences can be yielded
+    without reading the FASTA again.
     """
     
     graftm_package = singlem_package.graftm_package()
@@ -173,10 +176,11 @@ def _filter_sequences_through_hmmsearch(
         tempfile.NamedTemporaryFile(prefix='singlem_hmmsearch') for _ in graftm_package.search_hmm_paths()
     ])
     with tempfile.NamedTemporaryFile(prefix='singlem_hmmsearch_input') as input_tf:
-        count, example = _generate_package_specific_fasta_input(target_sequence_ids, prefilter_result, input_tf)
-        logging.debug("Running {} sequences through HMMSEARCH e.g. {}".format(count, example))
+        candidate_sequences = _generate_package_specific_fasta_input(target_sequence_ids, prefilter_result, input_tf)
+        logging.debug("Running {} sequences through HMMSEARCH e.g. {}".format(
+            len(candidate_sequences), candidate_sequences[0][0] if len(candidate_sequences) > 0 else None))
         input_tf.flush()
-        if count == 0:
+        if len(candidate_sequences) == 0:
             return
 
         # With some hoop jumping it should be possible to stream this, but eh
@@ -192,7 +196,7 @@ def _filter_sequences_through_hmmsearch(
         for orfm_seq_id in StreamingHMMSearchResult.yield_from_hmmsearch_table(output_tempfile.name):
             seqs_to_extract.add(OrfMUtils().un_orfm_name(orfm_seq_id))
 
-    for (qseqid, seq) in _yield_target_sequences(target_sequence_ids, prefilter_result):
+    for (qseqid, seq) in candidate_sequences:
         if qseqid in seqs_to_extract:
             yield Sequence(qseqid, seq)
 
@@ -206,19 +210,47 @@ def _generate_package_specific_fasta_input(
     target_sequence_ids, prefilter_result, output_io):
     """Write sequences that are in the prefilter result that match the singlem
     package to output_io.
+
+    Returns
+    -------
+    list of (name, sequence) tuples, one for each sequence written.
     """
     
-    count = 0
-    example = None
+    candidate_sequences = []
 
     for (qseqid, seq) in _yield_target_sequences(target_sequence_ids, prefilter_result):
-        count += 1
-        if example is not None:
-            example = qseqid
+        candidate_sequences.append((qseqid, seq))
         output_io.write(">{}\n{}\n".format(qseqid, seq).encode())
 
-    return count, example
+    return candidate_sequences
+
 
+def _orfm_hmmalign_sequences(sequences, min_orf_length, hmm_path):
+    '''Run orfm | hmmalign on a list of nucleotide Sequence objects, parsing
+    the Stockholm output as it is streamed from hmmalign rather than
+    collecting it all first.
+
+    Returns
+    -------
+    list of AlignedProteinSequence objects
+    '''
+    with tempfile.NamedTemporaryFile(prefix='singlem_hmmalign_input', mode='w') as input_tf:
+        # A dummy sequence is included so that hmmalign does not croak when
+        # orfm finds no ORFs.
+        input_tf.write(">dummy\n{}\n".format('A'*min_orf_length))
+        for s in sequences:
+            input_tf.write(">{}\n{}\n".format(s.name, s.seq))
+        input_tf.flush()
+
+        cmd = "orfm -m {} {} | hmmalign '{}' /dev/stdin".format(
+            min_orf_length, input_tf.name, hmm_path)
+        logging.debug("Running command: {}, with {} sequences as input".format(cmd, len(sequences)))
+        protein_alignment = []
+        with run_streaming_command(cmd) as stockholm:
+            for record in SeqIO.parse(stockholm, 'stockholm'):
+                protein_alignment.append(AlignedProteinSequence(record.name, str(record.seq)))
+        logging.debug("Finished command: {}".format(cmd))
+    return protein_alignment
 
 def _extract_reads_by_diamond_for_package_and_sample(prefilter_result, spkg,
     sample_name, min_orf_length, include_inserts):
@@ -247,22 +279,19 @@ def _extract_reads_by_diamond_for_package_and_sample(prefilter_result, spkg,
     # time.
     chunk_size = 5000 #=> Appoximately 100MB of RAM needed
     window_seqs = []
+    hmm_path = spkg.graftm_package().alignment_hmm_path()
+
+    # Build the name to nucleotide sequence lookup once, rather than once per
+    # chunk, since that would make extraction quadratic in the number of
+    # sequences.
+    nucleotide_sequence_hash = {}
+    for s in sequences:
+        nucleotide_sequence_hash[s.name] = s.seq
+
     # For each chunk
     for i in range(0, len(sequences), chunk_size):
         chunk_sequences = sequences[i:i + chunk_size]
-        cmd = "orfm -m {} | hmmalign '{}' /dev/stdin".format(
-            min_orf_length, spkg.graftm_package().alignment_hmm_path()
-        )
-        stdin = '\n'.join(
-            [">{}\n{}".format(s.name, s.seq) for s in chunk_sequences])
-        logging.debug("Running command: {}, with {} sequences as input".format(cmd, len(chunk_sequences)))
-        output = extern.run(cmd, stdin=">dummy\n{}\n{}".format('A'*min_orf_length,stdin))
-        logging.debug("Finished command: {}".format(cmd))
-
-        # Convert to AlignedProteinSequence
-        protein_alignment = []
-        for record in SeqIO.parse(StringIO(output), 'stockholm'):
-            protein_alignment.append(AlignedProteinSequence(record.name, str(record.seq)))
+        protein_alignment = _orfm_hmmalign_sequences(chunk_sequences, min_orf_length, hmm_path)
 
         if len(protein_alignment) > 0:
             logging.debug("Read in %i aligned sequences from this chunk e.g. %s %s" % (
@@ -273,10 +302,6 @@ def _extract_reads_by_diamond_for_package_and_sample(prefilter_result, spkg,
             logging.debug("No aligned sequences found for this HMM")
 
         # Extract OTU sequences
-        nucleotide_sequence_hash = {}
-        for s in sequences:
-            nucleotide_sequence_hash[s.name] = s.seq
-        logging.debug("First sequence: {} / {}".format(protein_alignment[0].name, protein_alignment[0].seq))
         # Window sequences must be found for each chunk, otherwise the
         # alignments won't line up re insert characters, between chunks.
         window_seqs.extend(MetagenomeOtuFinder().find_windowed_sequences(
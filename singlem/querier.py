@@ -1,3 +1,5 @@
+import os
+import shutil
 import tempfile
 import logging
 import subprocess
@@ -7,7 +9,7 @@ import csv
 import pandas as pd
 import itertools
 import math
-import extern
+from multiprocessing.pool import ThreadPool
 from bird_tool_utils import iterable_chunks
 from sqlalchemy import select
 from sqlalchemy.orm import Session
@@ -21,12 +23,9 @@ from .otu_table_collection import OtuTableCollection
 from .otu_table_entry import OtuTableEntry
 from .otu_table import OtuTable
 from .otu_table_collection import StreamingOtuTableCollection
+from .run_streaming_command import run_streaming_command
 
 class Querier:
-    def __init__(self):
-        self._query_result_from_db_builder_nucleotide = None
-        self._query_result_from_db_builder_protein = None
-
     def query(self, **kwargs):
         db = SequenceDatabase.acquire(kwargs.pop('db'), min_version=5)
         max_divergence = kwargs.pop('max_divergence')
@@ -39,6 +38,7 @@ class Querier:
         max_nearest_neighbours = kwargs.pop('max_nearest_neighbours')
         max_search_nearest_neighbours = kwargs.pop('max_search_nearest_neighbours')
         preload_db = kwargs.pop('preload_db')
+        preload_db_memmap = kwargs.pop('preload_db_memmap', False)
         limit_per_sequence = kwargs.pop('limit_per_sequence')
 
         if len(kwargs) > 0:
@@ -49,7 +49,8 @@ class Querier:
         query_results = self.query_with_queries(
             queries, db, max_divergence, search_method, sequence_type, 
             max_nearest_neighbours=max_nearest_neighbours, max_search_nearest_neighbours=max_search_nearest_neighbours, \
-            preload_db=preload_db, limit_per_sequence=limit_per_sequence)
+            preload_db=preload_db, limit_per_sequence=limit_per_sequence, num_threads=num_threads,
+            preload_db_memmap=preload_db_memmap)
         # Only reason not to stream would be so that the queries are returned in the same order as passed in. eh for now.
         do_stream = True
         if not do_stream:
@@ -63,7 +64,22 @@ class Querier:
         else:
             raise Exception("Programming error")
 
-    def preload_nucleotide_db(self, sdb, marker_id, limit_per_sequence):
+    def preload_nucleotide_db(self, sdb, marker_id, limit_per_sequence, memmap=False):
+        if memmap:
+            loaded = MemmapPreloadedDB.acquire(
+                _preloaded_db_cache_directory(sdb, SequenceDatabase.NUCLEOTIDE_TYPE, marker_id),
+                lambda: self._preload_nucleotide_dataframe(sdb, marker_id),
+                'nucleotides_marker_wise_id')
+        if not memmap or loaded is None:
+            loaded = PreloadedDB.from_dataframe(
+                self._preload_nucleotide_dataframe(sdb, marker_id),
+                'nucleotides_marker_wise_id')
+
+        if limit_per_sequence: loaded.limit_per_sequence(limit_per_sequence)
+
+        return loaded
+
+    def _preload_nucleotide_dataframe(self, sdb, marker_id):
         with Session(sdb.sqlalchemy_connection) as conn:
             marker_name = conn.execute(select(Marker.marker).where(Marker.id==marker_id)).fetchone()[0]
             logging.info("Caching nucleotide data for marker {}..".format(marker_name))
@@ -78,26 +94,26 @@ class Querier:
                     .where(Otu.taxonomy_id == Taxonomy.id) \
                     .where(Otu.marker_id == marker_id)
             result = conn.execute(query)
-            current_preloaded_db = pd.DataFrame(result.fetchall(), 
+            return pd.DataFrame(result.fetchall(), 
                 columns = ('nucleotides_marker_wise_id','nucleotide_sequence', \
                     'sample_name', 'num_hits', 'coverage', 'taxonomy'))
 
-        loaded = PreloadedDB()
-        loaded.indices = pd.Series(
-            current_preloaded_db.groupby('nucleotides_marker_wise_id').indices)
-        loaded.sample_name = current_preloaded_db.xs('sample_name',axis=1).to_numpy()
-        loaded.count = current_preloaded_db.xs('num_hits',axis=1).to_numpy()
-        loaded.sequence = current_preloaded_db.xs('nucleotide_sequence',axis=1).to_numpy()
-        loaded.coverage = current_preloaded_db.xs('coverage',axis=1).to_numpy()
-        loaded.taxonomy = current_preloaded_db.xs('taxonomy',axis=1).to_numpy()
-
-        del current_preloaded_db # Maybe not necessary, but just in case
+    def preload_protein_db(self, sdb, marker_id, limit_per_sequence, memmap=False):
+        if memmap:
+            loaded = MemmapPreloadedDB.acquire(
+                _preloaded_db_cache_directory(sdb, SequenceDatabase.PROTEIN_TYPE, marker_id),
+                lambda: self._preload_protein_dataframe(sdb, marker_id),
+                'proteins_marker_wise_id')
+        if not memmap or loaded is None:
+            loaded = PreloadedDB.from_dataframe(
+                self._preload_protein_dataframe(sdb, marker_id),
+                'proteins_marker_wise_id')
 
         if limit_per_sequence: loaded.limit_per_sequence(limit_per_sequence)
 
         return loaded
 
-    def preload_protein_db(self, sdb, marker_id, limit_per_sequence):
+    def _preload_protein_dataframe(self, sdb, marker_id):
         with Session(sdb.sqlalchemy_connection) as conn:
             marker_name = conn.execute(select(Marker.marker).where(Marker.id==marker_id)).fetchone()[0]
             logging.info("Caching protein data for marker {}..".format(marker_name))
@@ -115,28 +131,10 @@ class Querier:
                     .where(NucleotidesProteins.nucleotide_id == Otu.sequence_id) \
                     .where(NucleotidesProteins.protein_id == ProteinSequence.id)
             result = conn.execute(query)
-            current_preloaded_db = pd.DataFrame(result.fetchall(), 
+            return pd.DataFrame(result.fetchall(), 
                 columns = ('proteins_marker_wise_id','nucleotide_sequence','protein_sequence', \
                 'sample_name', 'num_hits', 'coverage', 'taxonomy'))
 
-        loaded = PreloadedDB()
-        loaded.indices = pd.Series(
-            current_preloaded_db.groupby('proteins_marker_wise_id').indices)
-        loaded.sample_name = current_preloaded_db.xs('sample_name',axis=1).to_numpy()
-        loaded.count = current_preloaded_db.xs('num_hits',axis=1).to_numpy()
-        loaded.sequence = current_preloaded_db.xs('nucleotide_sequence',axis=1).to_numpy()
-        loaded.coverage = current_preloaded_db.xs('coverage',axis=1).to_numpy()
-        loaded.taxonomy = current_preloaded_db.xs('taxonomy',axis=1).to_numpy()
-
-        loaded.protein_sequence = current_preloaded_db.xs('protein_sequence',axis=1).to_numpy()
-
-        del current_preloaded_db # Maybe not necessary, but just in case
-
-        if limit_per_sequence: loaded.limit_per_sequence(limit_per_sequence)
-
-        return loaded
-
-
     def prepare_query_sequences(self, otus, num_threads):
         '''return an iterable of QueryInputSequence objects sorted by marker.'''
 
@@ -167,76 +165,80 @@ class Querier:
         logging.info("Sorted {} OTU queries ..".format(total_otu_count))
         return MarkerSortedQueryInput(sorted_io)
 
-    def query_with_queries(self, queries, sdb, max_divergence, search_method, sequence_type, max_nearest_neighbours, max_search_nearest_neighbours, preload_db, limit_per_sequence):
+    def query_with_queries(self, queries, sdb, max_divergence, search_method, sequence_type, max_nearest_neighbours, max_search_nearest_neighbours, preload_db, limit_per_sequence, num_threads=1, preload_db_memmap=False):
         if max_divergence == 0 and sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
             if limit_per_sequence != None:
                 raise Exception("limit-per-sequence has not been implemented for nucleotide queries with max-divergence 0 yet")
             return self.query_by_sqlite(queries, sdb)
         elif search_method == 'scann-naive':
             return self.query_by_sequence_similarity_with_scann(
-                queries, sdb, max_divergence, sequence_type, max_nearest_neighbours, naive=True, preload_db=preload_db, limit_per_sequence=limit_per_sequence)
+                queries, sdb, max_divergence, sequence_type, max_nearest_neighbours, naive=True, preload_db=preload_db, limit_per_sequence=limit_per_sequence, preload_db_memmap=preload_db_memmap)
         elif search_method == 'annoy':
             if preload_db:
                 raise NotImplementedError("Preloading the database is not supported for the annoy search method")
             return self.query_by_sequence_similarity_with_annoy(
-                queries, sdb, max_divergence, sequence_type, max_nearest_neighbours, max_search_nearest_neighbours=max_search_nearest_neighbours, limit_per_sequence=limit_per_sequence)
+                queries, sdb, max_divergence, sequence_type, max_nearest_neighbours, max_search_nearest_neighbours=max_search_nearest_neighbours, limit_per_sequence=limit_per_sequence, num_threads=num_threads)
         elif search_method == 'nmslib':
             if preload_db:
                 raise NotImplementedError("Preloading the database is not supported for the nmslib search method")
             return self.query_by_sequence_similarity_with_nmslib(
-                queries, sdb, max_divergence, sequence_type, max_nearest_neighbours, max_search_nearest_neighbours=max_search_nearest_neighbours, limit_per_sequence=limit_per_sequence)
+                queries, sdb, max_divergence, sequence_type, max_nearest_neighbours, max_search_nearest_neighbours=max_search_nearest_neighbours, limit_per_sequence=limit_per_sequence, num_threads=num_threads)
         elif search_method == 'scann':
             return self.query_by_sequence_similarity_with_scann(
-                queries, sdb, max_divergence, sequence_type, max_nearest_neighbours, naive=False, preload_db=preload_db, max_search_nearest_neighbours=max_search_nearest_neighbours, limit_per_sequence=limit_per_sequence)
+                queries, sdb, max_divergence, sequence_type, max_nearest_neighbours, naive=False, preload_db=preload_db, max_search_nearest_neighbours=max_search_nearest_neighbours, limit_per_sequence=limit_per_sequence, preload_db_memmap=preload_db_memmap)
         elif search_method == 'smafa-naive':
             return self.query_by_sequence_similarity_with_smafa_naive(
-                queries, sdb, max_divergence, sequence_type, max_nearest_neighbours, preload_db=preload_db, limit_per_sequence=limit_per_sequence)
+                queries, sdb, max_divergence, sequence_type, max_nearest_neighbours, preload_db=preload_db, limit_per_sequence=limit_per_sequence, preload_db_memmap=preload_db_memmap)
         else:
             raise Exception("Unknown search method {}".format(search_method))
 
-    def query_by_sequence_similarity_with_nmslib(self, queries, sdb, max_divergence, sequence_type, max_nearest_neighbours, max_search_nearest_neighbours=None, limit_per_sequence=None):
+    def query_by_sequence_similarity_with_nmslib(self, queries, sdb, max_divergence, sequence_type, max_nearest_neighbours, max_search_nearest_neighbours=None, limit_per_sequence=None, num_threads=1):
         logging.info("Searching with nmslib by {} sequence ..".format(sequence_type))
 
         if max_search_nearest_neighbours is None:
             max_search_nearest_neighbours = max_nearest_neighbours
 
-        last_marker = None
-        index = None
-        for q in queries:
-            if q.marker != last_marker:
-                del index
-                last_marker = q.marker
-                index = sdb.get_sequence_index(last_marker, 'nmslib', sequence_type)
-                if index is None:
-                    raise Exception("The marker '{}' does not appear to be in the singlem db".format(last_marker))
-                logging.info("Querying index for {}".format(last_marker))
-                query = select(Marker.id).where(Marker.marker == last_marker)
-                m = sdb.sqlalchemy_connection.execute(query).first()
-                if m is None:
-                    raise Exception("Marker {} not in the SQL DB".format(last_marker))
-                last_marker_id = m.id
+        for marker, marker_queries in itertools.groupby(queries, lambda x: x.marker):
+            index = sdb.get_sequence_index(marker, 'nmslib', sequence_type)
+            if index is None:
+                raise Exception("The marker '{}' does not appear to be in the singlem db".format(marker))
+            logging.info("Querying index for {}".format(marker))
+            marker_id = self._get_marker_id(sdb, marker)
 
-            if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
-                query_protein_sequence = None
-                kNN = index.knnQuery(sequence_database.nucleotides_to_binary(q.sequence), max_search_nearest_neighbours)
-            elif sequence_type == SequenceDatabase.PROTEIN_TYPE:
-                query_protein_sequence = sequence_database.nucleotides_to_protein(q.sequence)
-                kNN = index.knnQuery(sequence_database.protein_to_binary(query_protein_sequence), max_search_nearest_neighbours)
-            else:
-                raise Exception("Unexpected sequence_type")
+            # Search in batches so that the hits can be looked up in the DB
+            # together
+            for chunked_queries1 in iterable_chunks(marker_queries, 1000):
+                chunked_queries = list([a for a in chunked_queries1 if a is not None]) # Remove trailing Nones from the iterable
 
-            num_reported = 0
-            for (hit_index, hamming_distance) in zip(kNN[0], kNN[1]):
-                div = int(hamming_distance / 2)
-                if max_divergence is None or div <= max_divergence:
-                    for qres in self.query_result_from_db(sdb, q, sequence_type, hit_index, last_marker, last_marker_id, div, query_protein_sequence=query_protein_sequence, limit_per_sequence=limit_per_sequence):
-                        yield qres
-                    num_reported += 1
-                    if num_reported >= max_nearest_neighbours:
-                        break
+                if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
+                    query_protein_sequences = [None] * len(chunked_queries)
+                    encoded_queries = sequence_database.nucleotides_to_binaries(
+                        [q.sequence for q in chunked_queries])
+                elif sequence_type == SequenceDatabase.PROTEIN_TYPE:
+                    query_protein_sequences = [
+                        sequence_database.nucleotides_to_protein(q.sequence) for q in chunked_queries]
+                    encoded_queries = sequence_database.proteins_to_binaries(query_protein_sequences)
+                else:
+                    raise Exception("Unexpected sequence_type")
+                kNN_batch = index.knnQueryBatch(encoded_queries, k=max_search_nearest_neighbours, num_threads=num_threads)
+
+                batch = _QueryHitBatch()
+                for q, query_protein_sequence, kNN in zip(chunked_queries, query_protein_sequences, kNN_batch):
+                    num_reported = 0
+                    for (hit_index, hamming_distance) in zip(kNN[0], kNN[1]):
+                        div = int(hamming_distance / 2)
+                        if max_divergence is None or div <= max_divergence:
+                            batch.add(q, hit_index, div, query_protein_sequence)
+                            num_reported += 1
+                            if num_reported >= max_nearest_neighbours:
+                                break
+
+                for qres in batch.query_results(self, sdb, sequence_type, marker, marker_id, limit_per_sequence):
+                    yield qres
 
+            del index
 
-    def query_by_sequence_similarity_with_scann(self, queries, sdb, max_divergence, sequence_type, max_nearest_neighbours, naive=False, preload_db=False, max_search_nearest_neighbours=None, limit_per_sequence=None):
+    def query_by_sequence_similarity_with_scann(self, queries, sdb, max_divergence, sequence_type, max_nearest_neighbours, naive=False, preload_db=False, max_search_nearest_neighbours=None, limit_per_sequence=None, preload_db_memmap=False):
         if naive:
             logging.info("Searching with SCANN NAIVE by {} sequence ..".format(sequence_type))
         else:
@@ -257,18 +259,14 @@ class Querier:
             if index is None:
                 raise Exception("The marker '{}' does not appear to be '{}' indexed in the singlem db".format(marker, index_format))
             logging.info("Querying index for {}".format(marker))
-            query = select(Marker.id).where(Marker.marker == marker)
-            m = sdb.sqlalchemy_connection.execute(query).first()
-            if m is None:
-                raise Exception("Marker {} not in the SQL DB".format(marker))
-            marker_id = m.id
+            marker_id = self._get_marker_id(sdb, marker)
 
             # Preload DB if needed
             if preload_db:
                 if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
-                    preloaded_db = self.preload_nucleotide_db(sdb, marker_id, limit_per_sequence)
+                    preloaded_db = self.preload_nucleotide_db(sdb, marker_id, limit_per_sequence, memmap=preload_db_memmap)
                 elif sequence_type == SequenceDatabase.PROTEIN_TYPE:
-                    preloaded_db = self.preload_protein_db(sdb, marker_id, limit_per_sequence)
+                    preloaded_db = self.preload_protein_db(sdb, marker_id, limit_per_sequence, memmap=preload_db_memmap)
                 else:
                     raise Exception("Unexpected sequence_type")
 
@@ -281,19 +279,20 @@ class Querier:
                 chunked_queries = list([a for a in chunked_queries1 if a is not None]) # Remove trailing Nones from the iterable
 
                 if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
-                    query_array = np.array([
-                        np.array(sequence_database.nucleotides_to_binary_array(q.sequence)) for q in chunked_queries])
+                    query_array = sequence_database.nucleotides_to_binary_arrays(
+                        [q.sequence for q in chunked_queries])
                 elif sequence_type == SequenceDatabase.PROTEIN_TYPE:
                     query_protein_sequences = np.array([
                         sequence_database.nucleotides_to_protein(q.sequence) for q in chunked_queries])
-                    query_array = np.array([
-                        np.array(sequence_database.protein_to_binary_array(seq)) for seq in query_protein_sequences])
+                    query_array = sequence_database.proteins_to_binary_arrays(
+                        list(query_protein_sequences))
                 else:
                     raise Exception("Unexpected sequence_type")
 
-                normed = np.array([qa / np.linalg.norm(qa) for qa in query_array])
+                normed = query_array / np.linalg.norm(query_array, axis=1)[:, np.newaxis]
                 kNN_batch = index.search_batched_parallel(normed, max_search_nearest_neighbours)
 
+                batch = _QueryHitBatch()
                 for i, q in enumerate(chunked_queries):
                     num_reported = 0
                     for (hit_index, dist) in zip(kNN_batch[0][i], kNN_batch[1][i]):
@@ -329,16 +328,17 @@ class Querier:
                                             query_protein_sequence=query_protein_sequences[i],
                                             subject_protein_sequence=preloaded_db.protein_sequence[entry_i])
                             else:
-                                for qres in self.query_result_from_db(sdb, q, sequence_type, hit_index, marker, marker_id, div, 
-                                    query_protein_sequence=query_protein_sequences[i] if sequence_type == SequenceDatabase.PROTEIN_TYPE else None,
-                                    limit_per_sequence=limit_per_sequence):
-
-                                    yield qres
+                                batch.add(q, hit_index, div,
+                                    query_protein_sequences[i] if sequence_type == SequenceDatabase.PROTEIN_TYPE else None)
                             num_reported += 1
                             if num_reported >= max_nearest_neighbours:
                                 break
 
-    def query_by_sequence_similarity_with_smafa_naive(self, queries, sdb, max_divergence, sequence_type, max_nearest_neighbours, preload_db=False, limit_per_sequence=None):
+                if not preload_db:
+                    for qres in batch.query_results(self, sdb, sequence_type, marker, marker_id, limit_per_sequence):
+                        yield qres
+
+    def query_by_sequence_similarity_with_smafa_naive(self, queries, sdb, max_divergence, sequence_type, max_nearest_neighbours, preload_db=False, limit_per_sequence=None, preload_db_memmap=False):
         logging.info("Searching with SMAFA NAIVE by {} sequence ..".format(sequence_type))
 
         for marker, marker_queries in itertools.groupby(queries, lambda x: x.marker):
@@ -346,215 +346,235 @@ class Querier:
             if index is None:
                 raise Exception("The marker '{}' does not appear to be 'smafa-naive/{}' indexed in the singlem db".format(marker, sequence_type))
             logging.info("Querying index for {}".format(marker))
-            query = select(Marker.id).where(Marker.marker == marker)
-            m = sdb.sqlalchemy_connection.execute(query).first()
-            if m is None:
-                raise Exception("Marker {} not in the SQL DB".format(marker))
-            marker_id = m.id
+            marker_id = self._get_marker_id(sdb, marker)
 
             # Preload DB if needed
             if preload_db:
                 if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
-                    preloaded_db = self.preload_nucleotide_db(sdb, marker_id, limit_per_sequence)
+                    preloaded_db = self.preload_nucleotide_db(sdb, marker_id, limit_per_sequence, memmap=preload_db_memmap)
                 elif sequence_type == SequenceDatabase.PROTEIN_TYPE:
-                    preloaded_db = self.preload_protein_db(sdb, marker_id, limit_per_sequence)
+                    preloaded_db = self.preload_protein_db(sdb, marker_id, limit_per_sequence, memmap=preload_db_memmap)
                 else:
                     raise Exception("Unexpected sequence_type")
             
-            # Actually do searches, in batches
-            for chunked_queries1 in iterable_chunks(marker_queries, 1000):
-                chunked_queries = list([a for a in chunked_queries1 if a is not None]) # Remove trailing Nones from the iterable
+            if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
+                pass
+            elif sequence_type == SequenceDatabase.PROTEIN_TYPE:
+                raise NotImplementedError("SMAFA NAIVE does not support protein sequences yet")
+            else:
+                raise Exception("Unexpected sequence_type")
 
-                if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
-                    pass
-                elif sequence_type == SequenceDatabase.PROTEIN_TYPE:
-                    raise NotImplementedError("SMAFA NAIVE does not support protein sequences yet")
-                else:
-                    raise Exception("Unexpected sequence_type")
+            # Run a single smafa process over all of this marker's queries,
+            # rather than one per chunk, so the database is only loaded once.
+            #
+            # Previous version of this code piped the fasta file via STDIN,
+            # but this ran into deadlock problems e.g. singlem query
+            # --query-archive-otu-tables <(zcat
+            # from_s3/us-west-2/sra_20211215_7_sample50000/singlem-err1193301-m82rp-ERR1193301/ERR1193301.annotated.singlem.json.gz)
+            # --db
+            # ~/m/msingle/sam/otu_tables/S3.0.5.metapackage20220806/NCBI_r215.sdb
+            #
+            # So instead write the queries to a temporary file, and stream the
+            # results back from STDOUT. The query objects themselves are
+            # kept, indexed by their position in the file, since callers such
+            # as appraise rely on getting the same objects back in the
+            # results.
+            marker_query_list = []
+            with tempfile.NamedTemporaryFile(mode='w', prefix='singlem-smafa-query-', suffix='.fasta') as query_fasta:
+                for i, q in enumerate(marker_queries):
+                    query_fasta.write(">{}\n{}\n".format(i, q.sequence))
+                    marker_query_list.append(q)
+                query_fasta.flush()
 
-                # Previous version of this code piped the fasta file via STDIN,
-                # but this ran into deadlock problems e.g. singlem query
-                # --query-archive-otu-tables <(zcat
-                # from_s3/us-west-2/sra_20211215_7_sample50000/singlem-err1193301-m82rp-ERR1193301/ERR1193301.annotated.singlem.json.gz)
-                # --db
-                # ~/m/msingle/sam/otu_tables/S3.0.5.metapackage20220806/NCBI_r215.sdb
-                #
-                # So instead just write the output to a temporary file, using
-                # extern rather than Popen.
                 smafa_args = ""
                 if max_divergence is not None:
                     smafa_args += " --max-divergence {}".format(max_divergence)
                 if max_nearest_neighbours is not None:
                     smafa_args += " --max-num-hits {}".format(max_nearest_neighbours)
-                smafa_cmd = 'smafa query --database \'{}\' --query /dev/stdin {}'.format(
-                    index, smafa_args)
-                smafa_stdout = extern.run(smafa_cmd, stdin='\n'.join([">{}\n{}".format(i, q.sequence) for i, q in enumerate(chunked_queries)]))
+                smafa_cmd = 'smafa query --database \'{}\' --query \'{}\' {}'.format(
+                    index, query_fasta.name, smafa_args)
+                logging.debug("Running command: {}".format(smafa_cmd))
 
-                if not preload_db:
+                with run_streaming_command(smafa_cmd) as smafa_output:
+                    for qres in self._smafa_naive_results(
+                        smafa_output, marker_query_list, sdb, sequence_type, marker, marker_id,
+                        max_nearest_neighbours, preload_db, preloaded_db if preload_db else None,
+                        limit_per_sequence):
+
+                        yield qres
+
+    def _smafa_naive_results(self, smafa_output, queries, sdb, sequence_type, marker, marker_id, max_nearest_neighbours, preload_db, preloaded_db, limit_per_sequence):
+        '''Parse smafa query output lines, yielding QueryResult objects. The
+        queries are given as a list indexed by the query index in the smafa
+        output. When the DB is not preloaded, hits are looked up in the SQL DB
+        in batches, each covering up to 1000 consecutive queries.'''
+        chunk_size = 1000
+        current_chunk = None
+        batch_for_db_queries = []
+        batch_for_db_hit_indices = []
+        batch_for_db_divs = []
+
+        previous_query_index = None
+        previous_query_index_num_reported = 0
+        for line in smafa_output:
+            splits = line.strip().split("\t")
+            if len(splits) != 4:
+                raise Exception("Unexpected output from smafa: {}".format(line))
+            query_index_str, hit_index, div_str, _ = splits
+            query_index = int(query_index_str)
+            hit_index = int(hit_index)
+            div = int(div_str)
+
+            if query_index == previous_query_index:
+                if previous_query_index_num_reported > max_nearest_neighbours:
+                    continue
+                previous_query_index_num_reported += 1
+            else:
+                previous_query_index_num_reported = 0
+                previous_query_index = query_index
+                query = queries[query_index]
+
+            if preload_db:
+                for entry_i in preloaded_db.indices.iat[hit_index]:
+                    otu = OtuTableEntry()
+                    otu.marker = marker
+                    otu.sample_name = preloaded_db.sample_name[entry_i]
+                    otu.count = preloaded_db.count[entry_i]
+                    otu.sequence = preloaded_db.sequence[entry_i]
+                    otu.coverage = preloaded_db.coverage[entry_i]
+                    otu.taxonomy = preloaded_db.taxonomy[entry_i]
+                    # Only nucleotide queries are supported by smafa (so far)
+                    yield QueryResult(query, otu, div)
+            else:
+                chunk = query_index // chunk_size
+                if chunk != current_chunk:
+                    if len(batch_for_db_queries) > 0:
+                        for qres in self.query_result_batch_from_db(sdb, batch_for_db_queries, sequence_type, batch_for_db_hit_indices,
+                            marker, marker_id, batch_for_db_divs,
+                            limit_per_sequence=limit_per_sequence):
+
+                            yield qres
                     batch_for_db_queries = []
                     batch_for_db_hit_indices = []
                     batch_for_db_divs = []
+                    current_chunk = chunk
 
-                # Read the output
-                previous_query_index = None
-                previous_query_index_num_reported = 0
-                for line in smafa_stdout.splitlines():
-                    splits = line.strip().split("\t")
-                    if len(splits) != 4:
-                        raise Exception("Unexpected output from smafa: {}".format(line))
-                    query_index_str, hit_index, div_str, _ = splits
-                    query_index = int(query_index_str)
-                    hit_index = int(hit_index)
-                    div = int(div_str)
-
-                    if query_index == previous_query_index:
-                        if previous_query_index_num_reported > max_nearest_neighbours:
-                            continue
-                        previous_query_index_num_reported += 1
-                    else:
-                        previous_query_index_num_reported = 0
-                        previous_query_index = query_index
-
-                    if preload_db:
-                        for entry_i in preloaded_db.indices.iat[hit_index]:
-                            otu = OtuTableEntry()
-                            otu.marker = marker
-                            otu.sample_name = preloaded_db.sample_name[entry_i]
-                            otu.count = preloaded_db.count[entry_i]
-                            otu.sequence = preloaded_db.sequence[entry_i]
-                            otu.coverage = preloaded_db.coverage[entry_i]
-                            otu.taxonomy = preloaded_db.taxonomy[entry_i]
-                            if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
-                                yield QueryResult(chunked_queries[query_index], otu, div)
-                            else:
-                                # Below not actually used - smafa doesn't handle proteins (yet)
-                                yield QueryResult(
-                                    chunked_queries[query_index], otu, div, 
-                                    query_protein_sequence=query_protein_sequences[i],
-                                    subject_protein_sequence=preloaded_db.protein_sequence[entry_i])
-                    else:
-                        # Query in batch as this should be faster than doing individually
-                        batch_for_db_queries.append(chunked_queries[query_index])
-                        batch_for_db_hit_indices.append(hit_index)
-                        batch_for_db_divs.append(div)
+                # Query in batch as this should be faster than doing individually
+                batch_for_db_queries.append(query)
+                batch_for_db_hit_indices.append(hit_index)
+                batch_for_db_divs.append(div)
 
-                if not preload_db:
-                    for qres in self.query_result_batch_from_db(sdb, batch_for_db_queries, sequence_type, batch_for_db_hit_indices, 
-                        marker, marker_id, batch_for_db_divs, 
-                        query_protein_sequence=query_protein_sequences[i] if sequence_type == SequenceDatabase.PROTEIN_TYPE else None,
-                        limit_per_sequence=limit_per_sequence):
+        if not preload_db and len(batch_for_db_queries) > 0:
+            for qres in self.query_result_batch_from_db(sdb, batch_for_db_queries, sequence_type, batch_for_db_hit_indices,
+                marker, marker_id, batch_for_db_divs,
+                limit_per_sequence=limit_per_sequence):
 
-                        yield qres
+                yield qres
 
 
-    def query_by_sequence_similarity_with_annoy(self, queries, sdb, max_divergence, sequence_type, max_nearest_neighbours, max_search_nearest_neighbours=None, limit_per_sequence=None):
+    def query_by_sequence_similarity_with_annoy(self, queries, sdb, max_divergence, sequence_type, max_nearest_neighbours, max_search_nearest_neighbours=None, limit_per_sequence=None, num_threads=1):
         logging.info("Searching with annoy by {} sequence ..".format(sequence_type))
 
         if max_search_nearest_neighbours is None:
             max_search_nearest_neighbours = max_nearest_neighbours
 
-        last_marker = None
-        last_marker_id = None
-        index = None
-        for q in queries:
-            if q.marker != last_marker:
-                del index
-                last_marker = q.marker
-                index = sdb.get_sequence_index(last_marker, 'annoy', sequence_type)
+        with ThreadPool(num_threads) as pool:
+            for marker, marker_queries in itertools.groupby(queries, lambda x: x.marker):
+                index = sdb.get_sequence_index(marker, 'annoy', sequence_type)
                 if index is None:
-                    raise Exception("The marker '{}' does not appear to be in the singlem db".format(last_marker))
-                logging.info("Querying index for {}".format(last_marker))
-                query = select(Marker.id).where(Marker.marker == last_marker)
-                m = sdb.sqlalchemy_connection.execute(query).first()
-                if m is None:
-                    raise Exception("Marker {} not in the SQL DB".format(last_marker))
-                last_marker_id = m.id
-
-            if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
-                query_protein_sequence = None
-                kNN = index.get_nns_by_vector(sequence_database.nucleotides_to_binary_array(q.sequence), max_search_nearest_neighbours, include_distances=True)
-            elif sequence_type == SequenceDatabase.PROTEIN_TYPE:
-                query_protein_sequence = sequence_database.nucleotides_to_protein(q.sequence)
-                kNN = index.get_nns_by_vector(sequence_database.protein_to_binary_array(query_protein_sequence), max_search_nearest_neighbours, include_distances=True)
-            else:
-                raise Exception("Unexpected sequence_type")
-
-            num_reported = 0
-            for (hit_index, hamming_distance) in zip(kNN[0], kNN[1]):
-                div = int(hamming_distance / 2)
-                if max_divergence is None or div <= max_divergence:
-                    for qres in self.query_result_from_db(sdb, q, sequence_type, hit_index, last_marker, last_marker_id, div, query_protein_sequence=query_protein_sequence, limit_per_sequence=limit_per_sequence):
+                    raise Exception("The marker '{}' does not appear to be in the singlem db".format(marker))
+                logging.info("Querying index for {}".format(marker))
+                marker_id = self._get_marker_id(sdb, marker)
+
+                # Search in batches so that the hits can be looked up in the DB
+                # together
+                for chunked_queries1 in iterable_chunks(marker_queries, 1000):
+                    chunked_queries = list([a for a in chunked_queries1 if a is not None]) # Remove trailing Nones from the iterable
+
+                    if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
+                        query_protein_sequences = [None] * len(chunked_queries)
+                        encoded_queries = sequence_database.nucleotides_to_binary_arrays(
+                            [q.sequence for q in chunked_queries]).tolist()
+                    elif sequence_type == SequenceDatabase.PROTEIN_TYPE:
+                        query_protein_sequences = [
+                            sequence_database.nucleotides_to_protein(q.sequence) for q in chunked_queries]
+                        encoded_queries = sequence_database.proteins_to_binary_arrays(query_protein_sequences).tolist()
+                    else:
+                        raise Exception("Unexpected sequence_type")
+                    # annoy releases the GIL while searching, so threads give
+                    # real parallelism here.
+                    kNN_batch = pool.map(
+                        lambda vector: index.get_nns_by_vector(vector, max_search_nearest_neighbours, include_distances=True),
+                        encoded_queries)
+
+                    batch = _QueryHitBatch()
+                    for q, query_protein_sequence, kNN in zip(chunked_queries, query_protein_sequences, kNN_batch):
+                        num_reported = 0
+                        for (hit_index, hamming_distance) in zip(kNN[0], kNN[1]):
+                            div = int(hamming_distance / 2)
+                            if max_divergence is None or div <= max_divergence:
+                                batch.add(q, hit_index, div, query_protein_sequence)
+                                num_reported += 1
+                                if num_reported >= max_nearest_neighbours:
+                                    break
+
+                    for qres in batch.query_results(self, sdb, sequence_type, marker, marker_id, limit_per_sequence):
                         yield qres
-                    num_reported += 1
-                    if num_reported >= max_nearest_neighbours:
-                        break
-
-    def query_result_from_db(self, sdb, query, sequence_type, hit_index, marker, marker_id, div, query_protein_sequence=None, limit_per_sequence=None):
-        if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
-            query2 = select(
-                Otu.marker_id, Otu.sample_name, Otu.sequence, Otu.num_hits, Otu.coverage, Otu.taxonomy_id
-            ).where(Otu.marker_wise_sequence_id == int(hit_index)).where(Otu.marker_id == int(marker_id)).limit(limit_per_sequence)
-            for row in sdb.sqlalchemy_connection.execute(query2):
-                otu = OtuTableEntry()
-                otu.marker = marker
-                otu.sample_name = row.sample_name
-                otu.count = row.num_hits
-                otu.sequence = row.sequence
-                otu.coverage = row.coverage
-                otu.taxonomy = sdb.get_taxonomy_via_cache(row.taxonomy_id)
-                yield QueryResult(query, otu, div)
 
-        elif sequence_type == SequenceDatabase.PROTEIN_TYPE:
-            query2 = select(
-                Otu.sequence,
-                ProteinSequence.protein_sequence,
-                Otu.sample_name,
-                Otu.num_hits,
-                Otu.coverage,
-                Otu.taxonomy_id) \
-                    .where(Otu.taxonomy_id == Taxonomy.id) \
-                    .where(Otu.marker_id == marker_id) \
-                    .where(NucleotidesProteins.nucleotide_id == Otu.sequence_id) \
-                    .where(NucleotidesProteins.protein_id == ProteinSequence.id) \
-                    .where(ProteinSequence.marker_wise_id == int(hit_index)) \
-                    .where(Otu.marker_id == marker_id)
-            if limit_per_sequence is not None:
-                query2 = query2.limit(limit_per_sequence)
-
-            results = sdb.sqlalchemy_connection.execute(query2)
+                del index
 
-            if results is None and hit_index <= 16:
-                # For very small indexes, SCANN can have dummy sequences that
-                # are not in the SQL DB. Ignore these.
-                pass
-            else:
-                for entry in results:
-                    otu = OtuTableEntry()
-                    otu.marker = marker
-                    otu.sample_name = entry.sample_name
-                    otu.sequence = entry.sequence
-                    otu.count = entry.num_hits
-                    otu.coverage = entry.coverage
-                    otu.taxonomy = sdb.get_taxonomy_via_cache(entry.taxonomy_id)
-                    yield QueryResult(query, otu, div, query_protein_sequence=query_protein_sequence, subject_protein_sequence=entry.protein_sequence)
-        else:
-            raise Exception("unknown sequence_type")
+    def _get_marker_id(self, sdb, marker):
+        query = select(Marker.id).where(Marker.marker == marker)
+        m = sdb.sqlalchemy_connection.execute(query).first()
+        if m is None:
+            raise Exception("Marker {} not in the SQL DB".format(marker))
+        return m.id
 
     def query_result_batch_from_db(self, sdb, queries, sequence_type, hit_indexes, marker, marker_id, 
-        divergences, query_protein_sequence=None, limit_per_sequence=None):
+        divergences, query_protein_sequences=None, limit_per_sequence=None):
         '''
-        Like query_result_from_db except arrays of queries, hit_indexes, and
-        divergences are passed in, so that only one SQL query is needed.
+        Yield a QueryResult for each OTU in the DB matching each hit, given as
+        lists of queries, hit_indexes, and divergences (and
+        query_protein_sequences for protein searches). The DB is queried once
+        per chunk of distinct hit indexes rather than once per hit. Results
+        are yielded in the same order as the given hits.
         '''
-        
-        if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
-            query2 = select(
-                Otu.marker_id, Otu.sample_name, Otu.sequence, Otu.num_hits, Otu.coverage, Otu.taxonomy_id, Otu.marker_wise_sequence_id
-            ).filter(Otu.marker_wise_sequence_id.in_(set([int(h) for h in hit_indexes]))
-            ).where(Otu.marker_id == int(marker_id))
-
-            hits = {}
+        max_set_size = 999 # Cannot query sqlite with > 999 '?' entries, so
+                           # query in batches.
+
+        if sequence_type not in (SequenceDatabase.NUCLEOTIDE_TYPE, SequenceDatabase.PROTEIN_TYPE):
+            raise Exception("unknown sequence_type")
+
+        # Map of hit index to list of (OtuTableEntry, subject protein sequence)
+        hits = {}
+        for chunk in iterable_chunks(sorted(set([int(h) for h in hit_indexes])), max_set_size):
+            chunk_hit_indexes = [h for h in chunk if h is not None] # Remove trailing Nones from the iterable
+
+            if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
+                query2 = select(
+                    Otu.sample_name, Otu.sequence, Otu.num_hits, Otu.coverage, Otu.taxonomy_id,
+                    Otu.marker_wise_sequence_id.label('hit_index')
+                ).where(Otu.marker_wise_sequence_id.in_(chunk_hit_indexes)
+                ).where(Otu.marker_id == int(marker_id))
+            else:
+                query2 = select(
+                    Otu.sequence,
+                    ProteinSequence.protein_sequence,
+                    Otu.sample_name,
+                    Otu.num_hits,
+                    Otu.coverage,
+                    Otu.taxonomy_id,
+                    ProteinSequence.marker_wise_id.label('hit_index')) \
+                        .where(Otu.taxonomy_id == Taxonomy.id) \
+                        .where(Otu.marker_id == int(marker_id)) \
+                        .where(NucleotidesProteins.nucleotide_id == Otu.sequence_id) \
+                        .where(NucleotidesProteins.protein_id == ProteinSequence.id) \
+                        .where(ProteinSequence.marker_wise_id.in_(chunk_hit_indexes))
+
             for row in sdb.sqlalchemy_connection.execute(query2):
+                row_hits = hits.setdefault(row.hit_index, [])
+                if limit_per_sequence is not None and len(row_hits) >= limit_per_sequence:
+                    continue
                 otu = OtuTableEntry()
                 otu.marker = marker
                 otu.sample_name = row.sample_name
@@ -562,22 +582,23 @@ class Querier:
                 otu.sequence = row.sequence
                 otu.coverage = row.coverage
                 otu.taxonomy = sdb.get_taxonomy_via_cache(row.taxonomy_id)
-                if row.marker_wise_sequence_id not in hits:
-                    hits[row.marker_wise_sequence_id] = [otu]
+                if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
+                    row_hits.append((otu, None))
                 else:
-                    hits[row.marker_wise_sequence_id].append(otu)
-
-            for query, hit_index, div in zip(queries, hit_indexes, divergences):
-                for i, hit_otu in enumerate(hits[int(hit_index)]):
-                    if limit_per_sequence is not None and i >= limit_per_sequence:
-                        break
+                    row_hits.append((otu, row.protein_sequence))
+
+        if query_protein_sequences is None:
+            query_protein_sequences = itertools.repeat(None)
+        for query, hit_index, div, query_protein_sequence in zip(queries, hit_indexes, divergences, query_protein_sequences):
+            # For very small indexes, SCANN can have dummy sequences that are
+            # not in the SQL DB, so there may be no hits. Ignore these.
+            for hit_otu, subject_protein_sequence in hits.get(int(hit_index), []):
+                if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
                     yield QueryResult(query, hit_otu, div)
-
-        elif sequence_type == SequenceDatabase.PROTEIN_TYPE:
-            raise Exception("batch queries not supported for protein sequences (yet)")
-
-        else:
-            raise Exception("unknown sequence_type")
+                else:
+                    yield QueryResult(query, hit_otu, div,
+                        query_protein_sequence=query_protein_sequence,
+                        subject_protein_sequence=subject_protein_sequence)
 
     def divergence(self, seq1, seq2):
         """Return the number of bases two sequences differ by"""
@@ -675,6 +696,29 @@ class QueryInputSequence:
         self.sequence = sequence
         self.marker = marker
 
+class _QueryHitBatch:
+    '''Hits accumulated from an index search, so they can be looked up in
+    the SQL DB together with Querier.query_result_batch_from_db.'''
+    def __init__(self):
+        self.queries = []
+        self.hit_indexes = []
+        self.divergences = []
+        self.query_protein_sequences = []
+
+    def add(self, query, hit_index, div, query_protein_sequence=None):
+        self.queries.append(query)
+        self.hit_indexes.append(hit_index)
+        self.divergences.append(div)
+        self.query_protein_sequences.append(query_protein_sequence)
+
+    def query_results(self, querier, sdb, sequence_type, marker, marker_id, limit_per_sequence):
+        if len(self.queries) == 0:
+            return iter([])
+        return querier.query_result_batch_from_db(
+            sdb, self.queries, sequence_type, self.hit_indexes, marker, marker_id,
+            self.divergences, query_protein_sequences=self.query_protein_sequences,
+            limit_per_sequence=limit_per_sequence)
+
 class QueryResult:
     def __init__(self, query, subject, divergence, query_protein_sequence=None, subject_protein_sequence=None):
         self.query = query
@@ -724,8 +768,155 @@ class PreloadedDB:
         # loaded.protein_sequence = current_preloaded_db.xs('protein_sequence',axis=1).to_numpy()
         self.protein_sequence = None
 
+    @staticmethod
+    def from_dataframe(current_preloaded_db, marker_wise_id_column):
+        loaded = PreloadedDB()
+        loaded.indices = pd.Series(
+            current_preloaded_db.groupby(marker_wise_id_column).indices)
+        loaded.sample_name = current_preloaded_db.xs('sample_name',axis=1).to_numpy()
+        loaded.count = current_preloaded_db.xs('num_hits',axis=1).to_numpy()
+        loaded.sequence = current_preloaded_db.xs('nucleotide_sequence',axis=1).to_numpy()
+        loaded.coverage = current_preloaded_db.xs('coverage',axis=1).to_numpy()
+        loaded.taxonomy = current_preloaded_db.xs('taxonomy',axis=1).to_numpy()
+        if 'protein_sequence' in current_preloaded_db.columns:
+            loaded.protein_sequence = current_preloaded_db.xs('protein_sequence',axis=1).to_numpy()
+        return loaded
+
     def limit_per_sequence(self, limit_per_sequence):
         ''' shuffle and truncate once up front '''
         self.indices.apply(np.random.shuffle)
         self.indices = pd.Series([a[:limit_per_sequence] for a in self.indices])
+
+
+def _preloaded_db_cache_directory(sdb, sequence_type, marker_id):
+    return os.path.join(sdb.base_directory, MemmapPreloadedDB.CACHE_DIRECTORY_NAME,
+        sequence_type, str(marker_id))
+
+
+class MemmapPreloadedDB(PreloadedDB):
+    '''A PreloadedDB whose columns are memory-mapped from files cached inside
+    the sdb directory. The cache is generated by the first process that needs
+    it, after which other processes attach to it quickly and share its pages
+    through the OS page cache.
+
+    Rows are stored grouped by marker-wise sequence ID, so the rows for the
+    sequence at position i are rows offsets[i] to offsets[i+1]. String columns
+    are stored as a single UTF-8 byte array plus offsets.'''
+
+    CACHE_DIRECTORY_NAME = 'preloaded_db_cache'
+    _VERSION = 1
+    _STRING_COLUMNS = ['sample_name', 'sequence', 'taxonomy', 'protein_sequence']
+
+    @staticmethod
+    def acquire(cache_directory, dataframe_generator, marker_wise_id_column):
+        '''Return a MemmapPreloadedDB from cache_directory, generating it
+        first from the DataFrame returned by dataframe_generator() if it does
+        not exist. Returns None if the cache could not be written.'''
+        version_directory = os.path.join(cache_directory, 'v{}'.format(MemmapPreloadedDB._VERSION))
+        if not os.path.exists(version_directory):
+            try:
+                os.makedirs(cache_directory, exist_ok=True)
+                working_directory = tempfile.mkdtemp(dir=cache_directory, prefix='tmp-')
+            except OSError as e:
+                logging.warning("Unable to write preloaded DB cache to {} ({}), preloading into memory instead".format(
+                    cache_directory, e))
+                return None
+            try:
+                logging.info("Writing preloaded DB cache to {} ..".format(version_directory))
+                MemmapPreloadedDB._write(dataframe_generator(), marker_wise_id_column, working_directory)
+                try:
+                    os.rename(working_directory, version_directory)
+                except OSError:
+                    # Another process generated the cache concurrently, use that
+                    if not os.path.exists(version_directory):
+                        raise
+            finally:
+                if os.path.exists(working_directory):
+                    shutil.rmtree(working_directory)
+        logging.info("Loading preloaded DB cache from {} ..".format(version_directory))
+        return MemmapPreloadedDB._load(version_directory)
+
+    @staticmethod
+    def _write(current_preloaded_db, marker_wise_id_column, directory):
+        marker_wise_ids = current_preloaded_db[marker_wise_id_column].to_numpy()
+        # Stable, so that rows within each group stay in DB order, as they
+        # would with groupby().indices
+        order = np.argsort(marker_wise_ids, kind='stable')
+        _, group_starts = np.unique(marker_wise_ids[order], return_index=True)
+        np.save(os.path.join(directory, 'offsets.npy'),
+            np.append(group_starts, len(order)).astype(np.int64))
+
+        np.save(os.path.join(directory, 'count.npy'),
+            current_preloaded_db['num_hits'].to_numpy()[order])
+        np.save(os.path.join(directory, 'coverage.npy'),
+            current_preloaded_db['coverage'].to_numpy()[order])
+        for attribute, column in [
+            ('sample_name', 'sample_name'),
+            ('sequence', 'nucleotide_sequence'),
+            ('taxonomy', 'taxonomy'),
+            ('protein_sequence', 'protein_sequence')]:
+            if column not in current_preloaded_db.columns:
+                continue
+            encoded = [s.encode() for s in current_preloaded_db[column].to_numpy()[order]]
+            string_offsets = np.zeros(len(encoded)+1, dtype=np.int64)
+            np.cumsum([len(e) for e in encoded], out=string_offsets[1:])
+            np.save(os.path.join(directory, '{}.offsets.npy'.format(attribute)), string_offsets)
+            np.save(os.path.join(directory, '{}.data.npy'.format(attribute)),
+                np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+    @staticmethod
+    def _load(directory):
+        def load(name):
+            return np.load(os.path.join(directory, name), mmap_mode='r')
+
+        loaded = MemmapPreloadedDB()
+        loaded.indices = _GroupedRowIndices(load('offsets.npy'))
+        loaded.count = load('count.npy')
+        loaded.coverage = load('coverage.npy')
+        for attribute in MemmapPreloadedDB._STRING_COLUMNS:
+            if os.path.exists(os.path.join(directory, '{}.offsets.npy'.format(attribute))):
+                setattr(loaded, attribute, _StringColumn(
+                    load('{}.offsets.npy'.format(attribute)),
+                    load('{}.data.npy'.format(attribute))))
+        return loaded
+
+    def limit_per_sequence(self, limit_per_sequence):
+        self.indices.limit = limit_per_sequence
+
+
+class _GroupedRowIndices:
+    '''Row indices of each marker-wise sequence ID in a MemmapPreloadedDB,
+    accessed like the pd.Series of PreloadedDB.indices i.e. indices.iat[i].'''
+    def __init__(self, offsets):
+        self._offsets = offsets
+        self.limit = None
+        self._limited = {}
+        self.iat = self
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if self.limit is None:
+            return range(self._offsets[i], self._offsets[i+1])
+        # Shuffle and truncate each group once, when first needed
+        if i not in self._limited:
+            rows = np.arange(self._offsets[i], self._offsets[i+1])
+            np.random.shuffle(rows)
+            self._limited[i] = rows[:self.limit]
+        return self._limited[i]
+
+
+class _StringColumn:
+    '''Strings stored as a byte array plus offsets, indexed like a numpy array
+    of str.'''
+    def __init__(self, offsets, data):
+        self._offsets = offsets
+        self._data = data
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self._data[self._offsets[i]:self._offsets[i+1]]).decode()
         
\ No newline at end of file
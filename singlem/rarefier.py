@@ -1,6 +1,7 @@
 import logging
 import copy
 import random
+import bisect
 
 from .otu_table import OtuTable
 
@@ -41,17 +42,27 @@ class Rarefier:
 
         for sample_name in sample_to_gene_to_otu.keys():
             for gene in sample_to_gene_to_otu[sample_name].keys():
-                sequences_to_sample = []
+                # Choose reads by their index in the list of reads that would
+                # be made by expanding each OTU into count reads, without
+                # expanding it. The sampled indices are then mapped back to
+                # their OTU through the cumulative counts, so memory use is
+                # proportional to the number of OTUs and num_to_sample, not
+                # the number of reads.
+                sequences = []
+                cumulative_counts = []
+                total_count = 0
                 for sequence, otu in sample_to_gene_to_otu[sample_name][gene].items():
-                    for _ in range(otu.count):
-                        sequences_to_sample.append(sequence)
-                if len(sequences_to_sample) < num_to_sample:
-                    logging.warning("Sample %s gene %s only contains %i sequences, so cannot be rarefied. Ignoring this sample/gene combination" % (sample_name, gene, len(sequences_to_sample)))
+                    total_count += otu.count
+                    sequences.append(sequence)
+                    cumulative_counts.append(total_count)
+                if total_count < num_to_sample:
+                    logging.warning("Sample %s gene %s only contains %i sequences, so cannot be rarefied. Ignoring this sample/gene combination" % (sample_name, gene, total_count))
                     continue
                 else:
-                    sequences_sampled = random_generator.sample(sequences_to_sample, num_to_sample)
+                    indices_sampled = random_generator.sample(range(total_count), num_to_sample)
                     sequence_counts = {}
-                for seq in sequences_sampled:
+                for index in indices_sampled:
+                    seq = sequences[bisect.bisect_right(cumulative_counts, index)]
                     try:
                         sequence_counts[seq] += 1
                     except KeyError:
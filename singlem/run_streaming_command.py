@@ -0,0 +1,46 @@
+import contextlib
+import subprocess
+import tempfile
+
+import extern
+
+@contextlib.contextmanager
+def run_streaming_command(cmd):
+    '''Run a command with bash, yielding its STDOUT as a text stream so that
+    the output can be processed as it is generated, rather than being held in
+    RAM all at once as with extern.run.
+
+    When the block is exited normally, wait for the command to finish and
+    raise an extern.ExternCalledProcessError if it failed, as extern.run
+    does. If instead an exception is raised within
+    the block, the command is killed.
+
+    e.g.
+    with run_streaming_command('cat {}'.format(path)) as stdout:
+        for line in stdout:
+            ...
+    '''
+    # stderr goes to a file so that a chatty command cannot block while
+    # stdout is being read.
+    with tempfile.TemporaryFile() as stderr_tf:
+        process = subprocess.Popen(
+            ['bash','-o','pipefail','-c',cmd],
+            stdout=subprocess.PIPE,
+            stderr=stderr_tf,
+            universal_newlines=True)
+        try:
+            yield process.stdout
+        except BaseException:
+            process.kill()
+            process.wait()
+            process.stdout.close()
+            raise
+        process.stdout.close()
+        process.wait()
+        if process.returncode != 0:
+            stderr_tf.seek(0)
+            # stdout has already been consumed by the caller
+            raise extern.ExternCalledProcessError(
+                subprocess.CompletedProcess(
+                    process.args, process.returncode, stdout=b'', stderr=stderr_tf.read()),
+                cmd)
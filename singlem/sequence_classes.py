@@ -103,8 +103,9 @@ class SeqReader:
 
     def read_nucleotide_sequences(self, nucleotide_file):
         nucleotide_sequences = {}
-        for name, seq, _ in self.readfq(open(nucleotide_file)):
-            nucleotide_sequences[name] = seq
+        with open(nucleotide_file) as f:
+            for name, seq, _ in self.readfq(f):
+                nucleotide_sequences[name] = seq
         return nucleotide_sequences
 
     def alignment_from_alignment_file(self, alignment_file):
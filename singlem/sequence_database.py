@@ -8,10 +8,12 @@ import json
 import itertools
 import sys
 import csv
+import multiprocessing
+import urllib.parse
 import extern
 import numpy as np
 
-from sqlalchemy import create_engine, select, distinct
+from sqlalchemy import create_engine, select, distinct, func
 
 import Bio.Data.CodonTable
 
@@ -20,6 +22,10 @@ from .singlem_database_models import *
 
 DEFAULT_NUM_THREADS = 1
 
+# Number of sequences to read from the SQL DB and one-hot encode at once when
+# building indices
+ENCODING_BATCH_SIZE = 10000
+
 ANNOY_INDEX_FORMAT = 'annoy'
 NMSLIB_INDEX_FORMAT = 'nmslib'
 SCANN_INDEX_FORMAT = 'scann'
@@ -600,253 +606,341 @@ class SequenceDatabase:
         if 'scann-naive' in sequence_database_methods:
             sequence_database_methods.append(SCANN_NAIVE_INDEX_FORMAT)
         if SCANN_INDEX_FORMAT in sequence_database_methods or SCANN_NAIVE_INDEX_FORMAT in sequence_database_methods:
-            sdb.create_scann_indexes(sequence_database_types, SCANN_NAIVE_INDEX_FORMAT in sequence_database_methods)
+            sdb.create_scann_indexes(sequence_database_types, SCANN_NAIVE_INDEX_FORMAT in sequence_database_methods, num_threads=num_threads)
 
         if NMSLIB_INDEX_FORMAT in sequence_database_methods:
             if NUCLEOTIDE_DATABASE_TYPE in sequence_database_types:
-                sdb.create_nmslib_nucleotide_indexes()
+                sdb.create_nmslib_nucleotide_indexes(num_threads=num_threads)
             if PROTEIN_DATABASE_TYPE in sequence_database_types:
-                sdb.create_nmslib_protein_indexes()
+                sdb.create_nmslib_protein_indexes(num_threads=num_threads)
 
         if ANNOY_INDEX_FORMAT in sequence_database_methods:
             if NUCLEOTIDE_DATABASE_TYPE in sequence_database_types:
-                sdb.create_annoy_nucleotide_indexes(ntrees=num_annoy_nucleotide_trees)
+                sdb.create_annoy_nucleotide_indexes(ntrees=num_annoy_nucleotide_trees, num_threads=num_threads)
             if PROTEIN_DATABASE_TYPE in sequence_database_types:
-                sdb.create_annoy_protein_indexes(ntrees=num_annoy_protein_trees)
+                sdb.create_annoy_protein_indexes(ntrees=num_annoy_protein_trees, num_threads=num_threads)
 
         if SMAFA_NAIVE_INDEX_FORMAT in sequence_database_methods:
             if NUCLEOTIDE_DATABASE_TYPE in sequence_database_types:
-                sdb.create_smafa_naive_nucleotide_indexes()
+                sdb.create_smafa_naive_nucleotide_indexes(num_threads=num_threads)
 
         logging.info("Finished singlem DB creation")
 
-    def create_smafa_naive_nucleotide_indexes(self):
+    def _create_indexes_per_marker(self, method_name, method_args, num_threads):
+        '''Run the given per-marker index creation method on each marker in the
+        DB. When num_threads > 1, markers are processed concurrently in separate
+        processes, each with its own read-only connection to the SQLite DB.
+
+        Parameters
+        ----------
+        method_name: str
+            name of the SequenceDatabase method to run, which is called as
+            method(marker_id, marker_name, *method_args)
+        method_args: tuple
+            extra arguments to pass to the method
+        num_threads: int
+            number of markers to process at once
+        '''
+        markers = [(marker_row.id, marker_row.marker) for marker_row in \
+            self.sqlalchemy_connection.execute(select(Marker))]
+        if num_threads <= 1 or len(markers) <= 1:
+            for marker_id, marker_name in markers:
+                getattr(self, method_name)(marker_id, marker_name, *method_args)
+        else:
+            logging.info("Creating indices for {} markers using {} processes ..".format(
+                len(markers), num_threads))
+            with multiprocessing.Pool(num_threads, initializer=_init_index_worker, initargs=(self.base_directory, self.sqlite_file)) as pool:
+                for _ in pool.imap_unordered(
+                    _create_index_in_worker,
+                    [(method_name, marker_id, marker_name, method_args) for marker_id, marker_name in markers]):
+                    pass
+
+    def create_smafa_naive_nucleotide_indexes(self, num_threads=DEFAULT_NUM_THREADS):
         logging.info("Creating smafa-naive nucleotide sequence indices ..")
         nucleotide_db_dir = os.path.join(self.base_directory, 'nucleotide_indices_smafa_naive')
         os.makedirs(nucleotide_db_dir)
-        
-        for marker_row in self.sqlalchemy_connection.execute(select(Marker)):
-            marker_name = marker_row.marker
-            logging.info("Tabulating unique nucleotide sequences for {}..".format(marker_name))
-            count = 0
+        self._create_indexes_per_marker('_create_smafa_naive_nucleotide_index', (nucleotide_db_dir,), num_threads)
 
-            with tempfile.NamedTemporaryFile(prefix='singlem-smafa-create-', suffix='.fasta') as fasta_file:
-                for row in self.sqlalchemy_connection.execute(select(
-                    NucleotideSequence.sequence, NucleotideSequence.marker_wise_id) \
-                    .where(NucleotideSequence.marker_id == marker_row.id)
-                    .order_by(NucleotideSequence.marker_wise_id)):
+    def _create_smafa_naive_nucleotide_index(self, marker_id, marker_name, nucleotide_db_dir):
+        logging.info("Tabulating unique nucleotide sequences for {}..".format(marker_name))
+        count = 0
 
-                    fasta_file.write(str.encode(">{}\n{}\n".format(row.marker_wise_id, row.sequence)))
-                    count += 1
-                fasta_file.flush()
+        with tempfile.NamedTemporaryFile(prefix='singlem-smafa-create-', suffix='.fasta') as fasta_file:
+            for row in self.sqlalchemy_connection.execute(select(
+                NucleotideSequence.sequence, NucleotideSequence.marker_wise_id) \
+                .where(NucleotideSequence.marker_id == marker_id)
+                .order_by(NucleotideSequence.marker_wise_id)):
 
-                extern.run('smafa makedb --database {} --input {}'.format(
-                    os.path.join(nucleotide_db_dir, "%s.smafa_naive_index" % marker_name),
-                    fasta_file.name))
-            logging.info("Finished writing index containing {} sequences to disk".format(count))
+                fasta_file.write(str.encode(">{}\n{}\n".format(row.marker_wise_id, row.sequence)))
+                count += 1
+            fasta_file.flush()
 
+            extern.run('smafa makedb --database {} --input {}'.format(
+                os.path.join(nucleotide_db_dir, "%s.smafa_naive_index" % marker_name),
+                fasta_file.name))
+        logging.info("Finished writing index containing {} sequences to disk".format(count))
 
-    def create_nmslib_nucleotide_indexes(self):
+    def create_nmslib_nucleotide_indexes(self, num_threads=DEFAULT_NUM_THREADS):
         logging.info("Creating nmslib nucleotide sequence indices ..")
         nucleotide_db_dir = os.path.join(self.base_directory, 'nucleotide_indices_nmslib')
         os.makedirs(nucleotide_db_dir)
-        
-        for marker_row in self.sqlalchemy_connection.execute(select(Marker)):
-            nucleotide_index = SequenceDatabase._nucleotide_nmslib_init()
+        self._create_indexes_per_marker('_create_nmslib_nucleotide_index', (nucleotide_db_dir,), num_threads)
 
-            marker_name = marker_row.marker
-            logging.info("Tabulating unique nucleotide sequences for {}..".format(marker_name))
-            count = 0
+    def _create_nmslib_nucleotide_index(self, marker_id, marker_name, nucleotide_db_dir):
+        nucleotide_index = SequenceDatabase._nucleotide_nmslib_init()
 
-            for row in self.sqlalchemy_connection.execute(select(
-                NucleotideSequence.sequence, NucleotideSequence.marker_wise_id) \
-                .where(NucleotideSequence.marker_id == marker_row.id)):
+        logging.info("Tabulating unique nucleotide sequences for {}..".format(marker_name))
+        count = 0
 
-                nucleotide_index.addDataPoint(row.marker_wise_id, nucleotides_to_binary(row.sequence))
-                count += 1
+        for batch in self.sqlalchemy_connection.execute(select(
+            NucleotideSequence.sequence, NucleotideSequence.marker_wise_id) \
+            .where(NucleotideSequence.marker_id == marker_id) \
+            .execution_options(yield_per=ENCODING_BATCH_SIZE)).partitions(ENCODING_BATCH_SIZE):
+
+            nucleotide_index.addDataPointBatch(
+                nucleotides_to_binaries([row.sequence for row in batch]),
+                np.array([row.marker_wise_id for row in batch]))
+            count += len(batch)
 
-            # TODO: Tweak index creation parameters?
-            logging.info("Creating binary nucleotide index from {} unique sequences ..".format(count))
-            nucleotide_index.createIndex()
+        # TODO: Tweak index creation parameters?
+        logging.info("Creating binary nucleotide index from {} unique sequences ..".format(count))
+        nucleotide_index.createIndex()
 
-            logging.info("Writing index to disk ..")
-            nucleotide_db_path = os.path.join(nucleotide_db_dir, "%s.nmslib_index" % marker_name)
-            nucleotide_index.saveIndex(nucleotide_db_path, save_data=True)
-            logging.info("Finished writing index to disk")
+        logging.info("Writing index to disk ..")
+        nucleotide_db_path = os.path.join(nucleotide_db_dir, "%s.nmslib_index" % marker_name)
+        nucleotide_index.saveIndex(nucleotide_db_path, save_data=True)
+        logging.info("Finished writing index to disk")
 
-    def create_nmslib_protein_indexes(self):
+    def create_nmslib_protein_indexes(self, num_threads=DEFAULT_NUM_THREADS):
         logging.info("Creating nmslib protein sequence indices ..")
         protein_db_dir = os.path.join(self.base_directory, 'protein_indices_nmslib')
         os.makedirs(protein_db_dir)
-        for marker_row in self.sqlalchemy_connection.execute(select(Marker)):
-            protein_index = SequenceDatabase._protein_nmslib_init()
-
-            marker_name = marker_row.marker
-            logging.info("Tabulating unique protein sequences for {}..".format(marker_name))
-            count = 0
-
-            for row in self.sqlalchemy_connection.execute(select(
-                distinct(ProteinSequence.marker_wise_id), ProteinSequence.protein_sequence) \
-                    .where(ProteinSequence.id == NucleotidesProteins.protein_id) \
-                    .where(NucleotidesProteins.nucleotide_id == NucleotideSequence.id) \
-                    .where(NucleotideSequence.marker_id == marker_row.id)):
-                protein_index.addDataPoint(row.marker_wise_id, protein_to_binary(row.protein_sequence))
-                count += 1
-
-            # TODO: Tweak index creation parameters?
-            logging.info("Creating binary protein index from {} unique sequences ..".format(count))
-            protein_index.createIndex()
-
-            logging.info("Writing index to disk ..")
-            protein_db_path = os.path.join(protein_db_dir, "%s.nmslib_index" % marker_name)
-            protein_index.saveIndex(protein_db_path, save_data=True)
-            logging.info("Finished writing index to disk")
-
-    def create_annoy_nucleotide_indexes(self, ntrees):
+        self._create_indexes_per_marker('_create_nmslib_protein_index', (protein_db_dir,), num_threads)
+
+    def _create_nmslib_protein_index(self, marker_id, marker_name, protein_db_dir):
+        protein_index = SequenceDatabase._protein_nmslib_init()
+
+        logging.info("Tabulating unique protein sequences for {}..".format(marker_name))
+        count = 0
+
+        for batch in self.sqlalchemy_connection.execute(select(
+            distinct(ProteinSequence.marker_wise_id), ProteinSequence.protein_sequence) \
+                .where(ProteinSequence.id == NucleotidesProteins.protein_id) \
+                .where(NucleotidesProteins.nucleotide_id == NucleotideSequence.id) \
+                .where(NucleotideSequence.marker_id == marker_id) \
+                .execution_options(yield_per=ENCODING_BATCH_SIZE)).partitions(ENCODING_BATCH_SIZE):
+            protein_index.addDataPointBatch(
+                proteins_to_binaries([row.protein_sequence for row in batch]),
+                np.array([row.marker_wise_id for row in batch]))
+            count += len(batch)
+
+        # TODO: Tweak index creation parameters?
+        logging.info("Creating binary protein index from {} unique sequences ..".format(count))
+        protein_index.createIndex()
+
+        logging.info("Writing index to disk ..")
+        protein_db_path = os.path.join(protein_db_dir, "%s.nmslib_index" % marker_name)
+        protein_index.saveIndex(protein_db_path, save_data=True)
+        logging.info("Finished writing index to disk")
+
+    def create_annoy_nucleotide_indexes(self, ntrees, num_threads=DEFAULT_NUM_THREADS):
         logging.info("Creating annoy nucleotide sequence indices ..")
         nucleotide_db_dir = os.path.join(self.base_directory, 'nucleotide_indices_annoy')
         os.makedirs(nucleotide_db_dir)
+        self._create_indexes_per_marker('_create_annoy_nucleotide_index', (nucleotide_db_dir, ntrees), num_threads)
 
-        for marker_row in self.sqlalchemy_connection.execute(select(Marker)):
-            annoy_index = self._nucleotide_annoy_init()
+    def _create_annoy_nucleotide_index(self, marker_id, marker_name, nucleotide_db_dir, ntrees):
+        annoy_index = self._nucleotide_annoy_init()
 
-            marker_name = marker_row.marker
-            logging.info("Tabulating unique nucleotide sequences for {}..".format(marker_name))
-            count = 0
+        logging.info("Tabulating unique nucleotide sequences for {}..".format(marker_name))
+        count = 0
 
-            for row in self.sqlalchemy_connection.execute(select(
-                NucleotideSequence.sequence, NucleotideSequence.marker_wise_id) \
-                .where(NucleotideSequence.marker_id == marker_row.id)):
+        for batch in self.sqlalchemy_connection.execute(select(
+            NucleotideSequence.sequence, NucleotideSequence.marker_wise_id) \
+            .where(NucleotideSequence.marker_id == marker_id) \
+            .execution_options(yield_per=ENCODING_BATCH_SIZE)).partitions(ENCODING_BATCH_SIZE):
 
-                annoy_index.add_item(row.marker_wise_id, nucleotides_to_binary_array(row.sequence))
-                count += 1
+            encoded = nucleotides_to_binary_arrays([row.sequence for row in batch])
+            for row, vector in zip(batch, encoded):
+                annoy_index.add_item(row.marker_wise_id, vector.tolist())
+            count += len(batch)
 
-            # TODO: Tweak index creation parameters?
-            logging.info("Creating binary nucleotide index from {} unique sequences and ntrees={}..".format(count, ntrees))
-            annoy_index.build(ntrees)
+        # TODO: Tweak index creation parameters?
+        logging.info("Creating binary nucleotide index from {} unique sequences and ntrees={}..".format(count, ntrees))
+        annoy_index.build(ntrees)
 
-            logging.info("Writing index to disk ..")
-            annoy_index.save(os.path.join(nucleotide_db_dir, "%s.annoy_index" % marker_name))
-            logging.info("Finished writing index to disk")
-            # Delete immediately to save RAM (was using 200G+ before getting killed on big DB)
-            del annoy_index
+        logging.info("Writing index to disk ..")
+        annoy_index.save(os.path.join(nucleotide_db_dir, "%s.annoy_index" % marker_name))
+        logging.info("Finished writing index to disk")
+        # Delete immediately to save RAM (was using 200G+ before getting killed on big DB)
+        del annoy_index
 
-    def create_annoy_protein_indexes(self, ntrees):
+    def create_annoy_protein_indexes(self, ntrees, num_threads=DEFAULT_NUM_THREADS):
         logging.info("Creating annoy protein sequence indices ..")
         protein_db_dir = os.path.join(self.base_directory, 'protein_indices_annoy')
         os.makedirs(protein_db_dir)
+        self._create_indexes_per_marker('_create_annoy_protein_index', (protein_db_dir, ntrees), num_threads)
 
-        for marker_row in self.sqlalchemy_connection.execute(select(Marker)):
-            annoy_index = self._protein_annoy_init()
+    def _create_annoy_protein_index(self, marker_id, marker_name, protein_db_dir, ntrees):
+        annoy_index = self._protein_annoy_init()
 
-            marker_name = marker_row.marker
-            logging.info("Tabulating unique protein sequences for {}..".format(marker_name))
-            count = 0
+        logging.info("Tabulating unique protein sequences for {}..".format(marker_name))
+        count = 0
 
-            for row in self.sqlalchemy_connection.execute(select(
-                distinct(ProteinSequence.marker_wise_id), ProteinSequence.protein_sequence) \
-                    .where(ProteinSequence.id == NucleotidesProteins.protein_id) \
-                    .where(NucleotidesProteins.nucleotide_id == NucleotideSequence.id) \
-                    .where(NucleotideSequence.marker_id == marker_row.id)):
+        for batch in self.sqlalchemy_connection.execute(select(
+            distinct(ProteinSequence.marker_wise_id), ProteinSequence.protein_sequence) \
+                .where(ProteinSequence.id == NucleotidesProteins.protein_id) \
+                .where(NucleotidesProteins.nucleotide_id == NucleotideSequence.id) \
+                .where(NucleotideSequence.marker_id == marker_id) \
+                .execution_options(yield_per=ENCODING_BATCH_SIZE)).partitions(ENCODING_BATCH_SIZE):
 
-                annoy_index.add_item(row.marker_wise_id, protein_to_binary_array(row.protein_sequence))
-                count += 1
+            encoded = proteins_to_binary_arrays([row.protein_sequence for row in batch])
+            for row, vector in zip(batch, encoded):
+                annoy_index.add_item(row.marker_wise_id, vector.tolist())
+            count += len(batch)
 
-            # TODO: Tweak index creation parameters?
-            logging.info("Creating binary protein index from {} unique sequences and ntrees={}..".format(count, ntrees))
-            annoy_index.build(ntrees)
+        # TODO: Tweak index creation parameters?
+        logging.info("Creating binary protein index from {} unique sequences and ntrees={}..".format(count, ntrees))
+        annoy_index.build(ntrees)
 
-            logging.info("Writing index to disk ..")
-            annoy_index.save(os.path.join(protein_db_dir, "%s.annoy_index" % marker_name))
-            logging.info("Finished writing index to disk")
-            # Delete immediately to save RAM (was using 200G+ before getting killed on big DB)
-            del annoy_index
+        logging.info("Writing index to disk ..")
+        annoy_index.save(os.path.join(protein_db_dir, "%s.annoy_index" % marker_name))
+        logging.info("Finished writing index to disk")
+        # Delete immediately to save RAM (was using 200G+ before getting killed on big DB)
+        del annoy_index
 
-    def create_scann_indexes(self, sequence_database_types, generate_brute_force_index):
+    def create_scann_indexes(self, sequence_database_types, generate_brute_force_index, num_threads=DEFAULT_NUM_THREADS):
         logging.info("Creating scann sequence indices ..")
-        import tensorflow as tf
-        import scann # only load when needed to speed start-up
+        nucleotide_db_dirs = None
+        protein_db_dirs = None
         if NUCLEOTIDE_DATABASE_TYPE in sequence_database_types:
             nucleotide_db_dir_ah = os.path.join(self.base_directory, 'nucleotide_indices_scann')
             nucleotide_db_dir_brute_force = os.path.join(self.base_directory, 'nucleotide_indices_scann_brute_force')
             os.makedirs(nucleotide_db_dir_ah)
             if generate_brute_force_index:
                 os.makedirs(nucleotide_db_dir_brute_force)
+            nucleotide_db_dirs = (nucleotide_db_dir_ah, nucleotide_db_dir_brute_force)
         if PROTEIN_DATABASE_TYPE in sequence_database_types:
             protein_db_dir_ah = os.path.join(self.base_directory, 'protein_indices_scann')
             protein_db_dir_brute_force = os.path.join(self.base_directory, 'protein_indices_scann_brute_force')
             os.makedirs(protein_db_dir_ah)
             if generate_brute_force_index:
                 os.makedirs(protein_db_dir_brute_force)
+            protein_db_dirs = (protein_db_dir_ah, protein_db_dir_brute_force)
 
-        def generate_indices_from_array(a, db_dir_ah, db_dir_brute_force, generate_brute_force_index):
-            normalized_dataset = a / np.linalg.norm(a, axis=1)[:, np.newaxis]
-            logging.info("Found {} sequences for {}".format(a.shape[0], marker_name))
-            del a # not sure if this matters much
+        self._create_indexes_per_marker(
+            '_create_scann_index',
+            (nucleotide_db_dirs, protein_db_dirs, generate_brute_force_index),
+            num_threads)
 
-            logging.info("Creating SCANN AH index ..")
-            searcher = scann.scann_ops_pybind.builder(normalized_dataset, 10, "dot_product").tree(
-                num_leaves=round(np.sqrt(normalized_dataset.shape[0])), num_leaves_to_search=100, training_sample_size=250000).score_ah(
-                2, anisotropic_quantization_threshold=0.2).reorder(100).build()
-            directory = os.path.join(db_dir_ah, marker_name)
-            os.mkdir(directory)
-            searcher.serialize(directory)
-            del searcher
+    @staticmethod
+    def _generate_scann_indices_from_array(normalized_dataset, marker_name, db_dir_ah, db_dir_brute_force, generate_brute_force_index):
+        import tensorflow as tf
+        import scann # only load when needed to speed start-up
+
+        logging.info("Found {} sequences for {}".format(normalized_dataset.shape[0], marker_name))
+
+        logging.info("Creating SCANN AH index ..")
+        searcher = scann.scann_ops_pybind.builder(normalized_dataset, 10, "dot_product").tree(
+            num_leaves=round(np.sqrt(normalized_dataset.shape[0])), num_leaves_to_search=100, training_sample_size=250000).score_ah(
+            2, anisotropic_quantization_threshold=0.2).reorder(100).build()
+        directory = os.path.join(db_dir_ah, marker_name)
+        os.mkdir(directory)
+        searcher.serialize(directory)
+        del searcher
+
+        if generate_brute_force_index:
+            logging.info("Creating SCANN brute force index ..")
+            # use scann.scann_ops.build() to instead create a
+            # TensorFlow-compatible searcher could not work out how to
+            # deserialise a brute force without any doco, so just copying method
+            # from the tests i.e.
+            # https://github.com/google-research/google-research/blob/34444253e9f57cd03364bc4e50057a5abe9bcf17/scann/scann/scann_ops/py/scann_ops_test.py#L93
+            searcher_naive = scann.scann_ops.builder(normalized_dataset, 10, "dot_product").tree(
+                num_leaves=round(np.sqrt(normalized_dataset.shape[0])), num_leaves_to_search=100).score_brute_force(True).build()
+            directory = os.path.join(db_dir_brute_force, marker_name)
+            module = searcher_naive.serialize_to_module()
+            tf.saved_model.save(
+                module,
+                directory,
+                options=tf.saved_model.SaveOptions(namespace_whitelist=["Scann"]))
+            del searcher_naive
+
+    def _create_scann_index(self, marker_id, marker_name, nucleotide_db_dirs, protein_db_dirs, generate_brute_force_index):
+        if nucleotide_db_dirs is not None:
+            logging.info("Tabulating unique nucleotide sequences for {}..".format(marker_name))
+            normalized_dataset = self._scann_normalized_dataset(
+                select(NucleotideSequence.sequence) \
+                    .where(NucleotideSequence.marker_id == marker_id) \
+                    .order_by(NucleotideSequence.marker_wise_id),
+                nucleotides_to_binary_arrays, 'nucleotide')
+            SequenceDatabase._generate_scann_indices_from_array(normalized_dataset, marker_name, *nucleotide_db_dirs, generate_brute_force_index)
+            del normalized_dataset
+            logging.info("Finished writing nucleotide indices to disk")
+
+        if protein_db_dirs is not None:
+            logging.info("Tabulating unique protein sequences for {}..".format(marker_name))
+            normalized_dataset = self._scann_normalized_dataset(
+                select(ProteinSequence.protein_sequence) \
+                    .order_by(ProteinSequence.marker_wise_id) \
+                    .where(ProteinSequence.id == NucleotidesProteins.protein_id) \
+                    .where(NucleotidesProteins.nucleotide_id == NucleotideSequence.id) \
+                    .where(NucleotideSequence.marker_id == marker_id)
+                    .distinct(),
+                proteins_to_binary_arrays, 'protein')
+            SequenceDatabase._generate_scann_indices_from_array(normalized_dataset, marker_name, *protein_db_dirs, generate_brute_force_index)
+            del normalized_dataset
+            logging.info("Finished writing protein indices to disk")
+
+    def _scann_normalized_dataset(self, sequence_query, encoder, sequence_type):
+        '''Return a float32 matrix of the one-hot encoded sequences returned by
+        sequence_query, with each row scaled to unit length. The matrix is
+        allocated at its final size and filled one batch at a time, so only a
+        single copy of the dataset is held in memory.
+
+        SCANN requires at least 16 datapoints, so if there are fewer sequences
+        than that the matrix is padded with (normalised) rows of ones.
+
+        Parameters
+        ----------
+        sequence_query: sqlalchemy Select
+            query returning one sequence per row, in marker_wise_id order
+        encoder: function
+            nucleotides_to_binary_arrays or proteins_to_binary_arrays
+        sequence_type: str
+            'nucleotide' or 'protein', for logging
+        '''
+        num_sequences = self.sqlalchemy_connection.execute(
+            select(func.count()).select_from(sequence_query.subquery())).scalar()
+        if num_sequences == 0:
+            raise Exception("No {} sequences found to create SCANN index from".format(sequence_type))
+        num_rows = max(num_sequences, 16)
+
+        dataset = None
+        start = 0
+        for batch in self.sqlalchemy_connection.execute(
+            sequence_query.execution_options(yield_per=ENCODING_BATCH_SIZE)).partitions(ENCODING_BATCH_SIZE):
+
+            encoded = encoder([row[0] for row in batch])
+            if dataset is None:
+                dataset = np.empty((num_rows, encoded.shape[1]), dtype=np.float32)
+            end = start + encoded.shape[0]
+            dataset[start:end] = encoded
+            start = end
+        if start != num_sequences:
+            raise Exception("Unexpectedly found {} {} sequences when {} were expected".format(
+                start, sequence_type, num_sequences))
+
+        if num_sequences < 16:
+            logging.warning("Adding dummy {} sequences to SCANN AH/NAIVE DB creation since the number of real datapoints is too small".format(sequence_type))
+            dataset[num_sequences:] = 1
+
+        # Normalise in place, in batches to avoid a full size temporary
+        for i in range(0, num_rows, ENCODING_BATCH_SIZE):
+            chunk = dataset[i:i+ENCODING_BATCH_SIZE]
+            chunk /= np.linalg.norm(chunk, axis=1)[:, np.newaxis]
+        return dataset
 
-            if generate_brute_force_index:
-                logging.info("Creating SCANN brute force index ..")
-                # use scann.scann_ops.build() to instead create a
-                # TensorFlow-compatible searcher could not work out how to
-                # deserialise a brute force without any doco, so just copying method
-                # from the tests i.e.
-                # https://github.com/google-research/google-research/blob/34444253e9f57cd03364bc4e50057a5abe9bcf17/scann/scann/scann_ops/py/scann_ops_test.py#L93
-                searcher_naive = scann.scann_ops.builder(normalized_dataset, 10, "dot_product").tree(
-                    num_leaves=round(np.sqrt(normalized_dataset.shape[0])), num_leaves_to_search=100).score_brute_force(True).build()
-                directory = os.path.join(db_dir_brute_force, marker_name)
-                module = searcher_naive.serialize_to_module()
-                tf.saved_model.save(
-                    module,
-                    directory,
-                    options=tf.saved_model.SaveOptions(namespace_whitelist=["Scann"]))
-                del searcher_naive
-
-        for marker_row in self.sqlalchemy_connection.execute(select(Marker)):
-            marker_name = marker_row.marker
-            marker_id = marker_row.id
-            
-            if NUCLEOTIDE_DATABASE_TYPE in sequence_database_types:
-                logging.info("Tabulating unique nucleotide sequences for {}..".format(marker_name))
-                a = np.concatenate([np.array([nucleotides_to_binary_array(entry.sequence)]) for entry in \
-                    self.sqlalchemy_connection.execute(select(
-                        NucleotideSequence.sequence) \
-                        .where(NucleotideSequence.marker_id == marker_id) \
-                        .order_by(NucleotideSequence.marker_wise_id))
-                ])
-                if a.shape[0] < 16:
-                    logging.warning("Adding dummy nucleotide sequences to SCANN AH/NAIVE DB creation since the number of real datapoints is too small")
-                    a = np.concatenate([a, np.ones((16-a.shape[0], a.shape[1]))])
-                generate_indices_from_array(a, nucleotide_db_dir_ah, nucleotide_db_dir_brute_force, generate_brute_force_index)
-                logging.info("Finished writing nucleotide indices to disk")
-            
-            if PROTEIN_DATABASE_TYPE in sequence_database_types:
-                logging.info("Tabulating unique protein sequences for {}..".format(marker_name))
-                a = np.concatenate([np.array([protein_to_binary_array(entry.protein_sequence)]) for entry in \
-                    self.sqlalchemy_connection.execute(select(
-                        ProteinSequence.protein_sequence) \
-                            .order_by(ProteinSequence.marker_wise_id) \
-                            .where(ProteinSequence.id == NucleotidesProteins.protein_id) \
-                            .where(NucleotidesProteins.nucleotide_id == NucleotideSequence.id) \
-                            .where(NucleotideSequence.marker_id == marker_id)
-                            .distinct())
-                ])
-                if a.shape[0] < 16:
-                    logging.warn("Adding dummy protein sequences to SCANN AH/NAIVE DB creation since the number of real datapoints is too small")
-                    a = np.concatenate([a, np.ones((16-a.shape[0], a.shape[1]))])
-                generate_indices_from_array(a, protein_db_dir_ah, protein_db_dir_brute_force, generate_brute_force_index)
-                del a
-                logging.info("Finished writing protein indices to disk")
-
-    
     @staticmethod
     def dump(db_path):
         """Dump the DB contents to STDOUT, requiring a version 5+ database"""
@@ -880,36 +974,6 @@ class SequenceDatabase:
                         taxonomy_entries[row.taxonomy_id]
                     ]))
 
-def _base_to_binary(x):
-    if x == 'A':
-        return '1 0 0 0 0'
-    elif x == 'T':
-        return '0 1 0 0 0'
-    elif x == 'C':
-        return '0 0 1 0 0'
-    elif x == 'G':
-        return '0 0 0 1 0'
-    else:
-        return '0 0 0 0 1'
-    
-def nucleotides_to_binary(seq):
-    return ' '.join([_base_to_binary(b) for b in seq])
-    
-def _base_to_binary_array(x):
-    if x == 'A':
-        return [1,0,0,0,0]
-    elif x == 'T':
-        return [0,1,0,0,0]
-    elif x == 'C':
-        return [0,0,1,0,0]
-    elif x == 'G':
-        return [0,0,0,1,0]
-    else:
-        return [0,0,0,0,1]
-    
-def nucleotides_to_binary_array(seq):
-    return list(itertools.chain(*[_base_to_binary_array(b) for b in seq]))
-
 AA_ORDER = ['W',
         'H',
         'Q',
@@ -934,17 +998,121 @@ AA_ORDER = ['W',
         '-',
         'X']
 
-def _aa_to_binary(x):
-    return ' '.join(['1' if aa == x else '0' for aa in AA_ORDER])
+# Per-process SequenceDatabase used when creating indices in parallel, set up
+# by _init_index_worker
+_index_worker_sdb = None
+
+def _init_index_worker(base_directory, sqlite_file):
+    global _index_worker_sdb
+    sdb = SequenceDatabase()
+    sdb.base_directory = base_directory
+    sdb.sqlite_file = sqlite_file
+    # Each worker gets its own read-only connection, since SQLite connections
+    # cannot be shared across processes.
+    uri = 'file:{}?mode=ro'.format(urllib.parse.quote(os.path.abspath(sqlite_file)))
+    sdb.engine = create_engine("sqlite://", creator=lambda: sqlite3.connect(uri, uri=True))
+    sdb.sqlalchemy_connection = sdb.engine.connect()
+    _index_worker_sdb = sdb
+
+def _create_index_in_worker(args):
+    method_name, marker_id, marker_name, method_args = args
+    getattr(_index_worker_sdb, method_name)(marker_id, marker_name, *method_args)
+    return marker_name
+
+def _one_hot_lookup_tables(alphabet, other_index):
+    '''Return lookup tables indexed by byte value for one-hot encoding
+    sequences, so that whole sequences (or arrays of sequences) can be encoded
+    with numpy indexing rather than character by character.
+
+    Parameters
+    ----------
+    alphabet: list of str
+        characters, in the order of their one-hot positions
+    other_index: int or None
+        position set for characters not in the alphabet, or None to encode
+        those characters as all zeros.
+
+    Returns
+    -------
+    tuple of 2 numpy uint8 arrays: the binary table with shape (256,
+    num_positions), and the text table (256, 2*num_positions) containing the
+    ASCII encoding of each binary row followed by a space e.g. '1 0 0 0 0 '.
+    '''
+    num_positions = len(alphabet) if other_index is None else max(len(alphabet), other_index+1)
+    binary = np.zeros((256, num_positions), dtype=np.uint8)
+    if other_index is not None:
+        binary[:, other_index] = 1
+    for i, c in enumerate(alphabet):
+        binary[ord(c), :] = 0
+        binary[ord(c), i] = 1
+    text = np.full((256, 2*num_positions), ord(' '), dtype=np.uint8)
+    text[:, 0::2] = binary + ord('0')
+    return binary, text
+
+_NUCLEOTIDE_BINARY_TABLE, _NUCLEOTIDE_TEXT_TABLE = _one_hot_lookup_tables(['A','T','C','G'], 4)
+_PROTEIN_BINARY_TABLE, _PROTEIN_TEXT_TABLE = _one_hot_lookup_tables(AA_ORDER, None)
+
+def _sequence_to_codes(seq):
+    return np.frombuffer(seq.encode('latin-1'), dtype=np.uint8)
+
+def _sequences_to_codes(seqs):
+    '''Return a 2D array of byte values, one row per sequence. All sequences
+    must be the same length.'''
+    if len(seqs) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    seq_length = len(seqs[0])
+    for seq in seqs:
+        if len(seq) != seq_length:
+            raise Exception("Sequences to be encoded must all be the same length, found {} and {}".format(
+                seqs[0], seq))
+    return _sequence_to_codes(''.join(seqs)).reshape(len(seqs), seq_length)
+
+def _encode_text(codes, text_table):
+    # Drop the trailing space after the last position
+    return text_table[codes].tobytes()[:-1].decode()
+
+def _encode_texts(seqs, text_table):
+    codes = _sequences_to_codes(seqs)
+    texts = text_table[codes].reshape(codes.shape[0], -1)
+    return list([row.tobytes()[:-1].decode() for row in texts])
+
+def _encode_arrays(seqs, binary_table):
+    codes = _sequences_to_codes(seqs)
+    return binary_table[codes].reshape(codes.shape[0], -1)
+
+def nucleotides_to_binary(seq):
+    return _encode_text(_sequence_to_codes(seq), _NUCLEOTIDE_TEXT_TABLE)
+
+def nucleotides_to_binary_array(seq):
+    return _NUCLEOTIDE_BINARY_TABLE[_sequence_to_codes(seq)].ravel().tolist()
+
+def nucleotides_to_binaries(seqs):
+    '''Return a list of nucleotides_to_binary() strings, one for each of the
+    given equal length sequences.'''
+    return _encode_texts(seqs, _NUCLEOTIDE_TEXT_TABLE)
+
+def nucleotides_to_binary_arrays(seqs):
+    '''Return a 2D numpy uint8 array where each row is the
+    nucleotides_to_binary_array() encoding of each of the given equal length
+    sequences.'''
+    return _encode_arrays(seqs, _NUCLEOTIDE_BINARY_TABLE)
 
 def protein_to_binary(seq):
-    return ' '.join([_aa_to_binary(b) for b in seq])
-    
-def _aa_to_binary_array(x):
-    return list([1 if aa == x else 0 for aa in AA_ORDER])
+    return _encode_text(_sequence_to_codes(seq), _PROTEIN_TEXT_TABLE)
 
 def protein_to_binary_array(seq):
-    return list(itertools.chain(*[_aa_to_binary_array(b) for b in seq]))
+    return _PROTEIN_BINARY_TABLE[_sequence_to_codes(seq)].ravel().tolist()
+
+def proteins_to_binaries(seqs):
+    '''Return a list of protein_to_binary() strings, one for each of the
+    given equal length sequences.'''
+    return _encode_texts(seqs, _PROTEIN_TEXT_TABLE)
+
+def proteins_to_binary_arrays(seqs):
+    '''Return a 2D numpy uint8 array where each row is the
+    protein_to_binary_array() encoding of each of the given equal length
+    sequences.'''
+    return _encode_arrays(seqs, _PROTEIN_BINARY_TABLE)
 
 def nucleotides_to_protein(seq):
     aas = []
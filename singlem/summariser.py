@@ -13,6 +13,7 @@ from .otu_table import OtuTable
 from .rarefier import Rarefier
 from .ordered_set import OrderedSet
 from .archive_otu_table import ArchiveOtuTable
+from .columnar_otu_table import ColumnarOtuTable
 
 class Summariser:
     @staticmethod
@@ -165,6 +166,28 @@ class Summariser:
         else:
             OtuTable.write_otus_to(table_collection, output_table_io)
 
+    @staticmethod
+    def write_columnar_otu_table(**kwargs):
+        output_path = kwargs.pop('output_path')
+        table_collection = kwargs.pop('table_collection')
+        output_extras = kwargs.pop('output_extras')
+        if len(kwargs) > 0:
+            raise Exception("Unexpected arguments detected: %s" % kwargs)
+
+        logging.info("Writing columnar OTU table %s" % output_path)
+        archive_header = None
+        if output_extras:
+            # When all the inputs are archive tables, write an archive table,
+            # so that it can be used as input to e.g. condense.
+            archive_header = table_collection.archive_header()
+            if archive_header is not None:
+                fields = archive_header['fields']
+            else:
+                fields = table_collection.example_field_names()
+        else:
+            fields = OtuTable.DEFAULT_OUTPUT_FIELDS
+        ColumnarOtuTable.write(table_collection, fields, output_path, archive_header=archive_header)
+
     @staticmethod
     def write_wide_format_otu_table(**kwargs):
         output_table_io = kwargs.pop('output_table_io')
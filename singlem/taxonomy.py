@@ -10,7 +10,139 @@ NO_ASSIGNMENT_METHOD = 'no_assign_taxonomy'
 
 QUERY_BASED_ASSIGNMENT_METHOD = 'singlem_query_based'
 
+class TaxonomyTree:
+    '''Taxonomies interned as integer node IDs in a tree of taxons, so that
+    LCAs and truncations can be calculated from the parent and depth of each
+    node rather than by splitting and joining taxonomy strings. Taxonomies are
+    added to the tree as they are first seen, and each taxonomy string is only
+    split once, so repeated strings e.g. equal best hits shared by many reads
+    are cheap.
+
+    Node ROOT corresponds to the empty taxonomy.'''
+
+    ROOT = 0
+    # Number of LCAs of pairs of nodes remembered
+    LCA_CACHE_SIZE = 1000000
+
+    def __init__(self):
+        self._parents = [None]
+        self._depths = [0]
+        self._taxons = [None]
+        self._children = [{}]
+        # Taxonomy of each node, joined with '; '
+        self._taxonomy_strings = ['']
+        self._string_to_node = {}
+        self._lca_cache = {}
+
+    def __len__(self):
+        return len(self._parents)
+
+    def node(self, taxon_list):
+        '''Return the node ID of a taxonomy given as a list of taxons, adding
+        it to the tree if necessary'''
+        node = self.ROOT
+        for taxon in taxon_list:
+            try:
+                node = self._children[node][taxon]
+            except KeyError:
+                child = len(self._parents)
+                self._parents.append(node)
+                self._depths.append(self._depths[node] + 1)
+                self._taxons.append(taxon)
+                self._children.append({})
+                self._taxonomy_strings.append(
+                    taxon if node == self.ROOT else self._taxonomy_strings[node] + '; ' + taxon)
+                self._children[node][taxon] = child
+                node = child
+        return node
+
+    def node_of_string(self, taxonomy_string):
+        '''Return the node ID of a taxonomy string, where taxons are separated
+        by ';' and empty taxons are ignored'''
+        try:
+            return self._string_to_node[taxonomy_string]
+        except KeyError:
+            node = self.node([t for t in (t.strip() for t in taxonomy_string.split(';')) if t != ''])
+            self._string_to_node[taxonomy_string] = node
+            return node
+
+    def parent(self, node):
+        return self._parents[node]
+
+    def depth(self, node):
+        return self._depths[node]
+
+    def taxonomy_string(self, node):
+        '''Return the taxonomy of the node, with taxons joined by '; ' '''
+        return self._taxonomy_strings[node]
+
+    def taxon_list(self, node):
+        '''Return the taxonomy of the node as a list of taxons'''
+        taxons = []
+        while node != self.ROOT:
+            taxons.append(self._taxons[node])
+            node = self._parents[node]
+        return list(reversed(taxons))
+
+    def truncate(self, node, depth):
+        '''Return the ancestor of the node at the given depth, or the node
+        itself if it is not that deep'''
+        parents = self._parents
+        for _ in range(self._depths[node] - depth):
+            node = parents[node]
+        return node
+
+    def lca(self, node1, node2):
+        '''Return the lowest common ancestor of 2 nodes'''
+        if node1 == node2:
+            return node1
+        key = (node1, node2) if node1 < node2 else (node2, node1)
+        try:
+            return self._lca_cache[key]
+        except KeyError:
+            pass
+
+        depths = self._depths
+        parents = self._parents
+        a, b = key
+        while depths[a] > depths[b]:
+            a = parents[a]
+        while depths[b] > depths[a]:
+            b = parents[b]
+        while a != b:
+            a = parents[a]
+            b = parents[b]
+
+        if len(self._lca_cache) >= self.LCA_CACHE_SIZE:
+            self._lca_cache.clear()
+        self._lca_cache[key] = a
+        return a
+
+    def lca_of_nodes(self, nodes):
+        '''Return the lowest common ancestor of an iterable of nodes'''
+        nodes = iter(nodes)
+        try:
+            lca = next(nodes)
+        except StopIteration:
+            raise Exception("Cannot calculate the LCA of no taxonomies")
+        for node in nodes:
+            if lca == self.ROOT:
+                break
+            lca = self.lca(lca, node)
+        return lca
+
+
 class TaxonomyUtils:
+    # Shared by all callers in this process, see taxonomy_tree()
+    _taxonomy_tree = None
+
+    @staticmethod
+    def taxonomy_tree():
+        '''Return the TaxonomyTree shared within this process'''
+        if TaxonomyUtils._taxonomy_tree is None:
+            TaxonomyUtils._taxonomy_tree = TaxonomyTree()
+        return TaxonomyUtils._taxonomy_tree
+
     @staticmethod
     def split_taxonomy(taxonomy_string):
         if taxonomy_string:
@@ -23,17 +155,12 @@ class TaxonomyUtils:
 
     @staticmethod
     def lca_taxonomy_of_strings(taxonomy_strings):
-        hit_taxonomies = list([list([ta.strip() for ta in t.split(';') if ta.strip() != '']) for t in taxonomy_strings])
-        return TaxonomyUtils.lca_taxonomy_of_taxon_lists(hit_taxonomies)
+        tree = TaxonomyUtils.taxonomy_tree()
+        return tree.taxonomy_string(tree.lca_of_nodes(
+            [tree.node_of_string(t) for t in taxonomy_strings]))
 
     @staticmethod
     def lca_taxonomy_of_taxon_lists(taxonomy_lists):
-        lca = taxonomy_lists[0]
-        for taxonomy in taxonomy_lists[1:]:
-            if len(taxonomy) < len(lca):
-                lca = lca[:len(taxonomy)]
-            for i, tax in enumerate(taxonomy):
-                if i >= len(lca) or tax != lca[i]:
-                    lca = lca[:i]
-                    break
-        return '; '.join(lca)
+        tree = TaxonomyUtils.taxonomy_tree()
+        return tree.taxonomy_string(tree.lca_of_nodes(
+            [tree.node(t) for t in taxonomy_lists]))
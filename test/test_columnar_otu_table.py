@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+import json
+import tempfile
+import logging
+from io import StringIO
+import extern
+
+path_to_script = os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','bin','singlem')
+path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.otu_table import OtuTable
+from singlem.archive_otu_table import ArchiveOtuTable, ArchiveOtuTableEntry, InsufficientArchiveOtuTableVersionException
+from singlem.columnar_otu_table import ColumnarOtuTable
+from singlem.otu_table_entry import OtuTableEntry
+from singlem.otu_table_collection import OtuTableCollection, StreamingOtuTableCollection
+
+class Tests(unittest.TestCase):
+    with open(os.path.join(path_to_data, 'otu_table_formats', 'otu_table.csv')) as f:
+        otu_table = f.read()
+    with open(os.path.join(path_to_data, 'otu_table_formats', 'archive_otu_table.json')) as f:
+        archive = json.load(f)
+
+    def test_otu_table_round_trip(self):
+        otus = OtuTable.read(StringIO(self.otu_table))
+        with tempfile.NamedTemporaryFile(suffix='.otu_table.columnar') as f:
+            otus.write_columnar(f.name)
+            otus2 = OtuTable.read_columnar(f.name)
+            self.assertEqual(otus.fields, otus2.fields)
+            self.assertEqual(otus.data, otus2.data)
+            self.assertFalse(ColumnarOtuTable(f.name).is_archive())
+            self.assertEqual(4, len(ColumnarOtuTable(f.name)))
+
+    def test_archive_otu_table_round_trip(self):
+        archive = ArchiveOtuTable.read(StringIO(json.dumps(self.archive)))
+        with tempfile.NamedTemporaryFile(suffix='.otu_table.columnar') as f:
+            archive.write_columnar(f.name)
+            archive2 = ArchiveOtuTable.read_columnar(f.name)
+            self.assertEqual(self.archive['otus'], archive2.data)
+            self.assertEqual(4, archive2.version)
+            self.assertEqual(['a'], archive2.alignment_hmm_sha256s)
+            self.assertEqual(['b'], archive2.singlem_package_sha256s)
+            e = list(archive2)[0]
+            self.assertIsInstance(e, ArchiveOtuTableEntry)
+            self.assertEqual(['r1','r2'], e.read_names())
+            self.assertEqual('diamond', e.taxonomy_assignment_method())
+
+            with self.assertRaises(InsufficientArchiveOtuTableVersionException):
+                ArchiveOtuTable.read_columnar(f.name, min_version=5)
+
+    def test_sample_and_marker_filters(self):
+        otus = OtuTable.read(StringIO(self.otu_table))
+        with tempfile.NamedTemporaryFile(suffix='.otu_table.columnar') as f:
+            # Small row groups so that whole groups are skipped
+            ColumnarOtuTable.write(otus, otus.fields, f.name, row_group_size=2)
+            columnar = ColumnarOtuTable(f.name)
+            self.assertEqual(
+                [['gene1','sample2','CCT',5,10.25,'Root; d__Bacteria'],
+                 ['gene2','sample3','TTA',3,6.0,'']],
+                list(columnar.each_data(samples=['sample2','sample3'])))
+            self.assertEqual(
+                ['AAT','CCT'],
+                [e.sequence for e in columnar.each(markers=['gene1'])])
+            self.assertEqual(
+                ['GGT'],
+                [e.sequence for e in columnar.each(samples=['sample1'], markers=['gene2'])])
+            self.assertEqual([], list(columnar.each(samples=['nonexistent'])))
+
+    def test_write_subset_of_fields(self):
+        archive = ArchiveOtuTable.read(StringIO(json.dumps(self.archive)))
+        with tempfile.NamedTemporaryFile(suffix='.otu_table.columnar') as f:
+            ColumnarOtuTable.write(archive, OtuTable.DEFAULT_OUTPUT_FIELDS, f.name)
+            otus = OtuTable.read_columnar(f.name)
+            self.assertEqual(OtuTable.DEFAULT_OUTPUT_FIELDS, otus.fields)
+            self.assertEqual([d[:6] for d in self.archive['otus']], otus.data)
+
+    def test_write_entries_without_fields(self):
+        # Entries generated e.g. by condense or query have no fields set
+        entries = []
+        for d in OtuTable.read(StringIO(self.otu_table)).data:
+            e = OtuTableEntry()
+            e.data = d
+            entries.append(e)
+        with tempfile.NamedTemporaryFile(suffix='.otu_table.columnar') as f:
+            ColumnarOtuTable.write(entries, OtuTable.DEFAULT_OUTPUT_FIELDS, f.name)
+            self.assertEqual(
+                [e.data for e in entries],
+                OtuTable.read_columnar(f.name).data)
+
+    def test_collections(self):
+        archive = ArchiveOtuTable.read(StringIO(json.dumps(self.archive)))
+        otus = OtuTable.read(StringIO(self.otu_table))
+        with tempfile.NamedTemporaryFile(suffix='.otu_table.columnar') as f1:
+            with tempfile.NamedTemporaryFile(suffix='.otu_table.columnar') as f2:
+                archive.write_columnar(f1.name)
+                otus.write_columnar(f2.name)
+
+                streaming = StreamingOtuTableCollection()
+                streaming.add_columnar_otu_table_file(f1.name)
+                streaming.add_columnar_otu_table_file(f2.name)
+                self.assertEqual(
+                    self.archive['otus'] + otus.data,
+                    [e.data for e in streaming])
+
+                streaming = StreamingOtuTableCollection()
+                streaming.add_columnar_otu_table_file(f1.name)
+                streaming.sample_names = ['sample2']
+                samples = list(streaming.each_sample_otus(generate_archive_otu_table=True))
+                self.assertEqual(['sample2'], [s for (s, _) in samples])
+                self.assertEqual(self.archive['otus'][1:3], samples[0][1].data)
+
+                collection = OtuTableCollection()
+                collection.add_columnar_otu_table(f1.name)
+                collection.add_columnar_otu_table(f2.name)
+                self.assertEqual(1, len(collection.archive_table_objects))
+                self.assertEqual(1, len(collection.otu_table_objects))
+                self.assertEqual(8, len(list(collection)))
+
+    def test_summarise_columnar_then_condense(self):
+        archive = os.path.join(path_to_data, 'condense', '4.11.22seqs.diamond_assigned.json')
+        metapackage = os.path.join(path_to_data, '4.11.22seqs.gpkg.spkg.smpkg')
+        with tempfile.TemporaryDirectory() as d:
+            extern.run("{} summarise --input-archive-otu-tables {} --output-columnar-otu-table {}/archive.columnar --output-extras".format(
+                path_to_script, archive, d))
+            self.assertTrue(ColumnarOtuTable(os.path.join(d, 'archive.columnar')).is_archive())
+
+            expected = extern.run("{} condense --input-archive-otu-tables {} --metapackage {} -p /dev/stdout".format(
+                path_to_script, archive, metapackage))
+            self.assertEqual(4, len(expected.splitlines()))
+            observed = extern.run("{} condense --input-columnar-otu-tables {}/archive.columnar --metapackage {} -p /dev/stdout".format(
+                path_to_script, d, metapackage))
+            self.assertEqual(expected, observed)
+
+            # Streamed inputs and sample selection
+            extern.run("{} summarise --stream-inputs --input-archive-otu-tables {} --sample-names sample2 --output-columnar-otu-table {}/sample2.columnar --output-extras".format(
+                path_to_script, archive, d))
+            observed = extern.run("{} condense --input-columnar-otu-tables {}/sample2.columnar --metapackage {} -p /dev/stdout".format(
+                path_to_script, d, metapackage))
+            self.assertEqual(expected.splitlines()[:1] + expected.splitlines()[2:3], observed.splitlines())
+
+    def test_summarise_columnar_without_extras(self):
+        archive = os.path.join(path_to_data, 'condense', '4.11.22seqs.diamond_assigned.json')
+        with tempfile.TemporaryDirectory() as d:
+            extern.run("{} summarise --input-archive-otu-tables {} --output-columnar-otu-table {}/otus.columnar".format(
+                path_to_script, archive, d))
+            self.assertFalse(ColumnarOtuTable(os.path.join(d, 'otus.columnar')).is_archive())
+
+            expected = extern.run("{} summarise --input-archive-otu-tables {} --output-otu-table /dev/stdout".format(
+                path_to_script, archive))
+            observed = extern.run("{} summarise --input-columnar-otu-tables {}/otus.columnar --output-otu-table /dev/stdout".format(
+                path_to_script, d))
+            self.assertEqual(expected, observed)
+
+    def test_makedb_columnar(self):
+        otu_table = os.path.join(path_to_data, 'methanobacteria', 'otus.transcripts.on_target.csv')
+        with tempfile.TemporaryDirectory() as d:
+            extern.run("{} summarise --input-otu-tables {} --output-columnar-otu-table {}/otus.columnar".format(
+                path_to_script, otu_table, d))
+            extern.run("{} makedb --db {}/db --otu-table {} --sequence-database-methods none".format(
+                path_to_script, d, otu_table))
+            extern.run("{} makedb --db {}/columnar_db --columnar-otu-tables {}/otus.columnar --sequence-database-methods none".format(
+                path_to_script, d, d))
+
+            with open(otu_table) as f:
+                samples = sorted(set(line.split('\t')[1] for line in list(f)[1:]))
+            cmd = "{} query --db {{}} --sample-names {}".format(path_to_script, ' '.join(samples[:3]))
+            expected = extern.run(cmd.format(os.path.join(d, 'db')))
+            self.assertTrue(len(expected.splitlines()) > 3)
+            self.assertEqual(expected, extern.run(cmd.format(os.path.join(d, 'columnar_db'))))
+
+    def test_query_columnar(self):
+        otu_table = os.path.join(path_to_data, 'methanobacteria', 'otus.transcripts.on_target.csv')
+        query_otu_table = os.path.join(path_to_data, 'methanobacteria', 'otus.transcripts.on_target.3random.csv')
+        with tempfile.TemporaryDirectory() as d:
+            extern.run("{} summarise --input-otu-tables {} --output-columnar-otu-table {}/query.columnar".format(
+                path_to_script, query_otu_table, d))
+            extern.run("{} makedb --db {}/db --otu-table {}".format(path_to_script, d, otu_table))
+
+            expected = extern.run("{} query --query-otu-table {} --db {}/db".format(
+                path_to_script, query_otu_table, d))
+            observed = extern.run("{} query --query-columnar-otu-tables {}/query.columnar --db {}/db".format(
+                path_to_script, d, d))
+            self.assertEqual(expected, observed)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    unittest.main()
@@ -24,12 +24,14 @@
 import unittest
 import os.path
 import sys
+import tempfile
 import extern
 
 sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
 from singlem.otu_table import OtuTable
 from singlem.condense  import Condenser
 from singlem.archive_otu_table import ArchiveOtuTable
+from singlem.otu_table_collection import StreamingOtuTableCollection
 from singlem.pipe import QUERY_BASED_ASSIGNMENT_METHOD
 
 path_to_script = os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','bin','singlem')
@@ -251,6 +253,30 @@ class Tests(unittest.TestCase):
                 ).data
         )
 
+    def test_condense_threads(self):
+        archive = os.path.join(path_to_data, '4.11.22seqs.diamond_assigned.json')
+        metapackage = os.path.join(path_to_data, '..', '4.11.22seqs.gpkg.spkg.smpkg')
+        profiles = []
+        with tempfile.TemporaryDirectory() as d:
+            for threads in (1, 2, 3):
+                otus = StreamingOtuTableCollection()
+                otus.add_archive_otu_table_file(archive)
+                output = os.path.join(d, 'profile{}.tsv'.format(threads))
+                Condenser().condense(
+                    input_streaming_otu_table=otus,
+                    metapackage_path=metapackage,
+                    output_otu_table=output,
+                    krona=None,
+                    threads=threads)
+                with open(output) as f:
+                    profiles.append(f.read())
+
+        self.assertEqual(
+            ['sample', 'sample1', 'sample2', 'sample3'],
+            [line.split('\t')[0] for line in profiles[0].splitlines()])
+        self.assertEqual(profiles[0], profiles[1])
+        self.assertEqual(profiles[0], profiles[2])
+
 if __name__ == "__main__":
     import logging
     # logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s: %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
@@ -27,12 +27,17 @@ import tempfile
 import extern
 import sys
 import re
+import shutil
 
 path_to_script = os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','bin','singlem')
 path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
 
 sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
 
+from singlem.otu_table import OtuTable
+from singlem.querier import Querier
+from singlem.sequence_database import SequenceDatabase
+
 TEST_NMSLIB = False
 try:
     import nmslib
@@ -122,6 +127,59 @@ class Tests(unittest.TestCase):
                 self.assertEqual(observed.split("\n")[0], "\t".join(self.query_result_headers))
                 self.assertTrue('GB_GCA_000309865.1_protein	CAGACTGAAATATTCATGGACAACATGCGAATGTTCCTTAAAGAAGAGGGCCAGGGGATG	0	1	1.1	GB_GCA_000309865.1_protein	S3.32.Fibrillarin	CAGACTGAAATATTCATGGACAACATGCGAATGTTCCTTAAAGAAGAGGGCCAGGGGATG	Root; d__Archaea; p__Methanobacteriota; c__Methanobacteria; o__Methanobacteriales; f__Methanobacteriaceae; g__Methanobacterium; s__Methanobacterium sp000309865\n' in observed)
 
+    def test_query_with_queries_otu_table_entries(self):
+        # appraise queries with OtuTableEntry objects, and relies on the hits
+        # referring to those same objects
+        with tempfile.TemporaryDirectory() as d:
+            extern.run("%s makedb --db %s/db --otu-table %s/methanobacteria/otus.transcripts.on_target.csv --sequence-database-methods smafa-naive" % (
+                path_to_script, d, path_to_data))
+            sdb = SequenceDatabase.acquire(os.path.join(d, 'db'))
+
+            with open(os.path.join(path_to_data, 'methanobacteria', 'otus.transcripts.on_target.3random.csv')) as f:
+                queries = list(OtuTable.read(f))
+            for q in queries:
+                # Introduce a mismatch so the hits are not found by sqlite
+                q.sequence = ('C' if q.sequence[0] != 'C' else 'A') + q.sequence[1:]
+                q.sample_name = 'query_' + q.sample_name
+            queries = sorted(queries, key=lambda q: q.marker)
+
+            hits = list(Querier().query_with_queries(
+                queries, sdb, 3, 'smafa-naive', SequenceDatabase.NUCLEOTIDE_TYPE, 1, None, False, None))
+            self.assertEqual(len(queries), len(set(id(hit.query) for hit in hits)))
+            for hit in hits:
+                self.assertTrue(any(hit.query is q for q in queries))
+                self.assertTrue(1 <= hit.divergence <= 3)
+
+    def test_makedb_threads(self):
+        with tempfile.TemporaryDirectory() as d:
+            methods = ['smafa-naive']
+            if TEST_NMSLIB:
+                methods.append('nmslib')
+            if TEST_ANNOY:
+                methods.append('annoy')
+            index_files = {}
+            for threads in [1, 2]:
+                db = os.path.join(d, 'db%i' % threads)
+                extern.run("%s makedb --db %s --otu-table %s/methanobacteria/otus.transcripts.on_target.csv --sequence-database-methods %s --threads %i" % (
+                    path_to_script,
+                    db,
+                    path_to_data,
+                    ' '.join(methods),
+                    threads))
+                index_files[threads] = sorted(
+                    os.path.relpath(os.path.join(root, f), db) for root, _, files in os.walk(db) for f in files)
+            self.assertTrue(len([f for f in index_files[1] if 'smafa_naive_index' in f]) > 1)
+            self.assertEqual(index_files[1], index_files[2])
+
+            for method in methods:
+                cmd = "%s query --query-otu-table %s/methanobacteria/otus.transcripts.on_target.3random.csv --db %%s --search-method %s --max-nearest-neighbours 2" % (
+                    path_to_script,
+                    path_to_data,
+                    method)
+                expected = extern.run(cmd % os.path.join(d, 'db1'))
+                self.assertTrue(len(expected.splitlines()) > 1)
+                self.assertEqual(expected, extern.run(cmd % os.path.join(d, 'db2')), method)
+
     @unittest.skipIf(not TEST_NMSLIB and not TEST_ANNOY and not TEST_SCANN, "no protein search methods found, skipping test")
     def test_protein_search_methanobacteria(self):
         with tempfile.TemporaryDirectory() as d:
@@ -250,6 +308,31 @@ class Tests(unittest.TestCase):
             observed = extern.run(cmd).split('\n')
             self.assertEqual(expected, observed)
 
+    def test_preload_db_memmap(self):
+        from singlem.sequence_database import SequenceDatabase
+        from singlem.querier import Querier, MemmapPreloadedDB
+        with tempfile.TemporaryDirectory() as d:
+            db_path = os.path.join(d, 'db')
+            shutil.copytree(os.path.join(path_to_data,'small.otu_table.v5.sdb'), db_path)
+            sdb = SequenceDatabase.acquire(db_path)
+            querier = Querier()
+            for preload in [querier.preload_nucleotide_db, querier.preload_protein_db]:
+                expected = preload(sdb, 1, None)
+                # The second time is loaded from the cache
+                for _ in range(2):
+                    observed = preload(sdb, 1, None, memmap=True)
+                    self.assertIsInstance(observed, MemmapPreloadedDB)
+                    self.assertEqual(len(expected.indices), len(observed.indices))
+                    for i in range(len(expected.indices)):
+                        expected_rows = list(expected.indices.iat[i])
+                        observed_rows = list(observed.indices.iat[i])
+                        self.assertEqual(len(expected_rows), len(observed_rows))
+                        for e, o in zip(expected_rows, observed_rows):
+                            for attribute in ['sample_name','count','sequence','coverage','taxonomy']:
+                                self.assertEqual(getattr(expected, attribute)[e], getattr(observed, attribute)[o])
+            self.assertEqual(['nucleotide','protein'], sorted(os.listdir(
+                os.path.join(db_path, MemmapPreloadedDB.CACHE_DIRECTORY_NAME))))
+
     @unittest.skipIf(not TEST_SCANN, "scann not installed")
     def test_query_with_otu_table_two_samples_preload_db_scann(self):
         with tempfile.NamedTemporaryFile(mode='w') as f:
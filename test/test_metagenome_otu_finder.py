@@ -24,6 +24,7 @@
 
 import sys, os, unittest
 sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
 
 from singlem.metagenome_otu_finder import MetagenomeOtuFinder
 from singlem.sequence_classes import *
@@ -48,6 +49,20 @@ class Tests(unittest.TestCase):
         self.assertEqual(('AAA-TG',6),\
             m._nucleotide_alignment(AlignedProteinSequence('name','AAA-TTGGG'), 'AAATTGGG', [0,1,2,3,5,6], False))
 
+    def test__nucleotide_alignment_long_read(self):
+        m = MetagenomeOtuFinder()
+        protein = 'AC-D'*5000
+        nucleotides = 'AAATTTGGG'*5000
+        self.assertEqual(('AAAtttGGG'*2+'AAA',21),\
+            m._nucleotide_alignment(AlignedProteinSequence('name',protein), nucleotides, [4,7,8,11,12], True, include_inserts=True))
+        self.assertEqual(('AAA---GGG',9),\
+            m._nucleotide_alignment(AlignedProteinSequence('name',protein), nucleotides, [19996,19998,19999], True))
+
+    def test__nucleotide_alignment_gap_in_nucleotides(self):
+        m = MetagenomeOtuFinder()
+        with self.assertRaises(Exception):
+            m._nucleotide_alignment(AlignedProteinSequence('name','AC-D'), 'AAA---GGG', [0,1,2,3], True)
+
     def test_find_best_window_with_nucleotides(self):
         m = MetagenomeOtuFinder()
         seqs = [
@@ -84,6 +99,41 @@ class Tests(unittest.TestCase):
         self.assertEqual(['AAAAA','TATGG','TATGG','TATGG','TATGG'],
                          [o.aligned_sequence for o in obs])
 
+    def test_find_best_window_ignores_lower_case_columns(self):
+        m = MetagenomeOtuFinder()
+        seqs = [
+            Sequence('seq0', 'AA-aaAAAA--'),
+            Sequence('seq1', '-A-a-AAAAA-'),
+            Sequence('seq2', '--A--AAAAAA')]
+        self.assertEqual([3,4], m._find_lower_case_columns(seqs))
+        # Window of 3 starting at column 5 i.e. upper case position 3
+        self.assertEqual(3, m.find_best_window(seqs, 3, False))
+
+    def test_find_best_window_no_aligned_bases(self):
+        m = MetagenomeOtuFinder()
+        seqs = [
+            Sequence('seq0', 'AA----'),
+            Sequence('seq1', '----AA')]
+        self.assertEqual(0, m.find_best_window(seqs, 3, False))
+
+    def test_find_best_window_protein_package(self):
+        alignment = SeqReader().alignment_from_alignment_file(os.path.join(
+            path_to_data, '4.11.22seqs.gpkg.spkg', '4.11.22seqs', '4.11.22seqs.gpkg.refpkg',
+            '11_deduplicated_aligned.fasta'))
+        self.assertEqual(43, MetagenomeOtuFinder().find_best_window(alignment, 60, True))
+
+    def test_find_best_window_deep_protein_package(self):
+        alignment = SeqReader().alignment_from_alignment_file(os.path.join(
+            path_to_data, 'S1.7.ribosomal_protein_L16_L10E_rplP.gpkg.spkg', 'S1.7.ribosomal_protein_L16_L10E_rplP',
+            '4.14.ribosomal_protein_L16_L10E_rplP_final.gpkg.refpkg', '4_deduplicated_aligned.fasta'))
+        self.assertEqual(82, MetagenomeOtuFinder().find_best_window(alignment, 60, True))
+
+    def test_find_best_window_nucleotide_package(self):
+        alignment = SeqReader().alignment_from_alignment_file(os.path.join(
+            path_to_data, '61_otus.v3.gpkg.spkg', '61_otus.v3', '61_otus.v3.gpkg.refpkg',
+            '61_otus_deduplicated_aligned.fasta'))
+        self.assertEqual(216, MetagenomeOtuFinder().find_best_window(alignment, 60, False))
+
 
 
 if __name__ == "__main__":
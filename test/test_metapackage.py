@@ -33,6 +33,7 @@ path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
 
 sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
 from singlem.metapackage import Metapackage
+from singlem.metapackage_read_name_store import MetapackageReadNameStore
 from singlem.otu_table_collection import OtuTableCollection
 from singlem.taxonomy import TaxonomyUtils
 
@@ -114,6 +115,52 @@ class Tests(unittest.TestCase):
                     's__Weissella_hellenica']
             }, mp.get_taxonomy_of_reads(['2513020051', '2585428030']))
 
+    def test_read_name_store_lookup_and_cache(self):
+        store = MetapackageReadNameStore.acquire(
+            os.path.join(path_to_data, '4.11.22seqs.gpkg.spkg.smpkg', 'read_taxonomies.sqlite3'), cache_size=1)
+        expected = {
+            '2513020051':
+                ['d__Bacteria',
+                'p__Proteobacteria',
+                'c__Betaproteobacteria',
+                'o__Burkholderiales',
+                'f__Comamonadaceae',
+                'g__Variovorax',
+                's__Variovorax_sp._CF313'],
+            '2585428030':
+                ['d__Bacteria',
+                'p__Firmicutes',
+                'c__Bacilli',
+                'o__Lactobacillales',
+                'f__Leuconostocaceae',
+                'g__Weissella',
+                's__Weissella_hellenica']
+        }
+        self.assertEqual(expected, store.get_taxonomy_of_reads(['2513020051', '2585428030']))
+        # Cached results are returned as copies
+        store.get_taxonomy_of_reads(['2585428030'])['2585428030'].append('modified')
+        self.assertEqual(expected, store.get_taxonomy_of_reads(['2513020051', '2585428030']))
+        with self.assertRaises(Exception):
+            store.get_taxonomy_of_reads(['2585428030', 'not_a_read_name'])
+
+    def test_get_dmnd_cached(self):
+        with tempfile.TemporaryDirectory(prefix='singlem') as f:
+            os.environ['SINGLEM_DIAMOND_CACHE_DIRECTORY'] = f
+            try:
+                mp = Metapackage([os.path.join(path_to_data, '4.11.22seqs.v3_archaea_targetted.gpkg.spkg')])
+                dmnd = mp.get_dmnd()
+                self.assertEqual(f, os.path.dirname(dmnd))
+                self.assertTrue(os.path.exists(dmnd))
+                mtime = os.path.getmtime(dmnd)
+                # Second time it should be reused rather than rebuilt
+                self.assertEqual(dmnd, mp.get_dmnd())
+                self.assertEqual(mtime, os.path.getmtime(dmnd))
+                # No per-database lock or partially built files are left behind
+                self.assertEqual(
+                    ['.lock', os.path.basename(dmnd), os.path.basename(dmnd)+'.seed_idx'],
+                    sorted(os.listdir(f)))
+            finally:
+                del os.environ['SINGLEM_DIAMOND_CACHE_DIRECTORY']
 
 if __name__ == "__main__":
     unittest.main()
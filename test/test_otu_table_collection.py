@@ -22,7 +22,7 @@
 #=======================================================================
 
 
-import sys, os, unittest, logging
+import sys, os, unittest, logging, json, gzip, tempfile
 from io import StringIO
 
 sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
@@ -78,6 +78,62 @@ class Tests(unittest.TestCase):
         table_collection.collapse_coupled().write_to(out)
         self.assertEqual(expected, out.getvalue())
 
+    def test_streaming_archive_otu_table(self):
+        archive = {
+            "version": 4,
+            "alignment_hmm_sha256s": ["a"],
+            "singlem_package_sha256s": ["b"],
+            "fields": str.split('gene sample sequence num_hits coverage taxonomy read_names nucleotides_aligned taxonomy_by_known? read_unaligned_sequences equal_best_hit_taxonomies taxonomy_assignment_method'),
+            "otus": [
+                ["gene1", "sample1", "AAT", 2, 4.1, "Root; d__Bacteria", ["r1", "r2"], [3, 3], False, ["AATG", "AATC"], [["Root; d__Bacteria"]], "diamond"],
+                ["gene1", "sample2", "GGG", 1, 1.2, "Root", ["r3"], [3], False, ["GGGA"], [["Root"]], "diamond"]]}
+
+        collection = StreamingOtuTableCollection()
+        collection.add_archive_otu_table(StringIO(json.dumps(archive)))
+        samples = list(collection.each_sample_otus(generate_archive_otu_table=True))
+        self.assertEqual(['sample1','sample2'], [s for (s, _) in samples])
+        self.assertEqual([archive['otus'][0]], samples[0][1].data)
+        self.assertEqual([archive['otus'][1]], samples[1][1].data)
+
+    def test_streaming_truncated_gzip_archive_otu_table(self):
+        archive = {
+            "version": 4,
+            "alignment_hmm_sha256s": ["a"],
+            "singlem_package_sha256s": ["b"],
+            "fields": str.split('gene sample sequence num_hits coverage taxonomy read_names nucleotides_aligned taxonomy_by_known? read_unaligned_sequences equal_best_hit_taxonomies taxonomy_assignment_method'),
+            "otus": [
+                ["gene1", "sample%i" % i, "AAT", 2, 4.1, "Root; d__Bacteria", ["r%i" % i], [3], False, None, [["Root; d__Bacteria"]], "diamond"]
+                for i in range(1000)]}
+        with tempfile.TemporaryDirectory() as d:
+            good = os.path.join(d, 'good.json.gz')
+            with gzip.open(good, 'wt') as f:
+                json.dump(archive, f)
+            # A truncated gzip file, and a complete gzip file of truncated JSON
+            truncated_gzip = os.path.join(d, 'truncated_gzip.json.gz')
+            with open(good, 'rb') as f:
+                data = f.read()
+            with open(truncated_gzip, 'wb') as f:
+                f.write(data[:len(data)//2])
+            truncated_json = os.path.join(d, 'truncated_json.json.gz')
+            with gzip.open(truncated_json, 'wt') as f:
+                f.write(json.dumps(archive)[:-1000])
+
+            # A truncated gzip file is skipped entirely
+            collection = StreamingOtuTableCollection()
+            collection.add_gzip_archive_otu_table_file(truncated_gzip)
+            collection.add_gzip_archive_otu_table_file(good)
+            self.assertEqual(archive['otus'], [otu.data for otu in collection])
+
+            # Invalid JSON is only found once the OTUs before it have been
+            # streamed, so only the remainder of that table is skipped.
+            collection = StreamingOtuTableCollection()
+            collection.add_gzip_archive_otu_table_file(truncated_json)
+            collection.add_gzip_archive_otu_table_file(good)
+            observed = [otu.data for otu in collection]
+            num_parsed = len(observed) - len(archive['otus'])
+            self.assertTrue(0 < num_parsed < len(archive['otus']))
+            self.assertEqual(archive['otus'][:num_parsed] + archive['otus'], observed)
+
 
 
 if __name__ == "__main__":
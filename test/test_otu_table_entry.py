@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.otu_table_entry import OtuTableEntry
+
+class Tests(unittest.TestCase):
+    def _entry(self, taxonomy):
+        e = OtuTableEntry()
+        e.taxonomy = taxonomy
+        return e
+
+    def test_taxonomy_array(self):
+        e = self._entry('Root; d__Bacteria; p__Firmicutes; ')
+        self.assertEqual(['Root','d__Bacteria','p__Firmicutes'], e.taxonomy_array())
+        # Returned lists are independent of each other
+        e.taxonomy_array().append('c__Bacilli')
+        self.assertEqual(['Root','d__Bacteria','p__Firmicutes'], e.taxonomy_array())
+        self.assertEqual(None, self._entry('').taxonomy_array())
+
+    def test_taxonomy_array_after_change(self):
+        e = self._entry('Root; d__Bacteria')
+        self.assertEqual(['Root','d__Bacteria'], e.taxonomy_array())
+        e.taxonomy = 'Root; d__Archaea'
+        self.assertEqual(['Root','d__Archaea'], e.taxonomy_array())
+
+    def test_within_taxonomy(self):
+        e = self._entry('Root; d__Bacteria; p__Firmicutes')
+        self.assertTrue(e.within_taxonomy(['Root','d__Bacteria']))
+        self.assertTrue(e.within_taxonomy(['Root','d__Bacteria','p__Firmicutes']))
+        self.assertFalse(e.within_taxonomy(['Root','d__Archaea']))
+        self.assertFalse(e.within_taxonomy(['Root','d__Bacteria','p__Firmicutes','c__Bacilli']))
+
+    def test_no_instance_dict(self):
+        with self.assertRaises(AttributeError):
+            OtuTableEntry().not_a_field = 1
+
+if __name__ == "__main__":
+    unittest.main()
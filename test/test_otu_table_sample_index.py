@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+import json
+import gzip
+import tempfile
+import logging
+
+from Bio import bgzf
+
+path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.otu_table_sample_index import OtuTableSampleIndex
+from singlem.otu_table_collection import StreamingOtuTableCollection
+
+class Tests(unittest.TestCase):
+    with open(os.path.join(path_to_data, 'otu_table_formats', 'otu_table.csv')) as f:
+        otu_table = f.read()
+    with open(os.path.join(path_to_data, 'otu_table_formats', 'archive_otu_table.json')) as f:
+        archive = json.load(f)
+
+    def _each_sample(self, collection):
+        return [(s, t.data) for s, t in collection.each_sample_otus()]
+
+    def test_otu_table(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'otus.csv')
+            with open(path, 'w') as f:
+                f.write(self.otu_table)
+            index = OtuTableSampleIndex.generate(path, OtuTableSampleIndex.OTU_TABLE_FORMAT)
+            self.assertEqual(['sample1','sample2','sample3'], list(index.samples.keys()))
+            self.assertTrue(os.path.exists(path + '.sample_index'))
+
+            collection = StreamingOtuTableCollection()
+            collection.add_otu_table_file(path)
+            collection.sample_names = ['sample3', 'sample1', 'nonexistent']
+            self.assertEqual([
+                ('sample1', [['gene1','sample1','AAT',2,4.1,'Root; d__Bacteria'],['gene2','sample1','GGT',1,1.2,'Root; d__Archaea']]),
+                ('sample3', [['gene2','sample3','TTA',3,6.0,'']])],
+                self._each_sample(collection))
+
+    def test_archive_otu_table(self):
+        with tempfile.TemporaryDirectory() as d:
+            # Both with non-ASCII characters escaped, and not
+            for ensure_ascii in (True, False):
+                path = os.path.join(d, 'otus%s.json' % ensure_ascii)
+                with open(path, 'w', encoding='utf-8') as f:
+                    json.dump(self.archive, f, ensure_ascii=ensure_ascii)
+                OtuTableSampleIndex.generate(path, OtuTableSampleIndex.ARCHIVE_OTU_TABLE_FORMAT)
+
+                collection = StreamingOtuTableCollection()
+                collection.add_archive_otu_table_file(path)
+                collection.sample_names = ['sampleé3', 'sample2']
+                self.assertEqual([
+                    ('sample2', self.archive['otus'][1:3]),
+                    ('sampleé3', self.archive['otus'][3:])],
+                    self._each_sample(collection))
+
+    def test_bgzf_archive_otu_table(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'otus.json.gz')
+            archive = dict(self.archive)
+            # Enough OTUs that the table spans many BGZF blocks
+            archive['otus'] = [
+                ["gene1", "sample%i" % (i // 10), "A"*60, 1, 1.2, "Root", ["r%i" % i], [60], False, ["A"*150], [["Root"]], "diamond"]
+                for i in range(20000)]
+            with bgzf.BgzfWriter(path, 'wb') as f:
+                f.write(json.dumps(archive).encode())
+            OtuTableSampleIndex.generate(path, OtuTableSampleIndex.ARCHIVE_OTU_TABLE_FORMAT)
+
+            collection = StreamingOtuTableCollection()
+            collection.add_gzip_archive_otu_table_file(path)
+            collection.sample_names = ['sample1999', 'sample1']
+            collection.min_archive_otu_table_version = 4
+            self.assertEqual([
+                ('sample1', archive['otus'][10:20]),
+                ('sample1999', archive['otus'][19990:])],
+                self._each_sample(collection))
+
+    def test_non_bgzf_gzip(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'otus.json.gz')
+            with gzip.open(path, 'wt') as f:
+                json.dump(self.archive, f)
+            with self.assertRaisesRegex(Exception, 'not BGZF'):
+                OtuTableSampleIndex.generate(path, OtuTableSampleIndex.ARCHIVE_OTU_TABLE_FORMAT)
+
+    def test_non_contiguous_samples(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'otus.csv')
+            with open(path, 'w') as f:
+                f.write(self.otu_table)
+                f.write("\t".join(['gene3','sample1','AAT','2','4.10','Root; d__Bacteria'])+"\n")
+            with self.assertRaisesRegex(Exception, 'not contiguous'):
+                OtuTableSampleIndex.generate(path, OtuTableSampleIndex.OTU_TABLE_FORMAT)
+
+    def test_stale_index_ignored(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'otus.csv')
+            with open(path, 'w') as f:
+                f.write(self.otu_table)
+            OtuTableSampleIndex.generate(path, OtuTableSampleIndex.OTU_TABLE_FORMAT)
+            with open(path, 'a') as f:
+                f.write("\t".join(['gene3','sample4','AAT','2','4.10','Root; d__Bacteria'])+"\n")
+            self.assertIsNone(OtuTableSampleIndex.acquire(path))
+
+            collection = StreamingOtuTableCollection()
+            collection.add_otu_table_file(path)
+            collection.sample_names = ['sample4']
+            self.assertEqual(
+                [('sample4', [['gene3','sample4','AAT',2,4.1,'Root; d__Bacteria']])],
+                self._each_sample(collection))
+
+    def test_same_size_stale_index_ignored(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'otus.csv')
+            with open(path, 'w') as f:
+                f.write(self.otu_table)
+            index = OtuTableSampleIndex.generate(path, OtuTableSampleIndex.OTU_TABLE_FORMAT)
+            self.assertIsNotNone(OtuTableSampleIndex.acquire(path))
+
+            # Rewrite with a different sample name of the same length
+            with open(path, 'w') as f:
+                f.write(self.otu_table.replace('sample3', 'sample4'))
+            os.utime(path, (index.table_mtime + 10, index.table_mtime + 10))
+            self.assertEqual(index.table_size, os.path.getsize(path))
+            self.assertIsNone(OtuTableSampleIndex.acquire(path))
+
+            collection = StreamingOtuTableCollection()
+            collection.add_otu_table_file(path)
+            collection.sample_names = ['sample4']
+            self.assertEqual(
+                [('sample4', [['gene2','sample4','TTA',3,6.0,'']])],
+                self._each_sample(collection))
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    unittest.main()
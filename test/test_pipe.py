@@ -445,6 +445,23 @@ ATTAACAGTAGCTGAAGTTACTGACTTACGTTCACAATTACGTGAAGCTGGTGTTGAGTATAAAGTATACAAAAACACTA
         r = re.compile('\t.*?$') # Do not test the exact genome number because updated diamond version change this slightly.
         self.assertEqual([r.sub('',e) for e in exp], [r.sub('',e) for e in observed])
 
+    def test_diamond_assign_taxonomy_assignment_threads(self):
+        # Running DIAMOND jobs in parallel should not change the output
+        with tempfile.NamedTemporaryFile(mode='w',suffix='.fasta') as f:
+            f.write("\n".join(['>HWI-ST1243:156:D1K83ACXX:7:1109:18214:9910 1:N:0:TCCTGAGCCTAAGCCT',
+                'GTTAAATTACAAATTCCTGCAGGTAAAGCGAATCCAGCACCACCAGTTGGTCCAGCATTAGGTCAAGCAGGTGTGAACATCATGGGATTCTGTAAAGAGT','']))
+            f.flush()
+
+            cmd_stub = "%s pipe --sequences %s %s/1_pipe/minimal.fa --otu-table /dev/stdout --assignment_method diamond --metapackage %s/S1.5.ribosomal_protein_L11_rplK.gpkg.spkg.smpkg" % (
+                path_to_script,
+                f.name,
+                path_to_data,
+                path_to_data)
+            serial = sorted(extern.run(cmd_stub + " --assignment-threads 1").split("\n"))
+            parallel = sorted(extern.run(cmd_stub + " --assignment-threads 2").split("\n"))
+            self.assertEqual(3, len([l for l in serial if l != '']))
+            self.assertEqual(serial, parallel)
+
     def test_one_read_two_orfs_two_diamond_hits(self):
         # what a pain the real world is
         seq = '''>HWI-ST1240:128:C1DG3ACXX:7:2204:6599:65352 1:N:0:GTAGAGGATAGATCGC
@@ -1132,6 +1149,19 @@ CGGGATGTAGGCAGTGACCTCCACGCCTGAGGAGAGCCGGACGCGTGCGACCTTGCGCAACGCCGAGTTCGGCTTCTTCG
             list([line.split("\t") for line in expected]),
             extern.run(cmd))
 
+    def test_median_taxonomy(self):
+        pipe = SearchPipe()
+        self.assertEqual('Root; d__Bacteria; p__Firmicutes', pipe._median_taxonomy([
+            'Root; d__Bacteria; p__Firmicutes; c__Bacilli',
+            'Root; d__Bacteria; p__Firmicutes; c__Clostridia',
+            'Root; d__Bacteria; p__Firmicutes; c__Clostridia',
+            'Root; d__Archaea',
+            'Root; d__Bacteria; p__Firmicutes; c__Bacilli',
+        ]))
+        self.assertEqual('Root; d__Bacteria', pipe._median_taxonomy([
+            'Root; d__Bacteria; p__Firmicutes',
+            'Root; d__Bacteria; p__Actinobacteriota',
+        ]))
 
 
 
@@ -154,6 +154,20 @@ class Tests(unittest.TestCase):
         self.assertEqual(1, len(rares))
         self.assertEqual(2, rares[0].count)
 
+    def test_high_counts_not_expanded(self):
+        # Expanding these counts into one entry per read would exhaust RAM
+        e = [['gene','sample','sequence','num_hits','coverage','taxonomy'],
+             ['4.11.ribosomal_protein_L10','minimal','TTACGTTCACAATTACGTGAAGCTGGTGTTGAGTATAAAGTATACAAAAACACTATGGTA',str(10**12),'4.88','Root; d__Bacteria; p__Firmicutes; c__Bacilli; o__Bacillales; f__Staphylococcaceae; g__Staphylococcus'],
+             ['4.11.ribosomal_protein_L10','minimal','TTACGTTCACAATTACGTGAAGCTGGTGTTGAGTATAAAGTATACAAAAACACTATGGTT',str(10**12),'9.76','Root; d__Bacteria; p__Firmicutes; c__Bacilli; o__Bacillales']
+            ]
+        exp = "\n".join(["\t".join(x) for x in e]+[''])
+
+        table_collection = OtuTableCollection()
+        table_collection.add_otu_table(StringIO(exp))
+
+        rares = Rarefier().rarefy(table_collection, 1000)
+        self.assertEqual(1000, sum([e.count for e in rares]))
+
 
 class PredictableRandomGenerator:
     '''Generate numbers predictably, not relying on random.random
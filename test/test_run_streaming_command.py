@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+import tempfile
+import extern
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.run_streaming_command import run_streaming_command
+
+class Tests(unittest.TestCase):
+    def test_output(self):
+        with run_streaming_command('seq 3') as stdout:
+            self.assertEqual(['1\n','2\n','3\n'], list(stdout))
+
+    def test_failure(self):
+        with self.assertRaisesRegex(extern.ExternCalledProcessError, "non-zero exit status 3.\nSTDERR was: b'oops"):
+            with run_streaming_command('echo 1; echo oops >&2; exit 3') as stdout:
+                self.assertEqual(['1\n'], list(stdout))
+
+    def test_failure_in_pipe(self):
+        with self.assertRaises(extern.ExternCalledProcessError):
+            with run_streaming_command('false | cat') as stdout:
+                list(stdout)
+
+    def test_killed_on_exception(self):
+        with tempfile.TemporaryDirectory() as d:
+            done = os.path.join(d, 'done')
+            with self.assertRaises(KeyError):
+                with run_streaming_command('echo 1; sleep 5; touch {}'.format(done)) as stdout:
+                    stdout.readline()
+                    raise KeyError()
+            self.assertFalse(os.path.exists(done))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.taxonomy import TaxonomyTree, TaxonomyUtils
+
+class Tests(unittest.TestCase):
+    def test_tree_nodes(self):
+        tree = TaxonomyTree()
+        n1 = tree.node_of_string('Root; d__Bacteria; p__Firmicutes; ')
+        self.assertEqual(n1, tree.node(['Root','d__Bacteria','p__Firmicutes']))
+        self.assertEqual(n1, tree.node_of_string('Root;d__Bacteria;;p__Firmicutes'))
+        self.assertEqual(3, tree.depth(n1))
+        self.assertEqual('Root; d__Bacteria; p__Firmicutes', tree.taxonomy_string(n1))
+        self.assertEqual(['Root','d__Bacteria','p__Firmicutes'], tree.taxon_list(n1))
+        self.assertEqual(tree.node(['Root','d__Bacteria']), tree.parent(n1))
+        self.assertEqual(TaxonomyTree.ROOT, tree.node_of_string(''))
+        self.assertEqual('', tree.taxonomy_string(TaxonomyTree.ROOT))
+
+    def test_tree_lca_and_truncate(self):
+        tree = TaxonomyTree()
+        firmicutes = tree.node(['Root','d__Bacteria','p__Firmicutes','c__Bacilli'])
+        actinos = tree.node(['Root','d__Bacteria','p__Actinobacteriota'])
+        archaea = tree.node(['Root','d__Archaea'])
+        bacteria = tree.node(['Root','d__Bacteria'])
+        self.assertEqual(bacteria, tree.lca(firmicutes, actinos))
+        self.assertEqual(bacteria, tree.lca(actinos, firmicutes))
+        self.assertEqual(bacteria, tree.lca(bacteria, firmicutes))
+        self.assertEqual(tree.node(['Root']), tree.lca_of_nodes([firmicutes, actinos, archaea]))
+        self.assertEqual(firmicutes, tree.lca_of_nodes([firmicutes]))
+        # Same taxon name with a different parent is a different node
+        self.assertEqual(TaxonomyTree.ROOT, tree.lca(bacteria, tree.node(['d__Bacteria'])))
+        self.assertEqual(bacteria, tree.truncate(firmicutes, 2))
+        self.assertEqual(actinos, tree.truncate(actinos, 7))
+        self.assertEqual(TaxonomyTree.ROOT, tree.truncate(actinos, 0))
+
+    def test_lca_taxonomy_of_strings(self):
+        self.assertEqual('Root; d__Bacteria', TaxonomyUtils.lca_taxonomy_of_strings([
+            'Root; d__Bacteria; p__Firmicutes',
+            'Root; d__Bacteria; p__Actinobacteriota; ',
+            'Root; d__Bacteria; p__Firmicutes',
+        ]))
+        self.assertEqual('Root; d__Bacteria; p__Firmicutes', TaxonomyUtils.lca_taxonomy_of_strings([
+            'Root;d__Bacteria; p__Firmicutes']))
+        self.assertEqual('', TaxonomyUtils.lca_taxonomy_of_strings([
+            'Root; d__Bacteria', 'd__Bacteria']))
+
+    def test_lca_taxonomy_of_taxon_lists(self):
+        self.assertEqual('d__Bacteria; p__Firmicutes', TaxonomyUtils.lca_taxonomy_of_taxon_lists([
+            ['d__Bacteria','p__Firmicutes','c__Bacilli'],
+            ['d__Bacteria','p__Firmicutes'],
+        ]))
+        self.assertEqual('', TaxonomyUtils.lca_taxonomy_of_taxon_lists([
+            ['d__Bacteria'], ['d__Archaea']]))
+
+if __name__ == "__main__":
+    unittest.main()